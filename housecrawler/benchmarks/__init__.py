@@ -0,0 +1 @@
+# Offline benchmarks for the spiders of this project, see README.md
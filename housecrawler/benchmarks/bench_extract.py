@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of the total-count extraction on the fixture pages, the
+byte-level fast path against the XPath expressions on the lxml tree.
+
+    python -m benchmarks.bench_extract --number 200
+"""
+import argparse
+import os
+import time
+
+from scrapy.http import HtmlResponse
+
+from housecrawler.extract import extract_total_num_by_xpath, find_total_num
+
+from .make_fixtures import CITIES, fixture_path, make_fixtures
+
+
+def time_per_call(func, bodies, number):
+    """
+    :return: Mean time of one call in microseconds
+    """
+    t_start = time.perf_counter()
+    for _ in range(number):
+        for url, body in bodies:
+            func(url, body)
+    return 1e6 * (time.perf_counter() - t_start) / (number * len(bodies))
+
+
+def fast_path(url, body):
+    found = find_total_num(body)
+    assert found is not None, url
+    return found
+
+
+def xpath_path(url, body):
+    # A new response for each call, the selector is cached on the response
+    response = HtmlResponse(url=url, body=body, encoding="utf-8")
+    found = extract_total_num_by_xpath(response)
+    assert found is not None, url
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=100, help="times to extract each fixture")
+    args = parser.parse_args()
+
+    make_fixtures()
+    bodies = []
+    for code, _, _ in CITIES:
+        with open(fixture_path(code), "rb") as fp:
+            bodies.append((f"https://{code}.ke.com/ershoufang/", fp.read()))
+
+    # Both paths must agree on every fixture
+    for url, body in bodies:
+        assert fast_path(url, body)[0] == xpath_path(url, body)[0], url
+
+    size_kb = sum(len(body) for _, body in bodies) / len(bodies) / 1024
+    fast_us = time_per_call(fast_path, bodies, args.number)
+    xpath_us = time_per_call(xpath_path, bodies, args.number)
+    print(f"[PYRAD] {len(bodies)} fixtures, {size_kb:.1f} KB per page on average")
+    print(f"{'fast path':>12} = {fast_us:10.1f} us/page")
+    print(f"{'xpath':>12} = {xpath_us:10.1f} us/page")
+    print(f"{'speedup':>12} = {xpath_us / fast_us:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
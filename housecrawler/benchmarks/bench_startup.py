@@ -0,0 +1,124 @@
+"""
+Startup time of the spider, which every "scrapy list" and "scrapy crawl" pays
+before the first request is sent.
+
+    python -m benchmarks.bench_startup --runs 10
+    python -m benchmarks.bench_startup --importtime
+
+Each measure is taken in a fresh process, so nothing is already imported or
+cached. Reported (median of runs, in milliseconds):
+  - import_ms:      importing the spider module
+  - spider_ms:      creating HouseSpider
+  - data_dir_ms:    resolving the data directory, first and second time
+  - scrapy_list_ms: wall time of the whole "scrapy list" command
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def measure_once():
+    """
+    Take the measures in this process, which must not have imported the spider yet
+    """
+    t_start = time.perf_counter()
+    from housecrawler.spiders.house_spider import HouseSpider
+    t_import = time.perf_counter()
+    spider = HouseSpider()
+    t_spider = time.perf_counter()
+    spider.ssdk.get_data_dir_on_this_computer_by_cpu_name()
+    t_data_dir = time.perf_counter()
+    spider.ssdk.get_data_dir_on_this_computer_by_cpu_name()
+    t_data_dir2 = time.perf_counter()
+
+    heavy = [name for name in ("pandas", "numpy", "openpyxl", "zstandard", "cProfile", "twisted.web.server")
+             if name in sys.modules]
+    return {
+        "import_ms": round(1000.0 * (t_import - t_start), 3),
+        "spider_ms": round(1000.0 * (t_spider - t_import), 3),
+        "data_dir_ms": round(1000.0 * (t_data_dir - t_spider), 3),
+        "data_dir_cached_ms": round(1000.0 * (t_data_dir2 - t_data_dir), 3),
+        "heavy_modules_loaded": heavy,
+    }
+
+
+def run_child():
+    cmd = [sys.executable, "-m", "benchmarks.bench_startup", "--child"]
+    out = subprocess.run(cmd, cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True, check=True).stdout
+    line = [l for l in out.splitlines() if l.startswith("BENCH_RESULT ")][-1]
+    return json.loads(line[len("BENCH_RESULT "):])
+
+
+def time_scrapy_list():
+    t_start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "scrapy", "list"], cwd=PROJECT_DIR,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return round(1000.0 * (time.perf_counter() - t_start), 3)
+
+
+def print_importtime(top):
+    """
+    Print the modules which take the longest to import, by "python -X importtime"
+    """
+    cmd = [sys.executable, "-X", "importtime", "-c", "import housecrawler.spiders.house_spider"]
+    err = subprocess.run(cmd, cwd=PROJECT_DIR, stderr=subprocess.PIPE, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = [f.strip() for f in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    rows.sort(reverse=True)
+    print(f"{'cumulative us':>14} {'self us':>10}  module")
+    for cumulative_us, self_us, name in rows[:top]:
+        print(f"{cumulative_us:>14} {self_us:>10}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--no-scrapy-list", dest="scrapy_list", action="store_false",
+                        help="don't time the \"scrapy list\" command")
+    parser.add_argument("--importtime", type=int, nargs="?", const=20, default=None, metavar="TOP",
+                        help="print the TOP modules slowest to import instead (default: 20)")
+    parser.add_argument("--json", dest="json_file", default=None, help="also write the results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print("BENCH_RESULT " + json.dumps(measure_once()), flush=True)
+        return
+    if args.importtime is not None:
+        print_importtime(args.importtime)
+        return
+
+    results = []
+    for i in range(args.runs):
+        result = run_child()
+        if args.scrapy_list:
+            result["scrapy_list_ms"] = time_scrapy_list()
+        results.append(result)
+        print(f"[PYRAD] Run {i + 1}: {result}")
+
+    keys = ["import_ms", "spider_ms", "data_dir_ms", "data_dir_cached_ms"]
+    if args.scrapy_list:
+        keys.append("scrapy_list_ms")
+    print("==== Startup summary (median of runs) ====")
+    for key in keys:
+        values = sorted(r[key] for r in results)
+        print(f"{key:>24} = {values[len(values) // 2]}")
+    print(f"{'heavy modules loaded':>24} = {results[-1]['heavy_modules_loaded']}")
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as fp:
+            json.dump({"runs": results, "args": vars(args)}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
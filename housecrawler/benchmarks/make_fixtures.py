@@ -0,0 +1,153 @@
+"""
+Create the HTML fixtures of the city pages used by the benchmarks.
+
+By default the pages are generated with the same layout as the Beike
+ershoufang pages (the total-count block, the district/bizcircle filters,
+the listing list and the page box), so the benchmarks don't need the
+network. With --capture the real pages are downloaded and saved instead.
+
+    python -m benchmarks.make_fixtures [--capture]
+"""
+import argparse
+import json
+import os
+import random
+import urllib.request
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# City code (sub domain of ke.com), Chinese name, and a listing count in the
+# same order of magnitude as the real one
+CITIES = [
+    ("bj", "北京", 96547), ("gz", "广州", 134562), ("su", "苏州", 78431),
+    ("hz", "杭州", 65032), ("nj", "南京", 72514), ("xa", "西安", 81920),
+    ("cd", "成都", 152334), ("cq", "重庆", 143012), ("tj", "天津", 70211),
+    ("hf", "合肥", 40123), ("fz", "福州", 30567), ("xm", "厦门", 23456),
+    ("cs", "长沙", 61234), ("sh", "上海", 112345), ("sz", "深圳", 52345),
+    ("wh", "武汉", 123456),
+]
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{cn}二手房_{cn}二手房出售买卖信息网【{cn}贝壳找房】</title>
+<meta name="description" content="{cn}二手房买卖信息,{cn}二手房出售信息。">
+<link rel="stylesheet" href="//s1.ljcdn.com/matrix_pc/dist/pc/src/common/css/common.css">
+{scripts}
+</head>
+<body>
+<div class="beike" id="beike">
+<div class="wrapper">
+<div class="header"><div class="wrapper"><a class="logo" href="/">贝壳找房</a>{nav}</div></div>
+<div class="banner"><div class="container">{cn}二手房</div></div>
+<div class="m-search"><form><input class="search-input" placeholder="请输入区域、商圈或小区名开始找房"></form></div>
+<div class="content">
+<div class="leftContent">
+<div class="m-filter"><div class="position"><dl><dt>区域</dt><dd data-role="ershoufang">
+<div>{districts}</div>
+<div>{bizcircles}</div>
+</dd></dl></div></div>
+<div class="resultDes clear">
+<div class="total-box">
+<h2 class="total fl">共找到<span> {total} </span>套<a href="/ershoufang/" title="{cn}在售二手房">{cn}</a>二手房</h2>
+</div>
+</div>
+<ul class="sellListContent" log-mod="list">
+"""
+
+LISTING = """<li class="clear" data-lj_action_resblock_id="{rid}">
+<a class="noresultRecommend img LOGCLICKDATA" href="https://{code}.ke.com/ershoufang/{hid}.html" target="_blank" data-housecode="{hid}"><img class="lj-lazy" src="https://s1.ljcdn.com/x.png" alt="{cn}{name}"></a>
+<div class="info clear">
+<div class="title"><a class="" href="https://{code}.ke.com/ershoufang/{hid}.html" target="_blank" data-housecode="{hid}" title="{name} {rooms}室{halls}厅 {area}平米">{name} {rooms}室{halls}厅 {area}平米</a></div>
+<div class="address"><div class="flood"><div class="positionInfo"><a href="/xiaoqu/{rid}/">{name}</a></div></div>
+<div class="houseInfo">中楼层 (共{floors}层) | {year}年建 | {rooms}室{halls}厅 | {area}平米 | 南 北</div>
+<div class="followInfo">{follow}人关注 / {days}天以前发布</div>
+<div class="priceInfo"><div class="totalPrice totalPrice2"><i> </i><span class="">{price}</span><i>万</i></div>
+<div class="unitPrice" data-hid="{hid}" data-price="{unit}"><span>{unit_fmt}元/平</span></div></div>
+</div></div>
+</li>
+"""
+
+PAGE_TAIL = """</ul>
+<div class="contentBottom clear"><div class="page-box fr"><div class="page-box house-lst-page-box" comp-module="page" page-url="/ershoufang/pg{{page}}/" page-data='{page_data}'></div></div></div>
+</div>
+</div>
+<div class="footer">{footer}</div>
+</div>
+</div>
+</body>
+</html>
+"""
+
+DISTRICTS = ["东城", "西城", "朝阳", "海淀", "丰台", "石景山", "通州", "昌平", "大兴", "顺义",
+             "房山", "门头沟", "平谷", "怀柔", "密云", "延庆"]
+BIZCIRCLES = ["安贞", "安定门", "朝阳门外", "东直门", "广渠门", "和平里", "建国门内", "交道口",
+              "金宝街", "六铺炕", "前门", "天坛", "西单", "永定门", "崇文门", "东单"]
+
+
+def render_page(code, cn, total, page=1, seed=None, nlisting=30):
+    """
+    Render a listing page of a city, a district or a bizcircle
+    :param code: City code, e.g. "bj"
+    :param cn: Chinese name of the city
+    :param total: The total number shown in the count block
+    :param page: The page number, it is also used to generate different listings
+    :return: The page as a string
+    """
+    rnd = random.Random(f"{code}-{total}-{page}-{seed}")
+    # Inline scripts and a long navigation bar, they are a large part of the real pages
+    scripts = "\n".join(f"<script>window.__conf{i} = {json.dumps({'k': 'v' * 200, 'i': i})};</script>"
+                        for i in range(40))
+    nav = "".join(f'<a href="/nav{i}/">导航{i}</a>' for i in range(80))
+    districts = "".join(f'<a href="/ershoufang/d{i}/" title="{cn}{d}在售二手房 ">{d}</a>'
+                        for i, d in enumerate(DISTRICTS))
+    bizcircles = "".join(f'<a href="/ershoufang/b{i}/">{b}</a>' for i, b in enumerate(BIZCIRCLES))
+    parts = [PAGE_HEAD.format(cn=cn, scripts=scripts, nav=nav, districts=districts,
+                              bizcircles=bizcircles, total=total)]
+    for _ in range(min(nlisting, total)):
+        area = round(rnd.uniform(35, 240), 2)
+        unit = rnd.randint(8000, 120000)
+        parts.append(LISTING.format(
+            code=code, cn=cn, hid=rnd.randint(101100000000, 101130000000), rid=rnd.randint(1111027370000, 1111027399999),
+            name=f"小区{rnd.randint(1, 9999)}", rooms=rnd.randint(1, 5), halls=rnd.randint(1, 2), area=area,
+            floors=rnd.randint(6, 33), year=rnd.randint(1985, 2022), follow=rnd.randint(0, 500),
+            days=rnd.randint(1, 300), price=round(area * unit / 10000), unit=unit, unit_fmt=format(unit, ",")))
+    total_page = max(1, min(100, (total + nlisting - 1) // nlisting))
+    page_data = json.dumps({"totalPage": total_page, "curPage": page})
+    footer = "".join(f'<a href="/city{i}/">城市{i}</a>' for i in range(300))
+    parts.append(PAGE_TAIL.format(page_data=page_data, footer=footer))
+    return "".join(parts)
+
+
+def fixture_path(code):
+    return os.path.join(FIXTURE_DIR, f"{code}.html")
+
+
+def capture_page(code):
+    from housecrawler.spiders.house_spider import HouseSpider
+
+    url = f"https://{code}.ke.com/ershoufang/"
+    req = urllib.request.Request(url, headers=HouseSpider.get_headers())
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return resp.read()
+
+
+def make_fixtures(capture=False, force=False):
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    for code, cn, total in CITIES:
+        fname = fixture_path(code)
+        if os.path.isfile(fname) and not force:
+            continue
+        body = capture_page(code) if capture else render_page(code, cn, total).encode("utf-8")
+        with open(fname, "wb") as fp:
+            fp.write(body)
+        print(f"[PYRAD] Saved fixture {fname} ({len(body)} bytes)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture", action="store_true", help="download the real pages instead of generating them")
+    parser.add_argument("--force", action="store_true", help="overwrite existing fixtures")
+    args = parser.parse_args()
+    make_fixtures(args.capture, args.force)
@@ -0,0 +1,163 @@
+"""
+A local stand-in for a pool of HTTP proxies, in front of the mock server.
+
+Each proxy listens on its own port and forwards the requests (with the
+absolute URL, as a proxy gets them) to the upstream, which is the mock
+server (benchmarks/mock_server.py) working as a proxy itself. A proxy can
+add latency, fail requests with 502, or stand for an IP which Beike bans
+when it is too fast: with --rate-limit, a host which gets more requests in
+a second than that from one proxy answers them with 418 ban pages.
+
+    python -m benchmarks.mock_server --port 8018
+    python -m benchmarks.mock_proxy --port 8100 --count 4 --upstream http://127.0.0.1:8018 --rate-limit 5
+
+GET http://127.0.0.1:{port}/__stats__ returns the counters of a proxy as JSON.
+"""
+import argparse
+import collections
+import http.client
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+from .mock_server import BAN_PAGE, MockHTTPServer
+
+# The headers of the upstream response passed on to the client
+FORWARD_HEADERS = ("Content-Type", "Content-Encoding", "Location", "ETag", "Last-Modified")
+
+
+class MockProxyConfig:
+    def __init__(self, upstream, latency_ms=0.0, fail_rate=0.0, rate_limit=0.0, seed=None):
+        parts = urlsplit(upstream)
+        self.upstream_host = parts.hostname
+        self.upstream_port = parts.port or 80
+        self.latency_ms = latency_ms
+        self.fail_rate = fail_rate
+        self.rate_limit = rate_limit
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "banned": 0, "failed": 0}
+        # The times of the requests of the last second, per host
+        self.recent = collections.defaultdict(collections.deque)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def draw(self):
+        with self.lock:
+            return self.rnd.random()
+
+    def is_over_rate(self, host):
+        """
+        Count a request to a host, and check whether this proxy went over the
+        rate the host allows to one IP
+        """
+        if self.rate_limit <= 0:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            times = self.recent[host]
+            while times and times[0] <= now - 1.0:
+                times.popleft()
+            times.append(now)
+            return len(times) > self.rate_limit
+
+
+class MockProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        sent = set()
+        for name, value in headers:
+            self.send_header(name, value)
+            sent.add(name.lower())
+        if "content-type" not in sent:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.config.count("bytes", len(body))
+
+    def do_GET(self):
+        cfg = self.config
+        url = urlsplit(self.path)
+        if url.path == "/__stats__" and not url.hostname:
+            with cfg.lock:
+                body = json.dumps(cfg.stats).encode("utf-8")
+            self.send_body(200, body, [("Content-Type", "application/json")])
+            return
+
+        cfg.count("requests")
+        if cfg.latency_ms > 0:
+            time.sleep(cfg.latency_ms / 1000.0)
+        if cfg.draw() < cfg.fail_rate:
+            cfg.count("failed")
+            self.send_body(502, b"<html><body>Bad Gateway</body></html>")
+            return
+        if cfg.is_over_rate(url.hostname or ""):
+            cfg.count("banned")
+            self.send_body(418, BAN_PAGE)
+            return
+
+        # Forward the request with its absolute URL, the upstream is a proxy too
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() not in ("proxy-connection", "proxy-authorization", "connection")}
+        conn = http.client.HTTPConnection(cfg.upstream_host, cfg.upstream_port, timeout=30)
+        try:
+            conn.request("GET", self.path, headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            fwd = [(name, resp.getheader(name)) for name in FORWARD_HEADERS if resp.getheader(name) is not None]
+            self.send_body(resp.status, body, fwd)
+        except OSError:
+            cfg.count("failed")
+            self.send_body(502, b"<html><body>Bad Gateway</body></html>")
+        finally:
+            conn.close()
+
+
+def make_proxy(port, config):
+    handler = type("Handler", (MockProxyHandler,), {"config": config})
+    return MockHTTPServer(("127.0.0.1", port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100, help="port of the first proxy, the others follow it")
+    parser.add_argument("--count", type=int, default=1, help="number of proxies")
+    parser.add_argument("--upstream", default="http://127.0.0.1:8018", help="the mock server")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency added by each proxy")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests failed with 502")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="requests per second a host takes from one proxy before banning it (0: no limit)")
+    parser.add_argument("--bad", type=int, default=0,
+                        help="number of the proxies (the last ones) which fail every request")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    servers = []
+    for i in range(args.count):
+        fail_rate = 1.0 if i >= args.count - args.bad else args.fail_rate
+        seed = None if args.seed is None else args.seed + i
+        config = MockProxyConfig(args.upstream, args.latency_ms, fail_rate, args.rate_limit, seed)
+        servers.append(make_proxy(args.port + i if args.port else 0, config))
+    urls = [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[PYRAD] Mock proxies listening on {','.join(urls)}", flush=True)
+    try:
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.server_close()
@@ -0,0 +1,213 @@
+"""
+A local stand-in for the Beike servers.
+
+The server works as an HTTP proxy: the spider sends its requests for
+http://{code}.ke.com/... to it (see the BEIKE_MIRROR_PROXY setting), and
+the city pages are served from the fixtures, other pages (districts,
+bizcircles, pgN pages) are generated with the same layout. Latency, 418
+bans and server errors can be configured to test the spider under load.
+With --bandwidth-kb the bodies are sent in pieces at that rate, as over a
+real link, so a download stopped early (EARLY_ABORT_ENABLED) saves bytes.
+With --etag the pages have an ETag, and a request with the same
+If-None-Match gets 304 Not Modified.
+
+    python -m benchmarks.mock_server --port 8018 --latency-ms 50 --ban-rate 0.05
+
+GET http://127.0.0.1:{port}/__stats__ returns the counters as JSON.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from .make_fixtures import CITIES, fixture_path, make_fixtures, render_page
+
+BAN_PAGE = ("<html><head><title>人机验证</title></head><body>"
+            "<div id=\"captcha\">您的访问过于频繁，请完成人机验证</div></body></html>").encode("utf-8")
+
+
+class MockBeikeConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, ban_rate=0.0, error_rate=0.0, seed=None, etag=False,
+                 bandwidth_kb=0.0):
+        self.latency_ms = latency_ms
+        # KB/s of each response, 0 sends the body at once
+        self.bandwidth_kb = bandwidth_kb
+        self.jitter_ms = jitter_ms
+        self.ban_rate = ban_rate
+        self.error_rate = error_rate
+        self.etag = etag
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        # "bytes" are the bytes of the bodies sent, "body_bytes" of the bodies
+        # as a whole, less are sent if the client closes the connection
+        # while a body is sent at --bandwidth-kb ("stopped")
+        self.stats = {"requests": 0, "bytes": 0, "body_bytes": 0, "banned": 0, "errors": 0, "not_found": 0,
+                      "not_modified": 0, "stopped": 0}
+        self.city_by_code = {code: (cn, total) for code, cn, total in CITIES}
+        self.fixtures = dict()
+        # The generated pages, rendering them would make the server the
+        # bottleneck of the runs with several workers
+        self.pages = dict()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def draw(self):
+        with self.lock:
+            return self.rnd.random(), self.rnd.uniform(-1.0, 1.0)
+
+    def get_fixture(self, code):
+        if code not in self.fixtures:
+            with open(fixture_path(code), "rb") as fp:
+                self.fixtures[code] = fp.read()
+        return self.fixtures[code]
+
+    def get_page(self, host, path):
+        """
+        :return: The body of the page, or None if there is no such page
+        """
+        code = host.split(".", 1)[0]
+        if code not in self.city_by_code or not host.endswith("ke.com"):
+            return None
+        cn, total = self.city_by_code[code]
+        parts = [p for p in path.split("/") if p]
+        if not parts or parts[0] != "ershoufang":
+            return None
+        if len(parts) == 1:
+            return self.get_fixture(code)
+        # Districts, bizcircles and pgN pages get a smaller total derived from the path
+        page = 1
+        if parts[-1].startswith("pg") and parts[-1][2:].isdigit():
+            page = int(parts[-1][2:])
+            parts = parts[:-1]
+        for p in parts[1:]:
+            total = max(1, total // (7 + sum(map(ord, p)) % 11))
+        key = (code, "/".join(parts), page)
+        if key not in self.pages:
+            self.pages[key] = render_page(code, cn, total, page, seed="/".join(parts)).encode("utf-8")
+        return self.pages[key]
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # The default backlog (5) drops connections when several workers crawl at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class MockBeikeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    # The size of the pieces of a body sent at --bandwidth-kb, a TLS record
+    PIECE_SIZE = 16 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="text/html; charset=utf-8", etag=None, counted=True):
+        """
+        :param counted: False for the responses not counted in the stats, e.g. the stats themselves
+        """
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not counted:
+            self.wfile.write(body)
+            return
+        self.config.count("body_bytes", len(body))
+        if self.config.bandwidth_kb <= 0:
+            self.wfile.write(body)
+            self.config.count("bytes", len(body))
+            return
+        # Each piece arrives once it would be transferred, only the bytes sent
+        # before the client closes the connection (a download stopped early) count
+        for pos in range(0, len(body), self.PIECE_SIZE):
+            piece = body[pos:pos + self.PIECE_SIZE]
+            time.sleep(len(piece) / (self.config.bandwidth_kb * 1024.0))
+            try:
+                self.wfile.write(piece)
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                self.config.count("stopped")
+                self.close_connection = True
+                return
+            self.config.count("bytes", len(piece))
+
+    def do_GET(self):
+        cfg = self.config
+        # Requests through a proxy carry the absolute URL
+        url = urlsplit(self.path)
+        host = url.hostname or self.headers.get("Host", "").split(":")[0]
+        if url.path == "/__stats__":
+            with cfg.lock:
+                body = json.dumps(cfg.stats).encode("utf-8")
+            self.send_body(200, body, "application/json", counted=False)
+            return
+
+        cfg.count("requests")
+        roll, jitter = cfg.draw()
+        delay = max(0.0, cfg.latency_ms + jitter * cfg.jitter_ms) / 1000.0
+        if delay > 0:
+            time.sleep(delay)
+
+        if roll < cfg.ban_rate:
+            cfg.count("banned")
+            self.send_body(418, BAN_PAGE)
+            return
+        if roll < cfg.ban_rate + cfg.error_rate:
+            cfg.count("errors")
+            self.send_body(500, b"<html><body>Internal Server Error</body></html>")
+            return
+
+        body = cfg.get_page(host, url.path)
+        if body is None:
+            cfg.count("not_found")
+            self.send_body(404, b"<html><body>Not Found</body></html>")
+            return
+        if cfg.etag:
+            etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                cfg.count("not_modified")
+                self.send_body(304, b"", etag=etag)
+                return
+            self.send_body(200, body, etag=etag)
+            return
+        self.send_body(200, body)
+
+
+def make_server(port=8018, config=None):
+    make_fixtures()
+    handler = type("Handler", (MockBeikeHandler,), {"config": config or MockBeikeConfig()})
+    return MockHTTPServer(("127.0.0.1", port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8018)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean latency of each response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="the latency varies by up to this much")
+    parser.add_argument("--ban-rate", type=float, default=0.0, help="fraction of responses which are 418 ban pages")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses which are 500 errors")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--etag", action="store_true", help="send ETags and answer If-None-Match with 304")
+    parser.add_argument("--bandwidth-kb", type=float, default=0.0,
+                        help="KB/s of each response, the bodies are sent in pieces (default: 0, at once)")
+    args = parser.parse_args()
+
+    config = MockBeikeConfig(args.latency_ms, args.jitter_ms, args.ban_rate, args.error_rate, args.seed, args.etag,
+                             args.bandwidth_kb)
+    server = make_server(args.port, config)
+    print(f"[PYRAD] Mock Beike server listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
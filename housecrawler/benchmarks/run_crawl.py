@@ -0,0 +1,356 @@
+"""
+Run "scrapy crawl house_resale" against the local mock server and report
+the throughput numbers of the whole run.
+
+    python -m benchmarks.run_crawl --runs 3 --latency-ms 50 --ban-rate 0.05
+    python -m benchmarks.run_crawl --workers 4 -a granularity=district
+    python -m benchmarks.run_crawl --proxies 4 --proxy-rate-limit 5
+    python -m benchmarks.run_crawl --etag
+    python -m benchmarks.run_crawl --replay
+    python -m benchmarks.run_crawl --workers 4 -a granularity=district --check
+    python -m benchmarks.run_crawl --bandwidth-kb 2000 -s EARLY_ABORT_ENABLED=True --check
+
+Each run is a separate process (the Twisted reactor can't be restarted), the
+spider and all its output steps run in it, and it writes to a temporary data
+directory. Reported per run: wall time, requests/s, parse time per response
+and peak RSS of the crawl process. With --workers the run is a sharded crawl,
+a frontier is seeded and that many crawl processes share it, the numbers are
+of all the workers together. With --proxies the crawl goes through a pool of
+stand-in proxies (benchmarks/mock_proxy.py) in front of the mock server, each
+banned by the hosts above --proxy-rate-limit requests/s. With --etag the mock
+server sends ETags and the runs share a page cache, so the runs after the
+first revalidate the pages (304). With --replay a first crawl fills the page
+cache, and the runs measured are offline, served from it. With --check the
+benchmark exits with an error when a run is not as expected, e.g. a worker of
+a sharded crawl got much less than its share of the pages, an output file
+is not created with the mode given by the umask, (with -s PROFILE_ENABLED=1,
+every call is then profiled) an output stage has no profile of its own, or
+(with -s EARLY_ABORT_ENABLED=True) a page is requested from the mock server
+more than once or the downloads stopped early don't save bytes. With
+--bandwidth-kb the mock server sends the bodies in pieces at that rate, a body
+sent at once is received whole before it can be stopped.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def get_peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset // 1024
+        except (ImportError, AttributeError):
+            return -1
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def crawl_once(proxy_url, data_dir, extra_settings, spargs=()):
+    """
+    Run the spider in this process and return the numbers of the run
+    """
+    os.environ["HOUSECRAWLER_DATA_DIR"] = data_dir
+    os.chdir(PROJECT_DIR)
+
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    settings.set("BEIKE_MIRROR_PROXY", proxy_url)
+    settings.set("LOG_LEVEL", "WARNING")
+    for kv in extra_settings:
+        key, _, value = kv.partition("=")
+        settings.set(key, value)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler("house_resale")
+    process.crawl(crawler, **dict(kv.partition("=")[::2] for kv in spargs))
+    t_start = time.perf_counter()
+    epoch_start = time.time()
+    process.start()
+    wall = time.perf_counter() - t_start
+
+    stats = crawler.stats.get_stats()
+    nresp = stats.get("downloader/response_count", 0)
+    nparse = stats.get("housecrawler/parse_count", 0)
+    parse_time = stats.get("housecrawler/parse_time", 0.0)
+    return {
+        "wall_s": round(wall, 3),
+        "requests": stats.get("downloader/request_count", 0),
+        "responses": nresp,
+        "requests_per_s": round(nresp / wall, 2) if wall > 0 else 0.0,
+        "parse_ms_per_response": round(1000.0 * parse_time / nparse, 3) if nparse else 0.0,
+        "bytes": stats.get("downloader/response_bytes", 0),
+        "peak_rss_kb": get_peak_rss_kb(),
+        "t_start": epoch_start,
+        "t_end": epoch_start + wall,
+    }
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(args):
+    port = get_free_port()
+    cmd = [sys.executable, "-m", "benchmarks.mock_server", "--port", str(port),
+           "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+           "--ban-rate", str(args.ban_rate), "--error-rate", str(args.error_rate), "--seed", "0"]
+    if args.etag:
+        cmd.append("--etag")
+    if args.bandwidth_kb > 0:
+        cmd.extend(["--bandwidth-kb", str(args.bandwidth_kb)])
+    proc = subprocess.Popen(cmd, cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True)
+    # The server prints one line when it is ready
+    proc.stdout.readline()
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def start_mock_proxies(args, upstream):
+    cmd = [sys.executable, "-m", "benchmarks.mock_proxy", "--port", "0", "--count", str(args.proxies),
+           "--upstream", upstream, "--rate-limit", str(args.proxy_rate_limit), "--seed", "0"]
+    proc = subprocess.Popen(cmd, cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True)
+    # The proxies print one line with their URLs when they are ready
+    return proc, proc.stdout.readline().split()[-1]
+
+
+def child_command(proxy_url, data_dir, args, extra_settings=()):
+    cmd = [sys.executable, "-m", "benchmarks.run_crawl", "--child", proxy_url, data_dir]
+    for kv in list(args.settings) + list(extra_settings):
+        cmd.extend(["-s", kv])
+    for kv in args.spargs:
+        cmd.extend(["-a", kv])
+    return cmd
+
+
+def parse_child_output(out):
+    line = [l for l in out.splitlines() if l.startswith("BENCH_RESULT ")][-1]
+    return json.loads(line[len("BENCH_RESULT "):])
+
+
+def run_sharded(proxy_url, data_dir, args):
+    """
+    Seed a frontier in the data directory and crawl it with args.workers processes at once
+    :return: The numbers of all the workers together
+    """
+    env = dict(os.environ, HOUSECRAWLER_DATA_DIR=data_dir)
+    subprocess.run([sys.executable, "-m", "scrapy", "frontier", "seed"], cwd=PROJECT_DIR, env=env,
+                   stdout=subprocess.DEVNULL, check=True)
+    cmd = child_command(proxy_url, data_dir, args, ["FRONTIER=sqlite"])
+    procs = [subprocess.Popen(cmd, cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True) for _ in range(args.workers)]
+    outs = [proc.communicate()[0] for proc in procs]
+    workers = [parse_child_output(out) for out in outs]
+    # From the first worker starting to crawl to the last one done, as for one
+    # process, without starting the Python processes
+    wall = max(w["t_end"] for w in workers) - min(w["t_start"] for w in workers)
+
+    nresp = sum(w["responses"] for w in workers)
+    return {
+        "wall_s": round(wall, 3),
+        "requests": sum(w["requests"] for w in workers),
+        "responses": nresp,
+        "requests_per_s": round(nresp / wall, 2) if wall > 0 else 0.0,
+        "parse_ms_per_response": round(sum(w["parse_ms_per_response"] * w["responses"] for w in workers) / nresp, 3)
+        if nresp else 0.0,
+        "bytes": sum(w["bytes"] for w in workers),
+        "peak_rss_kb": max(w["peak_rss_kb"] for w in workers),
+        "responses_per_worker": [w["responses"] for w in workers],
+    }
+
+
+def check_file_modes(data_dir):
+    """
+    :return: The files written by a run whose mode is not the one a new file gets (0666 less the umask)
+    """
+    umask = os.umask(0o022)
+    os.umask(umask)
+    expected = 0o666 & ~umask
+    problems = []
+    for dirpath, _, fnames in os.walk(data_dir):
+        for fname in fnames:
+            path = os.path.join(dirpath, fname)
+            mode = os.stat(path).st_mode & 0o777
+            if mode != expected:
+                problems.append(f"{os.path.relpath(path, data_dir)} is created {oct(mode)}, not {oct(expected)}")
+    return problems
+
+
+def get_server_stats(server_url):
+    with urllib.request.urlopen(server_url + "/__stats__") as resp:
+        return json.loads(resp.read())
+
+
+def setting_enabled(settings, name):
+    settings = dict(kv.partition("=")[::2] for kv in settings)
+    return settings.get(name, "0").lower() in ("1", "true", "yes")
+
+
+def check_profiles(data_dir, settings):
+    """
+    :return: The stages of the spider and the output steps without a profile,
+             the output steps run inside "closed" and are profiled on their own too
+    """
+    values = dict(kv.partition("=")[::2] for kv in settings)
+    # A short stage may have no stack samples, only the cProfile profiles are checked
+    if not setting_enabled(settings, "PROFILE_ENABLED") or values.get("PROFILE_MODE", "cprofile") != "cprofile" \
+            or float(values.get("PROFILE_SAMPLE_RATE", "1")) < 1.0:
+        return []
+    profile_dir = values.get("PROFILE_DIR") or os.path.join(data_dir, "profiles")
+    written = set()
+    for dirpath, _, fnames in os.walk(profile_dir):
+        written.update(fname[:-len(".pstats")] for fname in fnames if fname.endswith(".pstats"))
+    stages = ["parse", "closed", "save_results", "history_append", "table_refresh"]
+    return [f"No profile of the stage {stage} in {profile_dir}" for stage in stages if stage not in written]
+
+
+def check_early_abort(result, server_stats, check_bytes=True):
+    """
+    :param server_stats: The counters of the mock server in this run
+    :param check_bytes: False if the bytes can't be saved, the stand-in proxies
+                        read the whole body before passing it on
+    :return: The problems of a run with EARLY_ABORT_ENABLED
+    """
+    problems = []
+    # A stopped download must not make the connection pool send a page again
+    if server_stats["requests"] != result["requests"]:
+        problems.append(f"{server_stats['requests']} GETs at the mock server for {result['requests']} requests")
+    # The bytes received include the headers, without stopping they are more than the bodies
+    if check_bytes and result["bytes"] >= server_stats["body_bytes"]:
+        problems.append(f"No bytes saved by stopping the downloads: {result['bytes']} bytes received, "
+                        f"the bodies are {server_stats['body_bytes']} bytes (see --bandwidth-kb)")
+    return problems
+
+
+def check_run(result, args, data_dir, server_stats):
+    """
+    :param server_stats: The counters of the mock server in this run
+    :return: The problems of a run, for --check
+    """
+    problems = check_file_modes(data_dir) + check_profiles(data_dir, args.settings)
+    if setting_enabled(args.settings, "EARLY_ABORT_ENABLED") and not args.replay:
+        problems.extend(check_early_abort(result, server_stats, check_bytes=args.proxies == 0))
+    per_worker = result.get("responses_per_worker")
+    if per_worker and result["responses"] > 0:
+        # Each worker should get a fair part of the pages, not the first one most of them
+        share = result["responses"] / len(per_worker)
+        if min(per_worker) < share / 2:
+            problems.append(f"The work is not split across the workers: {per_worker}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--ban-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("-s", "--set", dest="settings", action="append", default=[],
+                        help="extra scrapy setting NAME=VALUE for the crawl, may be repeated")
+    parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                        help="spider argument for the crawl, may be repeated")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="crawl processes sharing a frontier (default: 1, no frontier)")
+    parser.add_argument("--proxies", type=int, default=0,
+                        help="crawl through a pool of this many stand-in proxies (default: 0, no pool)")
+    parser.add_argument("--proxy-rate-limit", type=float, default=0.0,
+                        help="requests/s a host takes from one stand-in proxy before banning it (default: no limit)")
+    parser.add_argument("--bandwidth-kb", type=float, default=0.0,
+                        help="KB/s of each response of the mock server (default: 0, the bodies are sent at once)")
+    parser.add_argument("--etag", action="store_true",
+                        help="the mock server sends ETags, the runs revalidate the pages in a shared page cache")
+    parser.add_argument("--replay", action="store_true",
+                        help="fill the page cache with one crawl, then run offline from it")
+    parser.add_argument("--json", dest="json_file", default=None, help="also write the results to this file")
+    parser.add_argument("--check", action="store_true", help="exit with an error if a run is not as expected")
+    parser.add_argument("--child", nargs=2, metavar=("PROXY", "DATA_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = crawl_once(args.child[0], args.child[1], args.settings, args.spargs)
+        print("BENCH_RESULT " + json.dumps(result), flush=True)
+        return
+
+    if args.check and setting_enabled(args.settings, "PROFILE_ENABLED") \
+            and not any(kv.startswith("PROFILE_SAMPLE_RATE=") for kv in args.settings):
+        # The stages called once in a run are profiled in every run checked
+        args.settings.append("PROFILE_SAMPLE_RATE=1")
+    server, proxy_url = start_mock_server(args)
+    proxies = None
+    if args.proxies > 0:
+        proxies, pool = start_mock_proxies(args, proxy_url)
+        args.settings.append(f"PROXY_POOL={pool}")
+    cache_dir = None
+    if args.etag or args.replay:
+        cache_dir = tempfile.mkdtemp(prefix="page_cache")
+        args.settings.extend(["PAGE_CACHE_ENABLED=True", f"PAGE_CACHE_DIR={cache_dir}"])
+    results = []
+    problems = []
+    try:
+        if args.replay:
+            with tempfile.TemporaryDirectory() as data_dir:
+                subprocess.run(child_command(proxy_url, data_dir, args), cwd=PROJECT_DIR, stdout=subprocess.DEVNULL,
+                               check=True)
+            args.settings.append("PAGE_CACHE_MODE=replay")
+        for i in range(args.runs):
+            before = get_server_stats(proxy_url)
+            with tempfile.TemporaryDirectory() as data_dir:
+                if args.workers > 1:
+                    result = run_sharded(proxy_url, data_dir, args)
+                else:
+                    cmd = child_command(proxy_url, data_dir, args)
+                    out = subprocess.run(cmd, cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True, check=True).stdout
+                    result = parse_child_output(out)
+                if args.check:
+                    after = get_server_stats(proxy_url)
+                    run_stats = {key: after[key] - before[key] for key in after}
+                    problems.extend(check_run(result, args, data_dir, run_stats))
+            for key in ("t_start", "t_end"):
+                result.pop(key, None)
+            results.append(result)
+            print(f"[PYRAD] Run {i + 1}: {result}")
+        server_stats = get_server_stats(proxy_url)
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        if proxies is not None:
+            proxies.terminate()
+            proxies.wait()
+        server.terminate()
+        server.wait()
+
+    keys = ["wall_s", "requests_per_s", "parse_ms_per_response", "peak_rss_kb"]
+    print("==== Benchmark summary (median of runs) ====")
+    for key in keys:
+        values = sorted(r[key] for r in results)
+        print(f"{key:>24} = {values[len(values) // 2]}")
+    print(f"{'mock server':>24} = {server_stats}")
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as fp:
+            json.dump({"runs": results, "server": server_stats, "args": vars(args)}, fp, indent=2)
+    if problems:
+        for problem in problems:
+            print(f"[PYRAD] CHECK FAILED: {problem}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+
+# Rules of pandas.DataFrame.resample for the frequencies of the analytics,
+# the weeks start on Sunday as in the history ("%U")
+RESAMPLE_RULES = {"D": "D", "W": "W-SAT", "M": "MS"}
+
+
+class HistoryAnalytics:
+    """
+    Analytics of the resale history in the SQLite history store: deltas,
+    percent changes, rolling means and rankings of the cities, per day,
+    week ("W") or month ("M").
+    The history is loaded once into a DataFrame (one float64 column per city,
+    NaN where a run has no number) and every result is computed on whole
+    columns. Results are cached until the history changes, which is found by
+    the size and modification time of the database files, so the summary of
+    each run and the dashboards don't read the history again.
+    pandas is imported only when the analytics are used.
+    """
+    def __init__(self, history_fname, city_list):
+        self.history_fname = history_fname
+        self.city_list = list(city_list)
+        self.version = None
+        self.results = dict()
+
+    def get_version(self):
+        """
+        :return: A key which changes when the history is written, the WAL file included
+        """
+        version = []
+        for fname in (self.history_fname, self.history_fname + "-wal"):
+            try:
+                st = os.stat(fname)
+                version.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def cached(self, key, compute):
+        version = self.get_version()
+        if version != self.version:
+            self.version = version
+            self.results = dict()
+        if key not in self.results:
+            self.results[key] = compute()
+        return self.results[key]
+
+    def load_frame(self):
+        import pandas as pd
+
+        conn = sqlite3.connect(self.history_fname)
+        try:
+            df = pd.read_sql_query("SELECT ts, city, total FROM samples ORDER BY ts", conn)
+        finally:
+            conn.close()
+
+        frame = df.pivot(index="ts", columns="city", values="total")
+        frame.index = pd.to_datetime(frame.index, format="%Y-%m-%d %H:%M:%S")
+        frame = frame.reindex(columns=[city for city in self.city_list if city in frame.columns])
+        # -1 is saved for a city without a number in a run
+        return frame.astype("float64").where(frame >= 0)
+
+    def frame(self):
+        """
+        :return: The numbers of each run, indexed by the time of the run, one column per city
+        """
+        return self.cached("frame", self.load_frame)
+
+    def sampled(self, freq="D"):
+        """
+        :return: The last number of each city in each day, week or month
+        """
+        return self.cached(("sampled", freq), lambda: self.frame().resample(RESAMPLE_RULES[freq]).last())
+
+    def deltas(self, freq="D"):
+        return self.cached(("deltas", freq), lambda: self.sampled(freq).diff())
+
+    def pct_change(self, freq="D"):
+        return self.cached(("pct_change", freq), lambda: 100.0 * self.sampled(freq).pct_change(fill_method=None))
+
+    def rolling_mean(self, window=7, freq="D"):
+        return self.cached(("rolling_mean", window, freq),
+                           lambda: self.sampled(freq).rolling(window, min_periods=1).mean())
+
+    def rankings(self, freq="D"):
+        """
+        :return: The rank of each city by its number, 1 is the most listings
+        """
+        return self.cached(("rankings", freq),
+                           lambda: self.sampled(freq).rank(axis=1, ascending=False, method="min"))
+
+    def rollups(self, period="week", stat="last"):
+        """
+        Read the precomputed rollups of the history store instead of the samples
+        :param period: "week", "month" or "year"
+        :param stat: "last", "min", "max", "mean" or "count"
+        :return: A DataFrame indexed by the period key (e.g. "2024-W09"), one column per city
+        """
+        def compute():
+            import pandas as pd
+
+            conn = sqlite3.connect(self.history_fname)
+            try:
+                df = pd.read_sql_query(
+                    "SELECT period_key, city, last, min, max, 1.0 * sum / count AS mean, count"
+                    " FROM rollups WHERE period = ?", conn, params=(period,))
+            finally:
+                conn.close()
+            frame = df.pivot(index="period_key", columns="city", values=stat).sort_index()
+            return frame.reindex(columns=[city for city in self.city_list if city in frame.columns])
+        return self.cached(("rollups", period, stat), compute)
+
+    def latest_summary(self):
+        """
+        :return: A DataFrame indexed by city with the latest number, its change
+                 since the day before and the week before (also in percent),
+                 its 4-week rolling mean and its rank
+        """
+        def compute():
+            import pandas as pd
+
+            if self.frame().empty:
+                return pd.DataFrame()
+            weekly = self.sampled("W")
+            return pd.DataFrame({
+                "total": self.sampled("D").iloc[-1],
+                "day_delta": self.deltas("D").iloc[-1],
+                "week_delta": self.deltas("W").iloc[-1],
+                "week_pct": self.pct_change("W").iloc[-1],
+                "mean_4w": weekly.rolling(4, min_periods=1).mean().iloc[-1],
+                "rank": self.rankings("D").iloc[-1],
+            })
+        return self.cached("latest_summary", compute)
+
+
+# The analytics of each history store, kept for the whole process (e.g. the daemon mode)
+_analytics = dict()
+
+
+def get_history_analytics(history_fname, city_list):
+    key = (history_fname, tuple(city_list))
+    if key not in _analytics:
+        _analytics[key] = HistoryAnalytics(history_fname, city_list)
+    return _analytics[key]
@@ -0,0 +1,204 @@
+import hashlib
+import os
+import sqlite3
+import zlib
+
+from .output_commit import FileLock
+
+
+def import_zstandard():
+    """
+    :return: The module "zstandard", or None if it is not installed. It is
+             imported on first use, not when the spider is loaded
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+class PageArchive:
+    """
+    Keep the raw HTML of every fetched page, for audits and reparsing.
+    The archive is content addressed: a body is stored once, compressed, in
+    the packed segment files (segment-NNNNN.pack), and an SQLite index maps
+    each fetch (timestamp, city, url) to the hash of its body. A page which
+    has not changed since the last poll costs only one index entry.
+    Bodies are compressed by zstd if the "zstandard" package is installed,
+    otherwise by zlib, the codec of each body is kept in the index.
+    Several processes can write to the same archive, a body is appended to
+    a segment under the lock of the archive (SEGMENT_LOCK_FNAME).
+    """
+    INDEX_FNAME = "index.sqlite3"
+    SEGMENT_LOCK_FNAME = "segments"
+    # Seconds to wait for another process writing to the index
+    BUSY_TIMEOUT = 60.0
+
+    def __init__(self, archive_dir, segment_max_bytes=64 * 1024 * 1024, level=None):
+        self.archive_dir = archive_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.codec = "zstd" if import_zstandard() is not None else "zlib"
+        self.level = level
+        self.conn = None
+        self.segment_fp = None
+        self.segment_no = -1
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(self.archive_dir, self.INDEX_FNAME),
+                                        timeout=self.BUSY_TIMEOUT)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.create_tables()
+        return self.conn
+
+    def create_tables(self):
+        with self.conn:
+            # Where each unique body is stored
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " hash TEXT PRIMARY KEY,"
+                " segment INTEGER NOT NULL,"
+                " offset INTEGER NOT NULL,"
+                " length INTEGER NOT NULL,"
+                " raw_length INTEGER NOT NULL,"
+                " codec TEXT NOT NULL)")
+            # Each fetch, "partial" is 1 if the download was stopped early (EARLY_ABORT_ENABLED)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                " ts TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " url TEXT NOT NULL,"
+                " level TEXT NOT NULL DEFAULT 'city',"
+                " status INTEGER NOT NULL,"
+                " partial INTEGER NOT NULL DEFAULT 0,"
+                " hash TEXT NOT NULL,"
+                " PRIMARY KEY (ts, city, url))")
+
+    @staticmethod
+    def hash_body(body):
+        return hashlib.sha256(body).hexdigest()
+
+    def segment_fname(self, segment_no):
+        return os.path.join(self.archive_dir, f"segment-{segment_no:05d}.pack")
+
+    def compress(self, body):
+        if self.codec == "zstd":
+            level = 3 if self.level is None else self.level
+            return import_zstandard().ZstdCompressor(level=level).compress(body)
+        return zlib.compress(body, 6 if self.level is None else self.level)
+
+    @staticmethod
+    def decompress(data, codec):
+        if codec == "zstd":
+            zstandard = import_zstandard()
+            if zstandard is None:
+                raise RuntimeError("The archive has zstd compressed pages, install the package \"zstandard\"")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def open_segment(self):
+        """
+        :return: The segment file to append to, a new segment is started when
+                 the last one reaches segment_max_bytes
+        """
+        if self.segment_fp is None:
+            row = self.connect().execute("SELECT MAX(segment) FROM blobs").fetchone()
+            self.segment_no = row[0] if row[0] is not None else 0
+            self.segment_fp = open(self.segment_fname(self.segment_no), "ab")
+        if self.segment_fp.seek(0, os.SEEK_END) >= self.segment_max_bytes:
+            self.segment_fp.close()
+            self.segment_no += 1
+            self.segment_fp = open(self.segment_fname(self.segment_no), "ab")
+        return self.segment_fp
+
+    def put_body(self, body):
+        """
+        Store a body if it is not in the archive yet
+        :return: The hash of the body
+        """
+        conn = self.connect()
+        digest = self.hash_body(body)
+        if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone() is not None:
+            return digest
+
+        data = self.compress(body)
+        with FileLock(os.path.join(self.archive_dir, self.SEGMENT_LOCK_FNAME)):
+            # The end of the segment, another process may have appended to it since the last write
+            fp = self.open_segment()
+            offset = fp.tell()
+            fp.write(data)
+            # The body must be in the segment before the index points to it
+            fp.flush()
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                             (digest, self.segment_no, offset, len(data), len(body), self.codec))
+        return digest
+
+    def put(self, ts, city, url, body, level="city", status=200, partial=False):
+        """
+        Archive a fetched page
+        :return: The hash of the body
+        """
+        digest = self.put_body(body)
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (ts, city, url, level, status, int(partial), digest))
+        return digest
+
+    def get(self, digest):
+        """
+        :return: The body of a hash, or None if it is not in the archive
+        """
+        row = self.connect().execute("SELECT segment, offset, length, codec FROM blobs WHERE hash = ?",
+                                     (digest,)).fetchone()
+        if row is None:
+            return None
+        segment_no, offset, length, codec = row
+        if self.segment_fp is not None and segment_no == self.segment_no:
+            self.segment_fp.flush()
+        with open(self.segment_fname(segment_no), "rb") as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+        return self.decompress(data, codec)
+
+    def iter_pages(self, since=None, until=None, city=None, level=None):
+        """
+        Iterate over the archived fetches in the order of time
+        :param since: Only the fetches at or after this timestamp ("%Y-%m-%d %H:%M:%S")
+        :param until: Only the fetches before this timestamp
+        :return: A generator of (ts, city, url, level, status, partial, hash)
+        """
+        sql = "SELECT ts, city, url, level, status, partial, hash FROM pages"
+        conds = []
+        params = []
+        for cond, value in (("ts >= ?", since), ("ts < ?", until), ("city = ?", city), ("level = ?", level)):
+            if value is not None:
+                conds.append(cond)
+                params.append(value)
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " ORDER BY ts, city, url"
+        # A separate cursor, so get() can be called while iterating
+        yield from self.connect().cursor().execute(sql, params)
+
+    def get_stats(self):
+        """
+        :return: (number of fetches, number of unique bodies, raw bytes, stored bytes)
+        """
+        conn = self.connect()
+        npage = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        nblob, raw_bytes, stored_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(raw_length), 0), COALESCE(SUM(length), 0) FROM blobs").fetchone()
+        return npage, nblob, raw_bytes, stored_bytes
+
+    def close(self):
+        if self.segment_fp is not None:
+            self.segment_fp.close()
+            self.segment_fp = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,113 @@
+import json
+import os
+from urllib.parse import urlsplit
+
+DEFAULT_REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cities.json")
+DEFAULT_URL_TEMPLATE = "https://{code}.ke.com/ershoufang/"
+
+
+class CityInfo:
+    """
+    A city to crawl, its English name is the key used everywhere else
+    """
+    def __init__(self, en, cn, code, url, unknown=False, urls=None):
+        self.en = en
+        self.cn = cn
+        self.code = code
+        # The city page of the resale market, and of each market (see markets.py)
+        self.url = url
+        self.urls = dict(urls) if urls else {"resale": url}
+        # The numbers of some cities are not reliable, they are reported
+        # separately (the last rows of the weekly tables)
+        self.unknown = unknown
+
+    def get_url(self, market="resale"):
+        """
+        :return: The city page of a market, None if the city has none
+        """
+        return self.urls.get(market)
+
+
+class CityRegistry:
+    """
+    All cities to crawl, loaded from a config file (see cities.json), with
+    hash maps keyed by URL, English name and Chinese name, so the spider,
+    the spreadsheet writer and the table refresher look cities up in O(1).
+      - cities: in the crawl order, which is also the column order of the spreadsheet
+      - report_order: the row order of the weekly tables and the summary
+    """
+    _loaded = dict()
+
+    def __init__(self, cities, report_order=None):
+        self.cities = list(cities)
+        self.by_en = {c.en: c for c in self.cities}
+        self.by_cn = {c.cn: c for c in self.cities}
+        self.by_url = {self.url_key(url): c for c in self.cities for url in c.urls.values()}
+        if report_order is None:
+            report_order = [c.en for c in self.cities]
+        self.report_order = [self.by_en[en] for en in report_order if en in self.by_en]
+        # Cities not given in the report order are reported at the end
+        reported = {c.en for c in self.report_order}
+        self.report_order.extend(c for c in self.cities if c.en not in reported)
+
+    def __len__(self):
+        return len(self.cities)
+
+    @staticmethod
+    def url_key(url):
+        """
+        The key of a URL for lookups, without the scheme (the mirror proxy uses
+        http://) and with a trailing slash
+        """
+        parts = urlsplit(url)
+        path = parts.path if parts.path.endswith("/") else parts.path + "/"
+        return parts.netloc.lower() + path
+
+    @classmethod
+    def load(cls, fname=None):
+        """
+        Load the registry from a JSON config file, each file is loaded only once
+        :param fname: The config file, default is cities.json of this package
+        """
+        if fname is None:
+            fname = DEFAULT_REGISTRY_FILE
+        if fname not in cls._loaded:
+            with open(fname, "r", encoding="utf-8") as fp:
+                conf = json.load(fp)
+            # The URL templates of each market, "url_template" is the one of
+            # the resale market in the configs from before the other markets
+            url_templates = dict(conf.get("url_templates", {}))
+            url_templates.setdefault("resale", conf.get("url_template", DEFAULT_URL_TEMPLATE))
+            cities = []
+            for c in conf["cities"]:
+                urls = {market: tmpl.format(code=c["code"]) for market, tmpl in url_templates.items()}
+                urls.update(c.get("urls", {}))
+                if c.get("url"):
+                    urls["resale"] = c["url"]
+                cities.append(CityInfo(c["en"], c["cn"], c["code"], urls["resale"], c.get("unknown", False), urls))
+            cls._loaded[fname] = cls(cities, conf.get("report_order"))
+        return cls._loaded[fname]
+
+    def get_by_url(self, url):
+        """
+        :return: The city of the city page of any market, or None
+        """
+        return self.by_url.get(self.url_key(url))
+
+    def get_en_name(self, cn_name):
+        city = self.by_cn.get(cn_name)
+        return city.en if city is not None else ""
+
+    def get_cn_name(self, en_name):
+        city = self.by_en.get(en_name)
+        return city.cn if city is not None else ""
+
+    def get_en_names(self):
+        return [c.en for c in self.cities]
+
+    def get_report_cities(self, unknown=None):
+        """
+        :param unknown: If it is given, only the cities whose numbers are (not) unknown
+        :return: The cities in the report order
+        """
+        return [c for c in self.report_order if unknown is None or c.unknown == unknown]
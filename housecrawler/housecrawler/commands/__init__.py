@@ -0,0 +1,2 @@
+# This package contains the custom scrapy commands of this project,
+# it is registered by the COMMANDS_MODULE setting.
@@ -0,0 +1,48 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+
+class Command(ScrapyCommand):
+    """
+    Keep one crawler alive and crawl every --interval seconds, e.g.
+
+        scrapy daemon --interval 1800 -a granularity=district
+
+    The spider stays open between the runs, so the reactor, the connection
+    pool, the DNS cache and the imported modules are all reused, and the
+    output steps of each run are done in a background thread.
+    """
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Crawl the resale numbers periodically in one process"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--interval", dest="interval", type=float, default=3600.0,
+                            help="seconds between the runs (default: 3600)")
+        parser.add_argument("--spider", dest="spider", default="house_resale",
+                            help="the spider to run (default: house_resale)")
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                            help="set spider argument (may be repeated)")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        if opts.interval <= 0:
+            raise UsageError("--interval must be positive", print_help=False)
+
+        opts.spargs["interval"] = opts.interval
+        self.crawler_process.crawl(opts.spider, **opts.spargs)
+        self.crawler_process.start()
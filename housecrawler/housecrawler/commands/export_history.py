@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from housecrawler.spiders.house_spider import HouseSpider
+
+
+class Command(ScrapyCommand):
+    """
+    Generate the yearly xlsx file from the SQLite history store, e.g.
+
+        scrapy export_history --year 2024
+        scrapy export_history --year 2024 --market rental
+    """
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Export the history of a market to a xlsx file"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--year", dest="year", type=int, default=None,
+                            help="year to export (default: this year)")
+        parser.add_argument("-o", "--output", dest="output", default=None,
+                            help="xlsx file to write (default: the yearly spreadsheet in the data directory)")
+        parser.add_argument("--market", dest="market", default="resale",
+                            help="market of the history, \"resale\", \"newhome\" or \"rental\" (default: resale)")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        year = opts.year if opts.year is not None else datetime.now().year
+        try:
+            spider = HouseSpider(markets=opts.market)
+        except ValueError as err:
+            raise UsageError(str(err))
+        ssdk = spider.ssdk
+        if self.settings.get("DATA_DIR"):
+            ssdk.data_dir = self.settings.get("DATA_DIR")
+        spfname = opts.output
+        if spfname is None:
+            spfname = ssdk.data_dir + "/" + spider.city_info_list.provideSpreadSheetFileName(year)
+
+        nrow = ssdk.export_history_to_spreadsheet(year, spfname)
+        print(f"[PYRAD] Exported {nrow} rows of year {year} to {spfname}")
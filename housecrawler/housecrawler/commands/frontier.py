@@ -0,0 +1,73 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from housecrawler.spiders.house_spider import HouseSpider
+
+
+class Command(ScrapyCommand):
+    """
+    Manage the runs of a sharded crawl (setting FRONTIER), e.g.
+
+        scrapy frontier seed                  (or seed --markets resale,rental)
+        scrapy crawl house_resale -s FRONTIER=sqlite    (in as many processes as wanted)
+        scrapy frontier status
+        scrapy frontier reduce --force
+
+      - seed:   start a run with the city pages, the workers take the latest run
+      - status: print the number of pages of the run in each state
+      - reduce: do the output steps of the run with the city totals of all
+                the workers, the last worker to finish does it by itself
+    """
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+    ACTIONS = ["seed", "status", "reduce"]
+
+    def syntax(self):
+        return "seed|status|reduce [options]"
+
+    def short_desc(self):
+        return "Seed, watch and reduce the runs of a sharded crawl"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--frontier", dest="frontier", default=None,
+                            help="the frontier, \"sqlite\", a SQLite file or a redis:// URL "
+                                 "(default: the setting FRONTIER, or \"sqlite\")")
+        parser.add_argument("--run", dest="run", default=None,
+                            help="time of the run, e.g. \"2024-03-01 09:00:00\" "
+                                 "(default: a new run for seed, the latest run otherwise)")
+        parser.add_argument("--force", dest="force", action="store_true",
+                            help="reduce a run even if it is not finished or already reduced")
+        parser.add_argument("--markets", dest="markets", default=None,
+                            help="markets to seed, e.g. \"resale,newhome,rental\" (default: resale)")
+
+    def run(self, args, opts):
+        if len(args) != 1 or args[0] not in self.ACTIONS:
+            raise UsageError()
+        action = args[0]
+
+        try:
+            spider = HouseSpider(run=opts.run or ("new" if action == "seed" else "last"),
+                                 worker=f"frontier-{action}", markets=opts.markets)
+        except ValueError as err:
+            raise UsageError(str(err))
+        if self.settings.get("DATA_DIR"):
+            spider.ssdk.data_dir = self.settings.get("DATA_DIR")
+        spec = opts.frontier or self.settings.get("FRONTIER") or "sqlite"
+        try:
+            spider.use_frontier(spec, self.settings)
+        except ValueError as err:
+            print(f"[PYRAD] {err}")
+            return
+
+        frontier = spider.frontier
+        try:
+            if action == "seed":
+                nadded = frontier.seed(spider.make_city_tasks())
+                print(f"[PYRAD] Seeded the run {frontier.run_ts} with {nadded} city pages")
+            elif action == "status":
+                print(f"[PYRAD] Run {frontier.run_ts}: {frontier.get_progress()}")
+            elif not spider.finish_shard(force=opts.force):
+                print(f"[PYRAD] Nothing done, use --force to reduce the run {frontier.run_ts} anyway")
+        finally:
+            frontier.close()
@@ -0,0 +1,90 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from housecrawler.history_store import SQLiteHistoryStore
+from housecrawler.spiders.house_spider import HouseSpider
+from housecrawler.spiders.table_refresh import ResaleTableRebuild
+
+
+def iter_runs(store, year):
+    """
+    :return: A generator of (run time, {English name: number}) of the stored runs of a year,
+             the cities without a number in a run are left out
+    """
+    for row_val in store.iter_rows(year):
+        run_time = datetime.strptime(f"{row_val[0]} {row_val[1]}", "%Y-%m-%d %H:%M:%S")
+        nums = {city: num for city, num in zip(store.city_list, row_val[4:]) if num >= 0}
+        yield run_time, nums
+
+
+class Command(ScrapyCommand):
+    """
+    Regenerate the weekly tables (resalenumbers{year}.md) from the SQLite
+    history store, e.g. after "scrapy reparse" or a change of the cities,
+
+        scrapy rebuild_tables --year 2024
+        scrapy rebuild_tables --all -j 4
+        scrapy rebuild_tables --all --market newhome
+
+    The file is the same as the one the runs would have left by updating the
+    table of each week, and it is written once, replacing the file.
+    """
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Regenerate the weekly tables of a market from the history"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--year", dest="years", type=int, action="append", default=None,
+                            help="year to rebuild, can be given more than once (default: this year)")
+        parser.add_argument("--all", dest="all_years", action="store_true",
+                            help="rebuild every year in the history")
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                            help="number of processes rendering the weeks (default: 1)")
+        parser.add_argument("-o", "--output-dir", dest="output_dir", default=None,
+                            help="directory to write the tables to (default: the data directory)")
+        parser.add_argument("--market", dest="market", default="resale",
+                            help="market of the history, \"resale\", \"newhome\" or \"rental\" (default: resale)")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        if opts.jobs < 1:
+            raise UsageError("--jobs should be at least 1")
+        if opts.all_years and opts.years:
+            raise UsageError("--year and --all can't be given together")
+
+        try:
+            spider = HouseSpider(markets=opts.market)
+        except ValueError as err:
+            raise UsageError(str(err))
+        if self.settings.get("DATA_DIR"):
+            spider.ssdk.data_dir = self.settings.get("DATA_DIR")
+        out_dir = opts.output_dir or spider.ssdk.data_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+        store = SQLiteHistoryStore(spider.ssdk.history_fname, spider.city_name_list)
+        executor = ProcessPoolExecutor(max_workers=opts.jobs) if opts.jobs > 1 else None
+        try:
+            if opts.all_years:
+                years = store.get_years()
+            else:
+                years = opts.years or [datetime.now().year]
+            for year in years:
+                fname = os.path.join(out_dir, spider.city_info_list.provideMarkdownFileName(year))
+                rtb = ResaleTableRebuild(fname, year, spider.registry, opts.market)
+                nweek = rtb.rebuild(iter_runs(store, year), executor)
+                print(f"[PYRAD] Rebuilt {nweek} weekly tables of year {year} in {fname}")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            store.close()
@@ -0,0 +1,152 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse
+
+from housecrawler.archive import PageArchive
+from housecrawler.extract import extract_total_num, extract_total_num_by_xpath
+from housecrawler.history_store import SQLiteHistoryStore
+from housecrawler.markets import get_market, get_market_by_url
+from housecrawler.spiders.house_spider import HouseSpider
+
+
+def reparse_chunk(archive_dir, chunk, xpath_only=False, market=None):
+    """
+    Extract the total numbers of a batch of archived pages, run in a worker process
+    :param chunk: A list of (hash, url), each body is read from the archive by its hash
+    :param market: The name of the market of the pages (see markets.py)
+    :return: A list of (hash, total_num), total_num is None if it is not found
+    """
+    pattern = get_market(market).total_num_pattern
+    archive = PageArchive(archive_dir)
+    results = []
+    try:
+        for digest, url in chunk:
+            body = archive.get(digest)
+            if body is None:
+                results.append((digest, None))
+                continue
+            response = HtmlResponse(url, body=body, encoding="utf-8")
+            if xpath_only:
+                found = extract_total_num_by_xpath(response, pattern)
+            else:
+                found = extract_total_num(response, pattern)
+            results.append((digest, found[0] if found is not None else None))
+    finally:
+        archive.close()
+    return results
+
+
+class Command(ScrapyCommand):
+    """
+    Recompute the city numbers of the history from the archived pages, e.g.
+    after fixing the extraction for a new layout of the Beike pages,
+
+        scrapy reparse --since 2024-03-01 --dry-run
+        scrapy reparse --since 2024-03-01
+        scrapy reparse --since 2024-03-01 --market rental
+
+    No page is fetched. Each unique body is parsed once, in a pool of
+    processes, and the numbers which differ are written back to the table
+    samples of the SQLite history store.
+    """
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Recompute the history of a market from the archived pages"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--since", dest="since", default=None,
+                            help="only the runs at or after this time, e.g. 2024-03-01")
+        parser.add_argument("--until", dest="until", default=None,
+                            help="only the runs before this time")
+        parser.add_argument("--city", dest="city", default=None,
+                            help="only this city, e.g. Beijing")
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(),
+                            help="number of worker processes (default: the number of CPUs)")
+        parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=64,
+                            help="pages parsed by a worker at a time (default: 64)")
+        parser.add_argument("--xpath", dest="xpath_only", action="store_true",
+                            help="skip the fast path, extract the numbers by XPath only")
+        parser.add_argument("--dry-run", dest="dry_run", action="store_true",
+                            help="print the numbers which would change, don't write them")
+        parser.add_argument("--market", dest="market", default="resale",
+                            help="market of the history, \"resale\", \"newhome\" or \"rental\" (default: resale)")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        if opts.chunk_size < 1 or opts.jobs < 1:
+            raise UsageError("--jobs and --chunk-size should be at least 1")
+
+        try:
+            spider = HouseSpider(markets=opts.market)
+        except ValueError as err:
+            raise UsageError(str(err))
+        if self.settings.get("DATA_DIR"):
+            spider.ssdk.data_dir = self.settings.get("DATA_DIR")
+        archive_dir = self.settings.get("ARCHIVE_DIR") or os.path.join(spider.ssdk.data_dir, "archive")
+        if not os.path.isfile(os.path.join(archive_dir, PageArchive.INDEX_FNAME)):
+            print(f"[PYRAD] No archive found in {archive_dir}")
+            return
+
+        archive = PageArchive(archive_dir)
+        try:
+            # Only the city pages have the numbers of the history, the pages of
+            # the markets are told apart by their paths
+            pages = [(ts, city, url, digest)
+                     for ts, city, url, level, status, partial, digest
+                     in archive.iter_pages(opts.since, opts.until, opts.city, level="city")
+                     if status == 200 and get_market_by_url(url).name == opts.market]
+        finally:
+            archive.close()
+
+        # Unchanged pages share a body, so parse each body only once
+        unique = dict()
+        for _, _, url, digest in pages:
+            unique.setdefault(digest, url)
+        items = list(unique.items())
+        chunks = [items[i:i + opts.chunk_size] for i in range(0, len(items), opts.chunk_size)]
+        print(f"[PYRAD] Reparse {len(pages)} archived pages ({len(items)} unique) "
+              f"in {len(chunks)} batches with {opts.jobs} processes")
+
+        totals = dict()
+        with ProcessPoolExecutor(max_workers=opts.jobs) as executor:
+            futures = [executor.submit(reparse_chunk, archive_dir, chunk, opts.xpath_only, opts.market) for chunk in chunks]
+            for future in as_completed(futures):
+                totals.update(future.result())
+
+        store = SQLiteHistoryStore(spider.ssdk.history_fname, spider.city_name_list)
+        try:
+            stored = store.get_totals(opts.since, opts.until)
+            changed = dict()
+            nfail = 0
+            for ts, city, url, digest in pages:
+                total = totals.get(digest)
+                if total is None:
+                    nfail += 1
+                    continue
+                if stored.get((ts, city)) != total:
+                    changed[(ts, city)] = total
+
+            for (ts, city), total in sorted(changed.items()):
+                print(f"[PYRAD] {ts} {city}: {stored.get((ts, city), '-')} -> {total}")
+            if nfail > 0:
+                print(f"[PYRAD] WARNING: No number found in {nfail} pages, their numbers are kept")
+
+            if opts.dry_run:
+                print(f"[PYRAD] {len(changed)} numbers would change (dry run)")
+            elif len(changed) > 0:
+                store.replace_totals((ts, city, total) for (ts, city), total in changed.items())
+                print(f"[PYRAD] Updated {len(changed)} numbers in {spider.ssdk.history_fname}")
+            else:
+                print(f"[PYRAD] All numbers are up to date")
+        finally:
+            store.close()
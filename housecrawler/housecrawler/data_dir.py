@@ -0,0 +1,91 @@
+import json
+import os
+import platform
+import subprocess
+
+DEFAULT_MACHINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "machines.json")
+
+# The CPU name and the data directories resolved in this process
+_cpu_name = None
+_data_dirs = dict()
+
+
+def read_cpu_name():
+    """
+    Check current machine's CPU name, without starting a process where the
+    OS has it in a file or the registry
+    :return: A string representing current machine's CPU name.
+             If not found, return an empty string
+    """
+    system = platform.system()
+    if system == "Linux":
+        try:
+            with open("/proc/cpuinfo", "r", encoding="utf-8", errors="replace") as fp:
+                for line in fp:
+                    if line.startswith("model name"):
+                        return line.split(":", 1)[1].strip()
+        except OSError:
+            pass
+        return ""
+    elif system == "Windows":
+        try:
+            import winreg
+
+            key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"HARDWARE\DESCRIPTION\System\CentralProcessor\0")
+            with key:
+                return winreg.QueryValueEx(key, "ProcessorNameString")[0].strip()
+        except OSError:
+            # For win32com, refer to the link below
+            # https://learn.microsoft.com/zh-cn/windows/win32/cimwin32prov/win32-processor
+            from win32com.client import GetObject
+            root_winmgmts = GetObject("winmgmts:root\\cimv2")
+            cpus = root_winmgmts.ExecQuery("Select * from Win32_Processor")
+            return cpus[0].Name.strip()
+    elif system == "Darwin":
+        try:
+            return subprocess.check_output(["/usr/sbin/sysctl", "-n", "machdep.cpu.brand_string"]).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+    return platform.processor()
+
+
+def get_cpu_name():
+    """
+    :return: The CPU name of this machine, it is probed only once per process
+    """
+    global _cpu_name
+    if _cpu_name is None:
+        _cpu_name = read_cpu_name()
+    return _cpu_name
+
+
+def load_machines(fname=None):
+    """
+    :return: A dict of the data directory of each machine, keyed by CPU name
+    """
+    with open(fname or DEFAULT_MACHINES_FILE, "r", encoding="utf-8") as fp:
+        conf = json.load(fp)
+    return {m["cpu_name"]: m["data_dir"] for m in conf["machines"]}
+
+
+def resolve_data_dir(machines_file=None):
+    """
+    Find the directory to keep the data of this machine in,
+      1. the environment variable HOUSECRAWLER_DATA_DIR, if it is set
+      2. the directory of this machine's CPU name in the machines file
+         (machines.json of this package by default)
+    The result of 2 is cached, so the CPU is probed only once per process
+    :return: A tuple (data_dir, cpu_name), data_dir is None if the machine is unknown
+    """
+    # The data directory can be given explicitly, e.g. by the benchmarks
+    data_dir = os.environ.get("HOUSECRAWLER_DATA_DIR")
+    if data_dir:
+        return data_dir, "n/a"
+
+    if machines_file not in _data_dirs:
+        cpu_name = get_cpu_name()
+        data_dir = load_machines(machines_file).get(cpu_name)
+        if data_dir is None:
+            print(f"Can't identify the CPU name ({cpu_name}) for this PC, please verify.")
+        _data_dirs[machines_file] = (data_dir, cpu_name)
+    return _data_dirs[machines_file]
@@ -0,0 +1,219 @@
+import json
+import os
+import time
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from .metrics import run_saved
+from .middlewares import is_ban_response
+from .output_commit import atomic_output
+from .profiling import Profiler, set_profiler
+
+
+def make_metrics_resource(extension):
+    """
+    The metrics endpoint,
+      - /metrics       all metrics of the process, in the Prometheus text format
+      - /metrics.json  the same as JSON, with the summary of the last run saved
+    twisted.web is imported only when the endpoint is started
+    """
+    from twisted.web import resource
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            return render_metrics(extension, request)
+
+    return MetricsResource()
+
+
+def render_metrics(extension, request):
+    path = request.path.decode("utf-8", errors="replace")
+    metrics = extension.get_metrics()
+    if metrics is None:
+        request.setResponseCode(503)
+        return b"Spider not opened\n"
+    if path == "/metrics":
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return metrics.total.to_prometheus().encode("utf-8")
+    if path == "/metrics.json":
+        request.setHeader(b"Content-Type", b"application/json")
+        summary = {"total": metrics.total.to_dict(), "last_run": extension.last_run_summary}
+        return json.dumps(summary, ensure_ascii=False, indent=2).encode("utf-8")
+    request.setResponseCode(404)
+    return b"Not found, see /metrics or /metrics.json\n"
+
+
+class MetricsExtension:
+    """
+    Record where the wall time of a run goes: for each city and level the
+    download time, the time to first byte, the bytes transferred, the bans
+    and the retries; the parse time and the durations of the output steps
+    are recorded by the spider in spider.metrics.
+      - The metrics are served on http://METRICS_HOST:METRICS_PORT/metrics
+        (Prometheus text format) and /metrics.json, if METRICS_PORT is not 0.
+        METRICS_PORT is a range like TELNETCONSOLE_PORT, each process (e.g.
+        each worker of a sharded crawl) takes the first free port of it
+      - A JSON summary of each run is written to METRICS_DIR, default is the
+        "metrics" directory in the data directory of the spider
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.host = settings.get("METRICS_HOST", "127.0.0.1")
+        self.portrange = [int(port) for port in settings.getlist("METRICS_PORT", [9410, 9450])]
+        self.metrics_dir = settings.get("METRICS_DIR")
+        self.spider = None
+        self.listener = None
+        # The time the response headers of each request being downloaded are received
+        self.headers_time = dict()
+        self.last_run_summary = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.headers_received, signal=signals.headers_received)
+        crawler.signals.connect(ext.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(ext.run_saved, signal=run_saved)
+        return ext
+
+    def get_metrics(self):
+        return getattr(self.spider, "metrics", None)
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        if self.metrics_dir is None and hasattr(spider, "ssdk"):
+            self.metrics_dir = os.path.join(spider.ssdk.data_dir, "metrics")
+        if self.portrange and self.portrange[0] > 0:
+            from scrapy.utils.reactor import listen_tcp
+            from twisted.internet.error import CannotListenError
+            from twisted.web import server
+
+            try:
+                site = server.Site(make_metrics_resource(self))
+                self.listener = listen_tcp(self.portrange, self.host, site)
+                spider.logger.info(f"Metrics on http://{self.host}:{self.listener.getHost().port}/metrics")
+            except CannotListenError as e:
+                spider.logger.warning(f"Metrics endpoint not started: {e}")
+
+    def spider_closed(self, spider):
+        self.headers_time.clear()
+        if self.listener is not None:
+            self.listener.stopListening()
+            self.listener = None
+
+    def get_city(self, request, spider):
+        city = request.meta.get("city")
+        if city is None and hasattr(spider, "get_url_city"):
+            city = spider.get_url_city(request.url)
+        return city or "N/A"
+
+    def headers_received(self, headers, body_length, request, spider):
+        self.headers_time[request] = time.perf_counter()
+
+    def response_downloaded(self, response, request, spider):
+        metrics = self.get_metrics()
+        t_headers = self.headers_time.pop(request, None)
+        if metrics is None:
+            return
+
+        labels = {"city": self.get_city(request, spider), "level": request.meta.get("level", "city"),
+                  "market": request.meta.get("market", "resale")}
+        # download_latency is set by the download handler when the headers are received
+        ttfb = request.meta.get("download_latency")
+        if ttfb is not None:
+            metrics.observe("ttfb_seconds", ttfb, **labels)
+            body_time = time.perf_counter() - t_headers if t_headers is not None else 0.0
+            metrics.observe("download_seconds", ttfb + body_time, **labels)
+        metrics.inc("response_bytes_total", len(response.body), **labels)
+        metrics.inc("responses_total", **labels)
+        if is_ban_response(response, request):
+            metrics.inc("bans_total", **labels)
+        if request.meta.get("ban_retry_times"):
+            metrics.inc("ban_retries_total", **labels)
+
+    def run_saved(self, run_time, metrics, wall_seconds=None):
+        """
+        Write the JSON summary of a run, e.g. metrics/run-20240301-090000.json
+        """
+        summary = {
+            "run_time": run_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "wall_seconds": wall_seconds,
+            "metrics": metrics.to_dict(),
+        }
+        self.last_run_summary = summary
+        if not self.metrics_dir:
+            return
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        fname = os.path.join(self.metrics_dir, run_time.strftime("run-%Y%m%d-%H%M%S.json"))
+        with atomic_output(fname, "w", encoding="utf-8") as fp:
+            json.dump(summary, fp, ensure_ascii=False, indent=2)
+
+
+class ProfilingExtension:
+    """
+    Profile production runs without editing the code, e.g.
+
+        scrapy crawl house_resale -s PROFILE_ENABLED=1 -s PROFILE_MODE=sample
+
+    The stages decorated by profiling.profiled() (parse, closed, the history
+    writes and the stages of ResaleTableRefresh) are profiled, see
+    profiling.Profiler for the modes. Keep the overhead low when it is left on
+    with PROFILE_SAMPLE_RATE (the fraction of calls profiled by cProfile) or
+    PROFILE_SAMPLE_HZ (the stack samples per second). The profiles of each run
+    are written to PROFILE_DIR/run-YYYYMMDD-HHMMSS, default PROFILE_DIR is
+    "profiles" in the data directory of the spider.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.profile_dir = settings.get("PROFILE_DIR")
+        self.profiler = Profiler(settings.get("PROFILE_MODE", "cprofile"),
+                                 settings.getfloat("PROFILE_SAMPLE_RATE", 1.0),
+                                 settings.getfloat("PROFILE_SAMPLE_HZ", 100.0))
+        self.run_time = None
+        self.spider = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PROFILE_ENABLED"):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.run_saved, signal=run_saved)
+        crawler.signals.connect(ext.engine_stopped, signal=signals.engine_stopped)
+        return ext
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        if self.profile_dir is None and hasattr(spider, "ssdk"):
+            self.profile_dir = os.path.join(spider.ssdk.data_dir, "profiles")
+        set_profiler(self.profiler)
+        self.profiler.start()
+
+    def dump(self, run_time):
+        if not self.profile_dir:
+            return
+        out_dir = os.path.join(self.profile_dir, run_time.strftime("run-%Y%m%d-%H%M%S"))
+        fnames = self.profiler.dump(out_dir)
+        if fnames and self.spider is not None:
+            self.spider.logger.info(f"Profiles written to {out_dir}")
+
+    def run_saved(self, run_time, metrics):
+        self.run_time = run_time
+        self.dump(run_time)
+
+    def engine_stopped(self):
+        # The spider is closed, "closed" is profiled only when it is done
+        self.profiler.stop()
+        set_profiler(None)
+        run_time = self.run_time or getattr(self.spider, "run_time", None) or datetime.now()
+        self.dump(run_time)
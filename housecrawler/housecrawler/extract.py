@@ -0,0 +1,239 @@
+"""
+Extract the numbers from the Beike pages.
+
+The total number of listings is in a small block near the top of the page,
+
+    <h2 class="total fl">共找到<span> 96547 </span>套<a href="/ershoufang/" title="北京在售二手房">北京</a>二手房</h2>
+
+so it is found by scanning the raw bytes of the body for that block, which
+is much cheaper than building the lxml tree for the whole page. The XPath
+expressions are only used if the fast path misses, e.g. after a layout change.
+The pages of the new homes (loupan) and the rentals (zufang) have their own
+blocks, see the TotalNumPattern of each market below.
+"""
+import json
+import re
+
+# Currently it seems the xpath for the total house numbers of each city is the same,
+# so use it as a single variable
+TOTAL_NUM_XPATH = '//*[@id="beike"]/div[1]/div[4]/div[1]/div[2]/div[1]/h2/span' + '/text()'
+CITY_XPATH = '//*[@id="beike"]/div[1]/div[4]/div[1]/div[2]/div[1]/h2/a' + '/text()'
+
+# Links to the districts of a city page, and to the bizcircles of a district page
+DISTRICT_LINKS_XPATH = '//*[@data-role="ershoufang"]/div[1]/a'
+BIZCIRCLE_LINKS_XPATH = '//*[@data-role="ershoufang"]/div[2]/a'
+
+# The listings of a listing page, and the page box with the number of pages
+LISTINGS_XPATH = '//ul[contains(@class, "sellListContent")]/li[contains(@class, "clear")]'
+PAGE_DATA_XPATH = '//div[contains(@class, "house-lst-page-box")]/@page-data'
+AREA_RE = re.compile(r'([\d.]+)\s*平米')
+
+TOTAL_NUM_ANCHOR = b'<h2 class="total'
+# The block is short, don't let a miss scan the rest of the page
+TOTAL_NUM_MAX_LEN = 512
+TOTAL_NUM_RE = re.compile(rb'<span[^>]*>\s*([\d,]+)\s*</span>[^<]*<a[^>]*>\s*([^<]*?)\s*</a>')
+
+
+class TotalNumPattern:
+    """
+    Where the total number of listings is on the city pages of a market: the
+    anchor and the regex of the block in the raw bytes (group 1 is the number,
+    group 2 the city name if the block has it), and the XPath expressions
+    """
+    def __init__(self, anchor, regex, total_num_xpath, city_xpath=None, max_len=TOTAL_NUM_MAX_LEN):
+        self.anchor = anchor
+        self.regex = regex
+        self.total_num_xpath = total_num_xpath
+        self.city_xpath = city_xpath
+        self.max_len = max_len
+
+
+# Resale (ershoufang), see the block above
+RESALE_TOTAL_NUM = TotalNumPattern(TOTAL_NUM_ANCHOR, TOTAL_NUM_RE, TOTAL_NUM_XPATH, CITY_XPATH)
+# New homes (loupan),
+#   <div class="resblock-have-find"><span>为您找到</span><span class="value">1108</span><span>个北京新房</span>
+NEWHOME_TOTAL_NUM = TotalNumPattern(
+    b'class="resblock-have-find"',
+    re.compile(rb'<span class="value">\s*([\d,]+)\s*</span>\s*<span>\s*([^<]*?)\s*</span>'),
+    '//div[contains(@class, "resblock-have-find")]/span[@class="value"]/text()')
+# Rentals (zufang),
+#   <p class="content__title">已为您找到 <span class="content__title--hl">28437</span> 套<a href="/zufang/">北京租房</a>
+RENTAL_TOTAL_NUM = TotalNumPattern(
+    b'<p class="content__title',
+    re.compile(rb'<span class="content__title--hl">\s*([\d,]+)\s*</span>[^<]*(?:<a[^>]*>\s*([^<]*?)\s*</a>)?'),
+    '//p[contains(@class, "content__title")]/span[contains(@class, "content__title--hl")]/text()',
+    '//p[contains(@class, "content__title")]/a/text()')
+
+
+def find_total_num(body, start=0, pattern=RESALE_TOTAL_NUM):
+    """
+    Find the total-count block in the raw bytes of a page
+    :param body: The body of the response, may be a part of it
+    :param start: The position to start searching from
+    :param pattern: The TotalNumPattern of the market of the page
+    :return: A tuple (total_num, city_name), or None if the block is not (yet) found
+    """
+    pos = body.find(pattern.anchor, start)
+    if pos < 0:
+        return None
+    m = pattern.regex.search(body, pos, pos + pattern.max_len)
+    if m is None:
+        return None
+    total_num = int(m.group(1).replace(b",", b""))
+    city_name = (m.group(2) or b"").decode("utf-8", errors="replace")
+    return total_num, city_name
+
+
+def extract_total_num_by_xpath(response, pattern=RESALE_TOTAL_NUM):
+    """
+    The slow path, build the lxml tree and run the XPath expressions
+    :return: A tuple (total_num, city_name), or None if not found
+    """
+    city_got = response.xpath(pattern.city_xpath).getall() if pattern.city_xpath else [""]
+    total_num_got = response.xpath(pattern.total_num_xpath).getall()
+    if len(city_got) == 0 or len(total_num_got) == 0:
+        return None
+    return int(total_num_got[0].strip().replace(",", "")), city_got[0]
+
+
+def extract_total_num(response, pattern=RESALE_TOTAL_NUM):
+    """
+    Extract the total number of listings from a response
+    :param pattern: The TotalNumPattern of the market of the page
+    :return: A tuple (total_num, city_name, method), method is "fast" or "xpath",
+             or None if the number is not found
+    """
+    found = find_total_num(response.body, pattern=pattern)
+    if found is not None:
+        return found[0], found[1], "fast"
+    found = extract_total_num_by_xpath(response, pattern)
+    if found is not None:
+        return found[0], found[1], "xpath"
+    return None
+
+
+def extract_total_page(response):
+    """
+    :return: The number of listing pages of an area, 1 if the page box is not found
+    """
+    page_data = response.xpath(PAGE_DATA_XPATH).get()
+    if not page_data:
+        return 1
+    try:
+        return max(1, int(json.loads(page_data).get("totalPage", 1)))
+    except (ValueError, TypeError, AttributeError):
+        return 1
+
+
+def to_float(text):
+    if text is None:
+        return None
+    try:
+        return float(text.strip().replace(",", ""))
+    except ValueError:
+        return None
+
+
+def extract_listings(response):
+    """
+    Extract the listings of a listing page
+    :return: A list of dicts with listing_id, title, url, total_price (10k yuan),
+             unit_price (yuan per square meter) and area (square meters)
+    """
+    listings = []
+    for li in response.xpath(LISTINGS_XPATH):
+        listing_id = li.xpath('.//*[@data-housecode]/@data-housecode').get()
+        if not listing_id:
+            continue
+        title_link = li.xpath('.//div[contains(@class, "title")]/a')
+        house_info = li.xpath('normalize-space(.//div[contains(@class, "houseInfo")])').get() or ""
+        area = AREA_RE.search(house_info)
+        unit_price = li.xpath('.//div[contains(@class, "unitPrice")]/@data-price').get()
+        if unit_price is None:
+            unit_price = li.xpath('.//div[contains(@class, "unitPrice")]/span/text()').re_first(r'[\d,]+')
+        listings.append({
+            "listing_id": listing_id.strip(),
+            "title": title_link.xpath('normalize-space(text())').get(),
+            "url": title_link.attrib.get("href"),
+            "total_price": to_float(li.xpath('.//div[contains(@class, "totalPrice")]/span/text()').get()),
+            "unit_price": to_float(unit_price),
+            "area": to_float(area.group(1)) if area else None,
+        })
+    return listings
+
+
+class TotalNumScanner:
+    """
+    Look for the total-count block in a body which arrives chunk by chunk,
+    so the download can be stopped as soon as the block is received.
+    The chunks are the raw bytes on the wire, so they are decompressed here
+    for gzip and deflate (and br if the brotli package is installed),
+    other encodings are not scanned.
+    """
+    # Give up if the block is not found in this many (decompressed) bytes
+    MAX_SCAN_SIZE = 2 * 1024 * 1024
+
+    def __init__(self, content_encoding=b"", pattern=RESALE_TOTAL_NUM, body_length=None):
+        """
+        :param body_length: The length of the body on the wire (Content-Length), None if it is not known
+        """
+        self.pattern = pattern
+        self.body_length = body_length
+        self.received = 0
+        self.buf = bytearray()
+        self.scanned = 0
+        self.decompressor = None
+        self.enabled = True
+        encoding = content_encoding.strip().lower()
+        if encoding in (b"gzip", b"x-gzip", b"deflate"):
+            import zlib
+            # 32 + MAX_WBITS accepts both gzip and zlib headers
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        elif encoding == b"br":
+            try:
+                import brotli
+                self.decompressor = brotli.Decompressor()
+            except (ImportError, AttributeError):
+                self.enabled = False
+        elif encoding not in (b"", b"identity"):
+            self.enabled = False
+
+    def feed(self, chunk):
+        """
+        :param chunk: The next chunk of the body as received
+        :return: A tuple (total_num, city_name) once the block is found, otherwise None
+        """
+        self.received += len(chunk)
+        if not self.enabled:
+            return None
+        try:
+            if self.decompressor is None:
+                data = chunk
+            elif hasattr(self.decompressor, "decompress"):
+                data = self.decompressor.decompress(chunk)
+            else:
+                data = self.decompressor.process(chunk)
+        except Exception:
+            self.enabled = False
+            return None
+
+        self.buf += data
+        found = find_total_num(self.buf, self.scanned, self.pattern)
+        if found is not None:
+            return found
+        # The anchor may be cut at the end of this chunk, or the block may not be complete yet
+        anchor = self.pattern.anchor
+        anchor_pos = self.buf.find(anchor, self.scanned)
+        if anchor_pos >= 0:
+            self.scanned = anchor_pos
+        else:
+            self.scanned = max(0, len(self.buf) - len(anchor))
+        if len(self.buf) > self.MAX_SCAN_SIZE:
+            self.enabled = False
+        return None
+
+    def is_complete(self):
+        """
+        :return: True if the whole body is received, stopping the download then saves nothing
+        """
+        return self.body_length is not None and self.received >= self.body_length
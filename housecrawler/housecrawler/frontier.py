@@ -0,0 +1,385 @@
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+# The fields of a task, a task is the request of one page
+TASK_FIELDS = ("key", "city", "url", "level", "district", "bizcircle", "priority", "market")
+
+
+def make_task(url, city, level="city", district="", bizcircle="", priority=0, market="resale"):
+    """
+    :return: A task as a dict, keyed by its URL, a page is fetched once per run
+    """
+    return {"key": url, "city": city, "url": url, "level": level,
+            "district": district, "bizcircle": bizcircle, "priority": priority, "market": market}
+
+
+class SQLiteFrontier:
+    """
+    The shared frontier of a sharded crawl: the pages of a run to fetch, in a
+    SQLite file, so several worker processes (e.g. "scrapy crawl
+    house_resale" started more than once) split the work between them.
+    A worker leases a batch of tasks, and completes each task with the city
+    total found on the page and the tasks of the pages linked from it
+    (districts, bizcircles, listing pages), which any worker can lease.
+    A lease which is not completed in lease_seconds (e.g. the worker is
+    gone) is given to the next worker asking for tasks, and only the worker
+    holding the lease of a task can complete it or give it back.
+    The file should be on a local disk, use RedisFrontier for workers on
+    several machines.
+    """
+    def __init__(self, fname, run_ts=None, lease_seconds=300.0):
+        self.fname = fname
+        self.run_ts = run_ts
+        self.lease_seconds = lease_seconds
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+            self.conn = sqlite3.connect(self.fname, timeout=60.0)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.create_tables()
+        return self.conn
+
+    def create_tables(self):
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                " run_ts TEXT PRIMARY KEY,"
+                " created REAL NOT NULL,"
+                " reduced_by TEXT)")
+            # state is "pending", "leased", "done" or "failed", total is the
+            # city total found on a page of the city level
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " run_ts TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " url TEXT NOT NULL,"
+                " level TEXT NOT NULL,"
+                " district TEXT NOT NULL DEFAULT '',"
+                " bizcircle TEXT NOT NULL DEFAULT '',"
+                " priority INTEGER NOT NULL DEFAULT 0,"
+                " state TEXT NOT NULL DEFAULT 'pending',"
+                " worker TEXT,"
+                " lease_until REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " total INTEGER,"
+                " market TEXT NOT NULL DEFAULT 'resale',"
+                " PRIMARY KEY (run_ts, key))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (run_ts, state, priority)")
+            # The frontiers of the resale market only have no market column
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(tasks)")]
+            if "market" not in columns:
+                self.conn.execute("ALTER TABLE tasks ADD COLUMN market TEXT NOT NULL DEFAULT 'resale'")
+
+    def get_last_run(self):
+        """
+        :return: The timestamp of the latest seeded run, or None
+        """
+        row = self.connect().execute("SELECT MAX(run_ts) FROM runs").fetchone()
+        return row[0] if row else None
+
+    def seed(self, tasks):
+        """
+        Start the run (if it is new) with the tasks of the city pages
+        :return: The number of tasks added, the tasks already in the run are kept
+        """
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO runs VALUES (?, ?, NULL)", (self.run_ts, time.time()))
+            return self.add_tasks(tasks)
+
+    def add_tasks(self, tasks):
+        nbefore = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO tasks (run_ts, " + ", ".join(TASK_FIELDS) + ")"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((self.run_ts,) + tuple(task[f] for f in TASK_FIELDS) for task in tasks))
+        return self.conn.total_changes - nbefore
+
+    def lease(self, worker, n):
+        """
+        :return: Up to n tasks for a worker, the highest priorities first
+        """
+        conn = self.connect()
+        now = time.time()
+        with conn:
+            # Take the write lock first, so no other worker leases the same tasks
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT " + ", ".join(TASK_FIELDS) + " FROM tasks WHERE run_ts = ?"
+                " AND (state = 'pending' OR (state = 'leased' AND lease_until < ?))"
+                " ORDER BY priority DESC, rowid LIMIT ?", (self.run_ts, now, n)).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1"
+                " WHERE run_ts = ? AND key = ?",
+                ((worker, now + self.lease_seconds, self.run_ts, row[0]) for row in rows))
+        return [dict(zip(TASK_FIELDS, row)) for row in rows]
+
+    def complete(self, key, worker, total=None, children=()):
+        """
+        Mark a task done, with the city total found on its page and the tasks
+        of the pages linked from it
+        :return: False if the worker doesn't hold the lease of the task any
+                 more (it expired and the task was leased again), nothing is saved
+        """
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET state = 'done', total = ?"
+                " WHERE run_ts = ? AND key = ? AND state = 'leased' AND worker = ?",
+                (total, self.run_ts, key, worker))
+            if cursor.rowcount != 1:
+                return False
+            self.add_tasks(children)
+        return True
+
+    def fail(self, key, worker, max_attempts=3):
+        """
+        Give a task back, e.g. its page is banned for this worker, another
+        worker (another IP) takes it, until it has been tried max_attempts times
+        :return: True if the task is pending again, False if it failed or the
+                 worker doesn't hold its lease any more
+        """
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,"
+                " lease_until = NULL WHERE run_ts = ? AND key = ? AND state = 'leased' AND worker = ?",
+                (max_attempts, self.run_ts, key, worker))
+            if cursor.rowcount != 1:
+                return False
+            row = conn.execute("SELECT state FROM tasks WHERE run_ts = ? AND key = ?",
+                               (self.run_ts, key)).fetchone()
+        return row is not None and row[0] == "pending"
+
+    def get_progress(self):
+        """
+        :return: A dict of the number of tasks in each state
+        """
+        cursor = self.connect().execute("SELECT state, COUNT(*) FROM tasks WHERE run_ts = ? GROUP BY state",
+                                        (self.run_ts,))
+        progress = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        progress.update({state: count for state, count in cursor})
+        return progress
+
+    def is_finished(self):
+        progress = self.get_progress()
+        return progress["pending"] == 0 and progress["leased"] == 0
+
+    def get_results(self):
+        """
+        :return: The city totals found by all the workers, {market: {city: total}}
+        """
+        cursor = self.connect().execute(
+            "SELECT market, city, total FROM tasks WHERE run_ts = ? AND level = 'city' AND total IS NOT NULL",
+            (self.run_ts,))
+        results = dict()
+        for market, city, total in cursor:
+            results.setdefault(market, dict())[city] = total
+        return results
+
+    def claim_reduce(self, worker):
+        """
+        :return: True for the first worker claiming the output steps of the run
+        """
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute("UPDATE runs SET reduced_by = ? WHERE run_ts = ? AND reduced_by IS NULL",
+                                  (worker, self.run_ts))
+        return cursor.rowcount == 1
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class RedisFrontier:
+    """
+    The same frontier as SQLiteFrontier in a Redis (or Redis-compatible)
+    server, for workers on several machines. The "redis" package is
+    imported only when it is used. Keys of a run:
+      {prefix}:{run_ts}:tasks      hash, key -> task as JSON
+      {prefix}:{run_ts}:pending    sorted set, key -> priority
+      {prefix}:{run_ts}:leased     sorted set, key -> end of the lease
+      {prefix}:{run_ts}:owners     hash, key -> the worker holding the lease
+      {prefix}:{run_ts}:attempts   hash, key -> leases so far
+      {prefix}:{run_ts}:done / failed    sets of keys
+      {prefix}:{run_ts}:totals:{market}    hash, city -> total
+      {prefix}:{run_ts}:markets    set of the markets with totals
+      {prefix}:{run_ts}:reduced    the worker doing the output steps
+    A task is moved between pending and leased by a Lua script, so it is
+    always in one of them (is_finished() never sees it in neither), and a
+    lease is completed or given back only by its owner.
+    """
+    # KEYS: pending, leased, attempts, owners, tasks
+    # ARGV: now, end of the lease, n, worker
+    LEASE_SCRIPT = """
+        for _, key in ipairs(redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1])) do
+            redis.call("ZREM", KEYS[2], key)
+            redis.call("HDEL", KEYS[4], key)
+            redis.call("ZADD", KEYS[1], cjson.decode(redis.call("HGET", KEYS[5], key))["priority"], key)
+        end
+        local keys = {}
+        local popped = redis.call("ZPOPMAX", KEYS[1], ARGV[3])
+        for i = 1, #popped, 2 do
+            redis.call("ZADD", KEYS[2], ARGV[2], popped[i])
+            redis.call("HINCRBY", KEYS[3], popped[i], 1)
+            redis.call("HSET", KEYS[4], popped[i], ARGV[4])
+            keys[#keys + 1] = popped[i]
+        end
+        return keys
+    """
+    # KEYS: leased, owners, done, markets, totals of the market
+    # ARGV: key, worker, total ("" if none), city, market
+    COMPLETE_SCRIPT = """
+        if redis.call("HGET", KEYS[2], ARGV[1]) ~= ARGV[2] then
+            return 0
+        end
+        redis.call("ZREM", KEYS[1], ARGV[1])
+        redis.call("HDEL", KEYS[2], ARGV[1])
+        redis.call("SADD", KEYS[3], ARGV[1])
+        if ARGV[3] ~= "" then
+            redis.call("SADD", KEYS[4], ARGV[5])
+            redis.call("HSET", KEYS[5], ARGV[4], ARGV[3])
+        end
+        return 1
+    """
+    # KEYS: leased, owners, attempts, pending, failed
+    # ARGV: key, worker, max attempts, priority
+    FAIL_SCRIPT = """
+        if redis.call("HGET", KEYS[2], ARGV[1]) ~= ARGV[2] then
+            return -1
+        end
+        redis.call("ZREM", KEYS[1], ARGV[1])
+        redis.call("HDEL", KEYS[2], ARGV[1])
+        if tonumber(redis.call("HGET", KEYS[3], ARGV[1]) or 0) < tonumber(ARGV[3]) then
+            redis.call("ZADD", KEYS[4], ARGV[4], ARGV[1])
+            return 1
+        end
+        redis.call("SADD", KEYS[5], ARGV[1])
+        return 0
+    """
+
+    def __init__(self, url, run_ts=None, lease_seconds=300.0, prefix="housecrawler:frontier"):
+        self.url = url
+        self.run_ts = run_ts
+        self.lease_seconds = lease_seconds
+        self.prefix = prefix
+        self.client = None
+        self.scripts = dict()
+
+    def connect(self):
+        if self.client is None:
+            import redis
+
+            self.client = redis.Redis.from_url(self.url, decode_responses=True)
+            self.scripts = {name: self.client.register_script(getattr(self, f"{name.upper()}_SCRIPT"))
+                            for name in ("lease", "complete", "fail")}
+        return self.client
+
+    def rkey(self, name):
+        return f"{self.prefix}:{self.run_ts}:{name}"
+
+    def get_last_run(self):
+        runs = self.connect().zrange(f"{self.prefix}:runs", -1, -1)
+        return runs[0] if runs else None
+
+    def seed(self, tasks):
+        client = self.connect()
+        # Runs are ordered by their timestamps, as the latest one is found by the score
+        client.zadd(f"{self.prefix}:runs", {self.run_ts: datetime.strptime(
+            self.run_ts, "%Y-%m-%d %H:%M:%S").timestamp()}, nx=True)
+        return self.add_tasks(tasks)
+
+    def add_tasks(self, tasks):
+        client = self.connect()
+        nadded = 0
+        for task in tasks:
+            # HSETNX makes sure a page is added once per run
+            if client.hsetnx(self.rkey("tasks"), task["key"], json.dumps(task, ensure_ascii=False)):
+                client.zadd(self.rkey("pending"), {task["key"]: task["priority"]})
+                nadded += 1
+        return nadded
+
+    def get_task(self, key):
+        data = self.connect().hget(self.rkey("tasks"), key)
+        return json.loads(data) if data is not None else None
+
+    def lease(self, worker, n):
+        self.connect()
+        now = time.time()
+        # Expired leases are pending again, then the tasks are moved to leased, in one step
+        keys = self.scripts["lease"](
+            keys=[self.rkey(name) for name in ("pending", "leased", "attempts", "owners", "tasks")],
+            args=[now, now + self.lease_seconds, n, worker])
+        return [self.get_task(key) for key in keys]
+
+    def complete(self, key, worker, total=None, children=()):
+        self.connect()
+        # The tasks linked from the page are pending before this one is done
+        self.add_tasks(children)
+        task = self.get_task(key)
+        market = task.get("market", "resale")
+        return bool(self.scripts["complete"](
+            keys=[self.rkey(name) for name in ("leased", "owners", "done", "markets", f"totals:{market}")],
+            args=[key, worker, "" if total is None else total, task["city"], market]))
+
+    def fail(self, key, worker, max_attempts=3):
+        self.connect()
+        return self.scripts["fail"](
+            keys=[self.rkey(name) for name in ("leased", "owners", "attempts", "pending", "failed")],
+            args=[key, worker, max_attempts, self.get_task(key)["priority"]]) == 1
+
+    def get_progress(self):
+        client = self.connect()
+        return {"pending": client.zcard(self.rkey("pending")), "leased": client.zcard(self.rkey("leased")),
+                "done": client.scard(self.rkey("done")), "failed": client.scard(self.rkey("failed"))}
+
+    def is_finished(self):
+        progress = self.get_progress()
+        return progress["pending"] == 0 and progress["leased"] == 0
+
+    def get_results(self):
+        client = self.connect()
+        return {market: {city: int(total) for city, total in client.hgetall(self.rkey(f"totals:{market}")).items()}
+                for market in client.smembers(self.rkey("markets"))}
+
+    def claim_reduce(self, worker):
+        return bool(self.connect().set(self.rkey("reduced"), worker, nx=True))
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+def open_frontier(spec, data_dir=None, run="last", lease_seconds=300.0):
+    """
+    Open the frontier given by the setting FRONTIER,
+      - "sqlite": frontier.sqlite3 in the data directory
+      - "redis://host:6379/0": a Redis server
+      - any other value: the path of a SQLite file
+    :param run: The timestamp of the run ("%Y-%m-%d %H:%M:%S"), "last" for
+                the latest seeded run or "new" for a new run from now
+    :return: The frontier, its run_ts is None if run is "last" and no run is seeded
+    """
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        frontier = RedisFrontier(spec, lease_seconds=lease_seconds)
+    else:
+        fname = os.path.join(data_dir, "frontier.sqlite3") if spec == "sqlite" else spec
+        frontier = SQLiteFrontier(fname, lease_seconds=lease_seconds)
+
+    if run == "last":
+        frontier.run_ts = frontier.get_last_run()
+    elif run == "new":
+        frontier.run_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        frontier.run_ts = run
+    return frontier
@@ -0,0 +1,515 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from .output_commit import FileLock, atomic_output
+
+# The periods of the rollups, and the format of the key of each period,
+# the weeks start on Sunday as in the history ("%U")
+ROLLUP_PERIODS = {
+    "week": "%Y-W%U",
+    "month": "%Y-%m",
+    "year": "%Y",
+}
+
+# Seconds to wait for another process (e.g. another shard of the crawl)
+# writing to the same SQLite file, before giving up
+SQLITE_BUSY_TIMEOUT = 60.0
+
+
+def get_period_bounds(period, dtime):
+    """
+    :return: The timestamps (start, end) of the period containing dtime, the
+             end excluded. Like "%U", the first and last weeks of a year are
+             cut at the start and the end of the year
+    """
+    day = dtime.replace(hour=0, minute=0, second=0, microsecond=0)
+    year_start = day.replace(month=1, day=1)
+    year_end = year_start.replace(year=year_start.year + 1)
+    if period == "year":
+        start, end = year_start, year_end
+    elif period == "month":
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    else:
+        start = max(year_start, day - timedelta(days=(day.weekday() + 1) % 7))
+        end = min(year_end, start + timedelta(days=7 - (start.weekday() + 1) % 7))
+    return start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class XlsxHistoryStore:
+    """
+    Keep the history of the scraped numbers in a yearly xlsx file.
+    Each append loads and saves the whole workbook, so it gets slower as
+    the year fills up. It is kept as the export format, and as a backend
+    for machines that still want the spreadsheet as the main store.
+    Each load-modify-save holds the lock of the file, and the workbook is
+    saved to a temp file renamed over the file, so overlapping runs don't
+    lose rows or leave a broken workbook.
+    """
+    def __init__(self, fname, city_list, sheet_name="CityResaleNum"):
+        self.fname = fname
+        self.city_list = city_list
+        self.sheet_name = sheet_name
+
+    def get_header_columns(self):
+        # Header columns, first 4 are date, time, weekday, week, the rest are city names
+        header_columns = ["Date", "Time", "Weekday", "Week"]
+        header_columns.extend(self.city_list)
+        return header_columns
+
+    def create_with_header(self):
+        if not isinstance(self.fname, str):
+            return False
+
+        # If file exists, assume this function should not be called
+        if os.path.isfile(self.fname) is True:
+            return False
+
+        import openpyxl
+
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = self.sheet_name
+        ws.append(self.get_header_columns())
+        try:
+            with atomic_output(self.fname) as fp:
+                wb.save(fp)
+        except PermissionError as perr:
+            print(f"PermissionError: errono = {perr.errno}")
+            print(f"PermissionError: strerror = {perr.strerror}")
+            print(f"PermissionError: filename = \'{perr.filename}\'")
+        except Exception as e:
+            print(e)
+
+        return os.path.isfile(self.fname)
+
+    def append_rows(self, rows):
+        """
+        Append rows to the spreadsheet, loading and saving the workbook only once
+        :param rows: An iterable of rows, each row is [date, time, weekday, week, city numbers...]
+        :return: True if the rows are saved
+        """
+        if not isinstance(self.fname, str):
+            return False
+
+        with FileLock(self.fname):
+            if os.path.isfile(self.fname) is False:
+                if self.create_with_header() is False:
+                    return False
+
+            import openpyxl
+
+            # Use openpyxl directly to append rows to an existing spreadsheet
+            wb = openpyxl.load_workbook(self.fname)
+            ws = wb.worksheets[0]
+            for row_val in rows:
+                ws.append(list(row_val))
+            with atomic_output(self.fname) as fp:
+                wb.save(fp)
+
+        return True
+
+    def append_row(self, dt_values, data_row):
+        """
+        Append the numbers of one run. If the last row is of the same run
+        (the same date and time, e.g. a resumed run), it is replaced instead
+        """
+        row_val = list(dt_values)
+        row_val.extend(data_row)
+
+        with FileLock(self.fname):
+            if os.path.isfile(self.fname) is False:
+                return self.append_rows([row_val])
+
+            import openpyxl
+
+            wb = openpyxl.load_workbook(self.fname)
+            ws = wb.worksheets[0]
+            last_row = [cell.value for cell in ws[ws.max_row]] if ws.max_row > 1 else []
+            if last_row[:2] == row_val[:2]:
+                for i, value in enumerate(row_val):
+                    ws.cell(row=ws.max_row, column=i + 1, value=value)
+            else:
+                ws.append(row_val)
+            with atomic_output(self.fname) as fp:
+                wb.save(fp)
+
+        return True
+
+    def close(self):
+        pass
+
+
+class SQLiteHistoryStore:
+    """
+    Keep the history of the scraped numbers in an append-only SQLite database.
+    There is one row per (timestamp, city), and the database runs in WAL mode,
+    so each append costs the same whatever the size of the history is.
+    Spreadsheets are exported from it on request, see export_to_spreadsheet().
+    Several processes can write to it at once, each write waits for the
+    others (SQLITE_BUSY_TIMEOUT).
+    """
+    def __init__(self, fname, city_list):
+        self.fname = fname
+        self.city_list = city_list
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.fname, timeout=SQLITE_BUSY_TIMEOUT)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.create_tables()
+        return self.conn
+
+    def create_tables(self):
+        has_rollups = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollups'").fetchone() is not None
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                " ts TEXT NOT NULL,"
+                " date TEXT NOT NULL,"
+                " time TEXT NOT NULL,"
+                " weekday TEXT NOT NULL,"
+                " week TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " total INTEGER NOT NULL,"
+                " PRIMARY KEY (ts, city))")
+            # Totals of the districts and bizcircles (and the cities again) of the fan-out crawl
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS area_counts ("
+                " ts TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " level TEXT NOT NULL,"
+                " district TEXT NOT NULL DEFAULT '',"
+                " bizcircle TEXT NOT NULL DEFAULT '',"
+                " total INTEGER NOT NULL,"
+                " url TEXT,"
+                " PRIMARY KEY (ts, city, level, district, bizcircle))")
+            # Listings of the listing-level crawl
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS listings ("
+                " ts TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " listing_id TEXT NOT NULL,"
+                " district TEXT NOT NULL DEFAULT '',"
+                " bizcircle TEXT NOT NULL DEFAULT '',"
+                " title TEXT,"
+                " total_price REAL,"
+                " unit_price REAL,"
+                " area REAL,"
+                " url TEXT,"
+                " PRIMARY KEY (ts, city, listing_id))")
+            # The city totals of each run as they arrive, so a failed run can be resumed
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                " run_ts TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " total INTEGER NOT NULL,"
+                " PRIMARY KEY (run_ts, city))")
+            # Listings which appeared ("new") or disappeared ("delisted") since the last listing crawl
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS listing_changes ("
+                " ts TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " listing_id TEXT NOT NULL,"
+                " change TEXT NOT NULL,"
+                " PRIMARY KEY (ts, city, listing_id))")
+            # The last, min, max and mean (sum / count) number of each city in
+            # each week, month and year, updated with each sample
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollups ("
+                " period TEXT NOT NULL,"
+                " period_key TEXT NOT NULL,"
+                " city TEXT NOT NULL,"
+                " last_ts TEXT NOT NULL,"
+                " last INTEGER NOT NULL,"
+                " min INTEGER NOT NULL,"
+                " max INTEGER NOT NULL,"
+                " sum INTEGER NOT NULL,"
+                " count INTEGER NOT NULL,"
+                " PRIMARY KEY (period, period_key, city))")
+        # A history from before the rollups
+        if not has_rollups:
+            self.rebuild_rollups()
+
+    def append_row(self, dt_values, data_row):
+        """
+        Append the numbers of one run
+        :param dt_values: [date, time, weekday, week] of this run
+        :param data_row: The numbers of each city, in the same order as the city list
+        :return: True if the numbers are saved
+        """
+        if not isinstance(self.fname, str):
+            return False
+        assert len(data_row) == len(self.city_list)
+
+        date_str, time_str, day_str, week_str = dt_values
+        ts = f"{date_str} {time_str}"
+        values = [(ts, date_str, time_str, day_str, week_str, city, num)
+                  for city, num in zip(self.city_list, data_row)]
+
+        self.write_samples(values)
+        return True
+
+    def write_samples(self, values):
+        """
+        Insert or replace samples and update the rollups in the same transaction
+        :param values: A list of (ts, date, time, weekday, week, city, total)
+        """
+        conn = self.connect()
+        with conn:
+            # Take the write lock first, so the replaced samples found are
+            # still the replaced ones when the rollups are updated
+            conn.execute("BEGIN IMMEDIATE")
+            replaced = set()
+            for ts in {v[0] for v in values}:
+                replaced.update((ts, city) for city, in conn.execute("SELECT city FROM samples WHERE ts = ?", (ts,)))
+            conn.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+            for v in values:
+                ts, city, total = v[0], v[5], v[6]
+                self.update_rollups(ts, city, total, (ts, city) in replaced)
+
+    def update_rollups(self, ts, city, total, replaced=False):
+        """
+        Add a sample to the rollups of its week, month and year, in O(1).
+        A replaced sample (e.g. by a resumed run or "scrapy reparse") can't be
+        taken out of min and max, so the rollups of its periods are rebuilt
+        from the samples of the periods instead
+        """
+        dtime = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+        for period, key_fmt in ROLLUP_PERIODS.items():
+            period_key = dtime.strftime(key_fmt)
+            if replaced:
+                self.rebuild_rollup(period, period_key, city, dtime)
+            elif total >= 0:
+                self.conn.execute(
+                    "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)"
+                    " ON CONFLICT (period, period_key, city) DO UPDATE SET"
+                    " last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last ELSE last END,"
+                    " last_ts = MAX(last_ts, excluded.last_ts),"
+                    " min = MIN(min, excluded.min),"
+                    " max = MAX(max, excluded.max),"
+                    " sum = sum + excluded.sum,"
+                    " count = count + 1",
+                    (period, period_key, city, ts, total, total, total, total))
+
+    def rebuild_rollup(self, period, period_key, city, dtime):
+        start, end = get_period_bounds(period, dtime)
+        self.conn.execute("DELETE FROM rollups WHERE period = ? AND period_key = ? AND city = ?",
+                          (period, period_key, city))
+        row = self.conn.execute(
+            "SELECT MAX(ts), MIN(total), MAX(total), SUM(total), COUNT(*) FROM samples"
+            " WHERE city = ? AND ts >= ? AND ts < ? AND total >= 0", (city, start, end)).fetchone()
+        if row[4] == 0:
+            return
+        last_ts, vmin, vmax, vsum, count = row
+        last = self.conn.execute("SELECT total FROM samples WHERE ts = ? AND city = ?", (last_ts, city)).fetchone()[0]
+        self.conn.execute("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (period, period_key, city, last_ts, last, vmin, vmax, vsum, count))
+
+    def rebuild_rollups(self):
+        """
+        Build all rollups from the samples, in one pass over the history
+        """
+        rollups = dict()
+        with self.conn:
+            # No sample can be written by another process between the read and the write
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute("SELECT ts, city, total FROM samples WHERE total >= 0 ORDER BY ts")
+            for ts, city, total in cursor:
+                dtime = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+                for period, key_fmt in ROLLUP_PERIODS.items():
+                    key = (period, dtime.strftime(key_fmt), city)
+                    entry = rollups.get(key)
+                    if entry is None:
+                        rollups[key] = [ts, total, total, total, total, 1]
+                    else:
+                        entry[0], entry[1] = ts, total
+                        entry[2] = min(entry[2], total)
+                        entry[3] = max(entry[3], total)
+                        entry[4] += total
+                        entry[5] += 1
+            self.conn.execute("DELETE FROM rollups")
+            self.conn.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (key + tuple(entry) for key, entry in rollups.items()))
+
+    def iter_rollups(self, period, city=None, since_key=None):
+        """
+        Iterate over the rollups of a period
+        :param period: "week", "month" or "year"
+        :param since_key: Only the periods from this one, e.g. "2024-W09", "2024-03"
+        :return: A generator of (period_key, city, last, min, max, mean, count)
+        """
+        sql = "SELECT period_key, city, last, min, max, 1.0 * sum / count, count FROM rollups WHERE period = ?"
+        params = [period]
+        if city is not None:
+            sql += " AND city = ?"
+            params.append(city)
+        if since_key is not None:
+            sql += " AND period_key >= ?"
+            params.append(since_key)
+        sql += " ORDER BY period_key, city"
+        yield from self.connect().execute(sql, params)
+
+    def get_totals(self, since=None, until=None):
+        """
+        :param since: Only the runs at or after this timestamp ("%Y-%m-%d %H:%M:%S")
+        :param until: Only the runs before this timestamp
+        :return: A dict of the stored numbers, keyed by (ts, city)
+        """
+        conn = self.connect()
+        cursor = conn.execute("SELECT ts, city, total FROM samples WHERE ts >= ? AND ts < ?",
+                              (since or "", until or "\uffff"))
+        return {(ts, city): total for ts, city, total in cursor}
+
+    def replace_totals(self, records):
+        """
+        Replace the numbers of some cities in some runs, e.g. with the numbers
+        recomputed from the archived pages
+        :param records: An iterable of (ts, city, total)
+        :return: True if the numbers are saved
+        """
+        values = []
+        for ts, city, total in records:
+            dtime = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+            values.append((ts, dtime.strftime("%Y-%m-%d"), dtime.strftime("%H:%M:%S"),
+                           dtime.strftime("%A"), dtime.strftime("%U"), city, total))
+
+        self.write_samples(values)
+        return True
+
+    def append_area_counts(self, records):
+        """
+        Append the totals of cities, districts and bizcircles
+        :param records: An iterable of (ts, city, level, district, bizcircle, total, url)
+        :return: True if the totals are saved
+        """
+        conn = self.connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO area_counts VALUES (?, ?, ?, ?, ?, ?, ?)", records)
+        return True
+
+    def append_listings(self, records):
+        """
+        Append listings
+        :param records: An iterable of (ts, city, listing_id, district, bizcircle,
+                        title, total_price, unit_price, area, url)
+        :return: True if the listings are saved
+        """
+        conn = self.connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+        return True
+
+    def append_listing_changes(self, records):
+        """
+        Append the changes of the listings found by the listing ID index
+        :param records: An iterable of (ts, city, listing_id, change)
+        :return: True if the changes are saved
+        """
+        conn = self.connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO listing_changes VALUES (?, ?, ?, ?)", records)
+        return True
+
+    def save_checkpoint(self, run_ts, city, total):
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (run_ts, city, total))
+        return True
+
+    def load_checkpoint(self, run_ts):
+        """
+        :return: A dict of the city totals saved for a run
+        """
+        conn = self.connect()
+        cursor = conn.execute("SELECT city, total FROM checkpoints WHERE run_ts = ?", (run_ts,))
+        return {city: total for city, total in cursor}
+
+    def get_last_checkpoint_run(self):
+        """
+        :return: The timestamp of the latest run with a checkpoint, or None
+        """
+        conn = self.connect()
+        row = conn.execute("SELECT MAX(run_ts) FROM checkpoints").fetchone()
+        return row[0] if row else None
+
+    def get_years(self):
+        """
+        :return: The years with stored runs, in order
+        """
+        cursor = self.connect().execute("SELECT DISTINCT substr(ts, 1, 4) FROM samples ORDER BY 1")
+        return [int(row[0]) for row in cursor]
+
+    def iter_rows(self, year=None):
+        """
+        Iterate over the stored runs in the spreadsheet layout
+        :param year: Only iterate over the runs of this year if it is given
+        :return: A generator of rows [date, time, weekday, week, city numbers...],
+                 a city without a number in a run gets -1
+        """
+        conn = self.connect()
+        sql = "SELECT ts, date, time, weekday, week, city, total FROM samples"
+        params = ()
+        if year is not None:
+            # The timestamp starts with the date, so this is a range scan on the primary key
+            sql += " WHERE ts >= ? AND ts < ?"
+            params = (f"{year}-", f"{int(year) + 1}-")
+        sql += " ORDER BY ts"
+
+        cursor = conn.execute(sql, params)
+        for _, records in groupby(cursor, key=lambda r: r[0]):
+            records = list(records)
+            nums = {r[5]: r[6] for r in records}
+            row_val = list(records[0][1:5])
+            row_val.extend([nums.get(city, -1) for city in self.city_list])
+            yield row_val
+
+    def export_to_spreadsheet(self, spfname, year=None, sheet_name="CityResaleNum"):
+        """
+        Write the stored runs to a new xlsx file, replacing the file if it exists
+        :return: The number of rows written
+        """
+        import openpyxl
+
+        xhs = XlsxHistoryStore(spfname, self.city_list, sheet_name)
+        # Write-only mode streams the rows instead of building the whole sheet in memory
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(sheet_name)
+        ws.append(xhs.get_header_columns())
+        nrow = 0
+        for row_val in self.iter_rows(year):
+            ws.append(row_val)
+            nrow += 1
+        with FileLock(spfname), atomic_output(spfname) as fp:
+            wb.save(fp)
+
+        return nrow
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# Backends which can be selected by the setting HISTORY_BACKEND, by name or by
+# the dotted path of a class, which is imported only when it is selected
+HISTORY_BACKENDS = {
+    "sqlite": "housecrawler.history_store.SQLiteHistoryStore",
+    "xlsx": "housecrawler.history_store.XlsxHistoryStore",
+}
+
+
+def load_history_backend(name):
+    """
+    :param name: A name in HISTORY_BACKENDS, or the dotted path of a backend class
+                 taking (fname, city_list), e.g. "mypackage.stores.CsvHistoryStore"
+    :return: The backend class
+    """
+    from scrapy.utils.misc import load_object
+
+    return load_object(HISTORY_BACKENDS.get(name, name))
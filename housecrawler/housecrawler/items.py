@@ -7,6 +7,39 @@ import scrapy
 
 
 class HousecrawlerItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+    """
+    A listing of a listing page (ershoufang/pgN/)
+    """
+    # Time of the run, "%Y-%m-%d %H:%M:%S"
+    ts = scrapy.Field()
+    # City name (English), and the district and bizcircle crawled to find it
+    city = scrapy.Field()
+    district = scrapy.Field()
+    bizcircle = scrapy.Field()
+    # The housecode of Beike
+    listing_id = scrapy.Field()
+    title = scrapy.Field()
+    url = scrapy.Field()
+    # Total price in 10k yuan, unit price in yuan per square meter, area in square meters
+    total_price = scrapy.Field()
+    unit_price = scrapy.Field()
+    area = scrapy.Field()
+
+
+class ListingCountItem(scrapy.Item):
+    """
+    The total number of listings of a city, a district or a bizcircle
+    """
+    # The market of the page, "resale", "newhome" or "rental" (see markets.py)
+    market = scrapy.Field()
+    # Time of the run, "%Y-%m-%d %H:%M:%S"
+    ts = scrapy.Field()
+    # City name (English)
+    city = scrapy.Field()
+    # "city", "district" or "bizcircle"
+    level = scrapy.Field()
+    # Names of the district and the bizcircle, empty for the upper levels
+    district = scrapy.Field()
+    bizcircle = scrapy.Field()
+    url = scrapy.Field()
+    total_num = scrapy.Field()
@@ -0,0 +1,118 @@
+import heapq
+import os
+from array import array
+from bisect import bisect_left
+
+from .output_commit import FileLock, write_atomically
+
+
+class ListingIdIndex:
+    """
+    A compact on-disk index of the listing IDs of each city, used to find the
+    new and the delisted homes since the last listing crawl.
+
+    The IDs of a city are kept as a sorted array of 64-bit integers (8 bytes
+    per listing), one file for the latest snapshot and one for the snapshot
+    before it:
+        {index_dir}/{city}.ids
+        {index_dir}/{city}.prev.ids
+    Membership is a binary search and the diff of two snapshots is one merge
+    pass over both arrays, without loading any stored listings.
+    A snapshot is committed under the lock of the city, and each file is
+    replaced as a whole, so a reader always finds a complete snapshot.
+    A partial crawl (pages missed, or fewer IDs than the total number of the
+    city) only adds its IDs to the latest snapshot, no listing is delisted by it.
+    """
+    ITEM_TYPE = "q"
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.snapshots = dict()
+
+    def snapshot_fname(self, city, previous=False):
+        return os.path.join(self.index_dir, f"{city}.prev.ids" if previous else f"{city}.ids")
+
+    @staticmethod
+    def to_int_id(listing_id):
+        """
+        :return: The listing ID as an integer, or None if it is not numeric
+        """
+        try:
+            return int(listing_id)
+        except (TypeError, ValueError):
+            return None
+
+    def load(self, city, previous=False):
+        """
+        :return: The sorted array of IDs of a snapshot, empty if there is no such snapshot
+        """
+        ids = array(self.ITEM_TYPE)
+        fname = self.snapshot_fname(city, previous)
+        if os.path.isfile(fname):
+            with open(fname, "rb") as fp:
+                ids.frombytes(fp.read())
+        return ids
+
+    def contains(self, city, listing_id):
+        """
+        Check whether a listing is in the latest snapshot of a city
+        """
+        key = self.to_int_id(listing_id)
+        if key is None:
+            return False
+        if city not in self.snapshots:
+            self.snapshots[city] = self.load(city)
+        ids = self.snapshots[city]
+        pos = bisect_left(ids, key)
+        return pos < len(ids) and ids[pos] == key
+
+    @staticmethod
+    def diff_sorted(new_ids, old_ids):
+        """
+        Diff two sorted arrays of unique IDs in one merge pass
+        :return: A tuple (IDs only in new_ids, IDs only in old_ids)
+        """
+        added, removed = [], []
+        i, j = 0, 0
+        n, m = len(new_ids), len(old_ids)
+        while i < n and j < m:
+            if new_ids[i] == old_ids[j]:
+                i += 1
+                j += 1
+            elif new_ids[i] < old_ids[j]:
+                added.append(new_ids[i])
+                i += 1
+            else:
+                removed.append(old_ids[j])
+                j += 1
+        added.extend(new_ids[i:])
+        removed.extend(old_ids[j:])
+        return added, removed
+
+    def commit_snapshot(self, city, listing_ids, partial=False):
+        """
+        Save the IDs crawled in this run as the latest snapshot of a city,
+        the latest snapshot so far becomes the previous one
+        :param listing_ids: An iterable of the IDs crawled in this run
+        :param partial: The IDs are a part of the listings of the city only, they
+                        are added to the latest snapshot instead of replacing it
+        :return: A tuple (new IDs, delisted IDs) compared to the latest snapshot so far
+        """
+        int_ids = (self.to_int_id(listing_id) for listing_id in listing_ids)
+        ids = array(self.ITEM_TYPE, sorted({key for key in int_ids if key is not None}))
+
+        fname = self.snapshot_fname(city)
+        with FileLock(fname):
+            old_ids = self.load(city)
+            added, removed = self.diff_sorted(ids, old_ids)
+            if partial:
+                ids = array(self.ITEM_TYPE, heapq.merge(old_ids, added))
+                removed = []
+            # The previous snapshot is written from the IDs already read, instead of
+            # renaming the latest one, so there is always a latest snapshot
+            if os.path.isfile(fname):
+                write_atomically(self.snapshot_fname(city, previous=True), old_ids.tobytes(), lock=False)
+            write_atomically(fname, ids.tobytes(), lock=False)
+        self.snapshots[city] = ids
+
+        return added, removed
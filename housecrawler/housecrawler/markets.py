@@ -0,0 +1,67 @@
+from urllib.parse import urlsplit
+
+from .extract import RESALE_TOTAL_NUM, NEWHOME_TOTAL_NUM, RENTAL_TOTAL_NUM, \
+    DISTRICT_LINKS_XPATH, BIZCIRCLE_LINKS_XPATH
+
+
+class Market:
+    """
+    A market of the Beike sites whose listings are counted. What is specific
+    to a market is kept here, so the same crawl engine (HouseSpider) serves all:
+      - the URL of the city pages (the template in cities.json), and its path
+      - the TotalNumPattern of the city pages, and the links to the districts
+        and bizcircles (None if the fan-out is not supported)
+      - the names of the output files and the titles of the weekly tables
+    """
+    def __init__(self, name, path, file_tag, title_en, title_cn, total_num_pattern,
+                 district_links_xpath=None, bizcircle_links_xpath=None, listings=False):
+        self.name = name
+        self.path = path
+        # e.g. cityDataYear2024ResaleNum19.xlsx, resalenumbers2024.md, cityResaleHistory.sqlite3
+        self.file_tag = file_tag
+        self.title_en = title_en
+        self.title_cn = title_cn
+        self.total_num_pattern = total_num_pattern
+        self.district_links_xpath = district_links_xpath
+        self.bizcircle_links_xpath = bizcircle_links_xpath
+        # The listing pages can be crawled (extract_listings)
+        self.listings = listings
+
+    def get_area_links_xpath(self, level):
+        """
+        :param level: "district" or "bizcircle"
+        :return: The XPath of the links to the areas of the level, or None
+        """
+        return self.district_links_xpath if level == "district" else self.bizcircle_links_xpath
+
+
+MARKETS = {
+    "resale": Market("resale", "/ershoufang/", "Resale", "Resale", "二手房", RESALE_TOTAL_NUM,
+                     DISTRICT_LINKS_XPATH, BIZCIRCLE_LINKS_XPATH, listings=True),
+    "newhome": Market("newhome", "/loupan/", "NewHome", "New Home", "新房", NEWHOME_TOTAL_NUM),
+    "rental": Market("rental", "/zufang/", "Rental", "Rental", "租房", RENTAL_TOTAL_NUM),
+}
+DEFAULT_MARKET = "resale"
+
+
+def get_market(name=None):
+    """
+    :return: The Market of a name, the default market (resale) if name is None
+    """
+    if name is None:
+        name = DEFAULT_MARKET
+    if name not in MARKETS:
+        raise ValueError(f"Unknown market {name}, should be one of {list(MARKETS)}")
+    return MARKETS[name]
+
+
+def get_market_by_url(url):
+    """
+    :return: The Market of a page by the start of its path, e.g. /zufang/dongcheng/,
+             the default market if none matches
+    """
+    path = urlsplit(url).path
+    for market in MARKETS.values():
+        if path.startswith(market.path):
+            return market
+    return MARKETS[DEFAULT_MARKET]
@@ -0,0 +1,133 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Signal sent by the spider when the output steps of a run are done,
+# with the arguments run_time, metrics (the MetricSet of the run) and
+# wall_seconds (from the start of the batch in this process)
+run_saved = object()
+
+
+class MetricSet:
+    """
+    Counters and summaries (count, sum and max of the observed values),
+    each with a set of labels, e.g. the download time of each city.
+    It is written by the reactor thread and by the thread of the output
+    steps in the daemon mode, so all accesses take the lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> [count, sum, max]
+        self.values = dict()
+        self.kinds = dict()
+
+    @staticmethod
+    def labels_key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            self.kinds.setdefault(name, "summary")
+            entry = self.values.get(key)
+            if entry is None:
+                self.values[key] = [1, value, value]
+            else:
+                entry[0] += 1
+                entry[1] += value
+                if value > entry[2]:
+                    entry[2] = value
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            self.kinds.setdefault(name, "counter")
+            entry = self.values.get(key)
+            if entry is None:
+                self.values[key] = [1, value, value]
+            else:
+                entry[0] += 1
+                entry[1] += value
+
+    def to_prometheus(self, prefix="housecrawler_"):
+        """
+        :return: The metrics in the Prometheus text format
+        """
+        with self.lock:
+            items = sorted(self.values.items())
+            kinds = dict(self.kinds)
+
+        lines = []
+        last_name = None
+        for (name, labels), (count, total, vmax) in items:
+            metric = prefix + name
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            label_str = "{" + label_str + "}" if label_str else ""
+            if name != last_name:
+                lines.append(f"# TYPE {metric} {kinds[name]}")
+                last_name = name
+            if kinds[name] == "counter":
+                lines.append(f"{metric}{label_str} {total}")
+            else:
+                lines.append(f"{metric}_count{label_str} {count}")
+                lines.append(f"{metric}_sum{label_str} {total:.6f}")
+                lines.append(f"{metric}_max{label_str} {vmax:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """
+        :return: The metrics as a dict for a JSON summary,
+                 {name: [{"labels": {...}, "count": n, "sum": s, "max": m}, ...]}
+        """
+        with self.lock:
+            items = sorted(self.values.items())
+            kinds = dict(self.kinds)
+
+        result = dict()
+        for (name, labels), (count, total, vmax) in items:
+            entry = {"labels": dict(labels), "count": count, "sum": total}
+            if kinds[name] == "summary":
+                entry["max"] = vmax
+                entry["avg"] = total / count
+            result.setdefault(name, []).append(entry)
+        return result
+
+
+class Metrics:
+    """
+    The metrics of the crawler process, and of the current run. In the daemon
+    mode the process does many runs, the totals are kept for the metrics
+    endpoint and the metrics of each run are summarized when it is saved
+    """
+    def __init__(self):
+        self.total = MetricSet()
+        self.run = MetricSet()
+
+    def observe(self, name, value, **labels):
+        self.total.observe(name, value, **labels)
+        self.run.observe(name, value, **labels)
+
+    def inc(self, name, value=1, **labels):
+        self.total.inc(name, value, **labels)
+        self.run.inc(name, value, **labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the seconds spent in a with-block, e.g.
+
+            with metrics.timer("output_step_seconds", step="table_refresh"):
+                ...
+        """
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t_start, **labels)
+
+    def end_run(self):
+        """
+        :return: The metrics of the run just done, the next run starts with empty metrics
+        """
+        run, self.run = self.run, MetricSet()
+        return run
@@ -3,11 +3,24 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import random
+import time
+from urllib.parse import urlsplit
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.httpobj import urlparse_cached
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from .archive import PageArchive
+from .items import ListingCountItem
+from .page_cache import CACHED_HEADERS, PageCache
+
 
 class HousecrawlerSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +114,541 @@ class HousecrawlerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+def is_captcha_url(url):
+    return "captcha" in url or "hip.ke.com" in url
+
+
+def is_ban_response(response, request=None):
+    """
+    Check whether Beike refused to serve the page: a 418 response, a
+    redirect to the captcha page, or a short page with the captcha text
+    :param request: The request of the response, the redirects to the captcha
+                    page are followed by RedirectMiddleware before the other
+                    middlewares see them, so its captcha page is a ban
+    """
+    if response.status == 418:
+        return True
+    if request is not None and request.meta.get("redirect_urls") and is_captcha_url(response.url):
+        return True
+    if response.status in (301, 302, 303, 307):
+        location = response.headers.get(b"Location", b"").decode("latin-1")
+        return is_captcha_url(location)
+    body = getattr(response, "body", b"")
+    # Ban pages are short, don't scan the real pages
+    if len(body) < 16 * 1024 and ("人机验证".encode("utf-8") in body or b"captcha" in body):
+        return True
+    return False
+
+
+class HostThrottleState:
+    """
+    The throttle of one downloader slot, i.e. one *.ke.com host
+    """
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.clean_count = 0
+
+
+class BanAwareThrottleMiddleware:
+    """
+    Throttle each *.ke.com host on its own, based on the bans it returns.
+      - On a ban page the delay of the host is doubled (from BAN_BACKOFF_START
+        up to BAN_BACKOFF_MAX seconds) and its concurrency is halved, then the
+        request is retried with jitter, up to BAN_RETRY_TIMES times.
+      - After THROTTLE_RECOVER_AFTER clean responses in a row the delay is
+        halved and the concurrency raised by one, up to THROTTLE_MAX_CONCURRENCY.
+    So each city gets the highest rate it can take without being banned,
+    instead of one fixed global rate. The state of each host is kept here and
+    applied to its downloader slot when a request reaches the downloader, as
+    the downloader drops its idle slots and makes new ones without the backoff.
+    """
+    # The redirects dropped from a ban retry, which requests the page itself again
+    REDIRECT_META = ("redirect_urls", "redirect_reasons", "redirect_times", "redirect_ttl")
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.retry_times = settings.getint("BAN_RETRY_TIMES", 3)
+        self.backoff_start = settings.getfloat("BAN_BACKOFF_START", 5.0)
+        self.backoff_max = settings.getfloat("BAN_BACKOFF_MAX", 300.0)
+        self.min_delay = settings.getfloat("DOWNLOAD_DELAY", 0.0)
+        self.start_concurrency = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN", 8)
+        self.max_concurrency = settings.getint("THROTTLE_MAX_CONCURRENCY", 2 * self.start_concurrency)
+        self.recover_after = settings.getint("THROTTLE_RECOVER_AFTER", 5)
+        self.states = dict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # This method is used by Scrapy to create your spiders.
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.request_reached_downloader, signal=signals.request_reached_downloader)
+        return s
+
+    @staticmethod
+    def get_slot_key(request):
+        # The same key as the downloader uses for its slots, of the page
+        # requested before any redirect (e.g. to the captcha page)
+        return request.meta.get("throttle_slot") or request.meta.get("download_slot") or \
+            urlparse_cached(request).hostname or ""
+
+    def get_state(self, key):
+        if key not in self.states:
+            self.states[key] = HostThrottleState(self.min_delay, self.start_concurrency)
+        return self.states[key]
+
+    def apply_state(self, key, state):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.delay = state.delay
+            slot.concurrency = state.concurrency
+
+    def request_reached_downloader(self, request, spider):
+        # The downloader has set download_slot, and made the slot if it had none
+        if not request.meta.get("redirect_urls"):
+            request.meta["throttle_slot"] = request.meta.get("download_slot")
+        key = self.get_slot_key(request)
+        if key in self.states:
+            self.apply_state(key, self.states[key])
+
+    def process_request(self, request, spider):
+        return None
+
+    def process_response(self, request, response, spider):
+        key = self.get_slot_key(request)
+        state = self.get_state(key)
+        stats = self.crawler.stats
+
+        if not is_ban_response(response, request):
+            if 200 <= response.status < 300:
+                state.clean_count += 1
+                if state.clean_count >= self.recover_after:
+                    state.clean_count = 0
+                    state.delay = max(self.min_delay, state.delay / 2.0 if state.delay > 0.1 else 0.0)
+                    state.concurrency = min(self.max_concurrency, state.concurrency + 1)
+                    self.apply_state(key, state)
+            return response
+
+        # Back off this host only, with jitter so the retries of the hosts don't line up
+        state.clean_count = 0
+        state.delay = min(self.backoff_max, max(self.backoff_start, state.delay * 2.0) * random.uniform(1.0, 1.5))
+        state.concurrency = max(1, state.concurrency // 2)
+        self.apply_state(key, state)
+        stats.inc_value(f"housecrawler/ban/{key}")
+
+        retries = request.meta.get("ban_retry_times", 0) + 1
+        if retries > self.retry_times:
+            spider.logger.warning(f"Banned by {key}, gave up after {self.retry_times} retries: {request.url}")
+            stats.inc_value("housecrawler/ban_gave_up")
+            return response
+
+        spider.logger.info(f"Banned by {key}, retry {retries} in about {state.delay:.1f}s: {request.url}")
+        stats.inc_value("housecrawler/ban_retry")
+        # The page itself, not the captcha page it was redirected to
+        retry_req = request.replace(url=request.meta.get("redirect_urls", [request.url])[0])
+        for name in self.REDIRECT_META:
+            retry_req.meta.pop(name, None)
+        retry_req.meta["ban_retry_times"] = retries
+        retry_req.dont_filter = True
+        return retry_req
+
+    def process_exception(self, request, exception, spider):
+        pass
+
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class ProxyState:
+    """
+    The health of one proxy of the pool, over all the hosts
+    """
+    def __init__(self, url):
+        self.url = url
+        # host:port, the credentials are kept out of the slots, stats and logs
+        self.key = urlsplit(url).netloc.rpartition("@")[2]
+        # Moving averages of the latency (seconds) and of the failures (bans
+        # and errors count 1, clean responses 0)
+        self.latency = None
+        self.fail_rate = 0.0
+        self.requests = 0
+        self.bans = 0
+        self.errors = 0
+        # Evicted until this time (time.monotonic()), for longer each time
+        self.evicted_until = 0.0
+        self.evictions = 0
+
+    def is_evicted(self, now):
+        return self.evicted_until > now
+
+    def get_score(self, default_latency):
+        """
+        Higher is better: the share of clean responses per second of latency
+        """
+        latency = self.latency if self.latency is not None else default_latency
+        return (1.0 - self.fail_rate) / max(latency, 0.001)
+
+
+class ProxyPoolMiddleware:
+    """
+    Rotate the requests over a pool of proxies (PROXY_POOL, a list of URLs, or
+    PROXY_POOL_FILE, one URL per line), so the rate of the crawl is not capped
+    by what Beike takes from one IP.
+      - Each host is pinned to PROXY_PER_HOST proxies of the pool (0 for all of
+        them), so a host sees a few stable IPs. The requests to a host go to
+        its pinned proxies in turn, weighted by their scores and the requests in
+        flight.
+      - Each (host, proxy) is a downloader slot of its own, so the delay, the
+        concurrency and the ban backoff of BanAwareThrottleMiddleware are per
+        IP, and the rate a host takes grows with the number of its proxies.
+      - A proxy is scored by the moving averages of its latency and of its
+        failure rate (bans and errors). A proxy banned by a host is unpinned
+        from it for PROXY_HOST_BAN_SECONDS. A proxy failing more than
+        PROXY_EVICT_FAIL_RATE of its requests (after PROXY_EVICT_MIN_REQUESTS)
+        is evicted from the pool for PROXY_EVICT_SECONDS, doubled at each
+        eviction, then it gets another chance.
+    """
+
+    def __init__(self, crawler, proxy_urls):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.proxies = [ProxyState(url) for url in proxy_urls]
+        self.by_key = {p.key: p for p in self.proxies}
+        self.per_host = settings.getint("PROXY_PER_HOST", 0)
+        self.alpha = settings.getfloat("PROXY_SCORE_ALPHA", 0.2)
+        self.evict_fail_rate = settings.getfloat("PROXY_EVICT_FAIL_RATE", 0.5)
+        self.evict_min_requests = settings.getint("PROXY_EVICT_MIN_REQUESTS", 5)
+        self.evict_seconds = settings.getfloat("PROXY_EVICT_SECONDS", 60.0)
+        self.evict_max_seconds = settings.getfloat("PROXY_EVICT_MAX_SECONDS", 1800.0)
+        self.host_ban_seconds = settings.getfloat("PROXY_HOST_BAN_SECONDS", 300.0)
+        self.scale_concurrency = settings.getbool("PROXY_SCALE_CONCURRENCY", True)
+        # host -> the proxies pinned to it, (host, proxy key) -> end of its ban
+        self.pins = dict()
+        self.host_bans = dict()
+        self.in_flight = dict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        proxy_urls = crawler.settings.getlist("PROXY_POOL")
+        fname = crawler.settings.get("PROXY_POOL_FILE")
+        if fname:
+            with open(fname, "r", encoding="utf-8") as fp:
+                proxy_urls.extend(line.strip() for line in fp if line.strip() and not line.startswith("#"))
+        if not proxy_urls:
+            raise NotConfigured
+        s = cls(crawler, list(dict.fromkeys(proxy_urls)))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def get_default_latency(self):
+        latencies = [p.latency for p in self.proxies if p.latency is not None]
+        return sum(latencies) / len(latencies) if latencies else 1.0
+
+    def is_usable(self, proxy, host, now):
+        return not proxy.is_evicted(now) and self.host_bans.get((host, proxy.key), 0.0) <= now
+
+    def get_pins(self, host, now):
+        """
+        :return: The usable proxies pinned to a host, the proxies evicted or
+                 banned by the host are replaced by the usable proxies pinned
+                 to the fewest hosts
+        """
+        size = self.per_host if 0 < self.per_host < len(self.proxies) else len(self.proxies)
+        pins = [p for p in self.pins.get(host, []) if self.is_usable(p, host, now)]
+        if len(pins) < size:
+            npinned = dict()
+            for pinned in self.pins.values():
+                for p in pinned:
+                    npinned[p.key] = npinned.get(p.key, 0) + 1
+            default_latency = self.get_default_latency()
+            free = [p for p in self.proxies if p not in pins and self.is_usable(p, host, now)]
+            free.sort(key=lambda p: (npinned.get(p.key, 0), -p.get_score(default_latency)))
+            pins.extend(free[:size - len(pins)])
+        self.pins[host] = pins
+        return pins
+
+    def choose_proxy(self, host):
+        now = time.monotonic()
+        pins = self.get_pins(host, now)
+        if not pins:
+            # Every proxy is evicted or banned by the host, take the one which
+            # would be back first rather than stopping the crawl
+            return min(self.proxies, key=lambda p: max(p.evicted_until, self.host_bans.get((host, p.key), 0.0)))
+        # Rotate over the pins, the healthy and idle ones more often
+        default_latency = self.get_default_latency()
+        weights = [p.get_score(default_latency) / (1 + self.in_flight.get((host, p.key), 0)) for p in pins]
+        return random.choices(pins, weights)[0]
+
+    def get_proxy(self, request):
+        return self.by_key.get(request.meta.get("proxy_pool_key"))
+
+    def end_request(self, request, proxy):
+        host = urlparse_cached(request).hostname or ""
+        slot = (host, proxy.key)
+        if self.in_flight.get(slot, 0) > 0:
+            self.in_flight[slot] -= 1
+        return host
+
+    def record(self, proxy, failed, latency=None):
+        proxy.requests += 1
+        proxy.fail_rate += self.alpha * ((1.0 if failed else 0.0) - proxy.fail_rate)
+        if latency is not None:
+            proxy.latency = latency if proxy.latency is None else proxy.latency + self.alpha * (latency - proxy.latency)
+
+    def evict_if_bad(self, proxy, spider):
+        if proxy.requests < self.evict_min_requests or proxy.fail_rate <= self.evict_fail_rate:
+            return
+        seconds = min(self.evict_max_seconds, self.evict_seconds * 2 ** proxy.evictions)
+        proxy.evictions += 1
+        proxy.evicted_until = time.monotonic() + seconds
+        # Start over when it is back, a bad proxy is evicted again after a few requests
+        proxy.requests = 0
+        proxy.fail_rate = 0.0
+        self.crawler.stats.inc_value("housecrawler/proxy/evicted")
+        spider.logger.warning(f"Proxy {proxy.key} evicted for {seconds:.0f}s "
+                              f"({proxy.bans} bans, {proxy.errors} errors so far)")
+
+    def process_request(self, request, spider):
+        host = urlparse_cached(request).hostname or ""
+        proxy = self.choose_proxy(host)
+        slot = (host, proxy.key)
+        self.in_flight[slot] = self.in_flight.get(slot, 0) + 1
+        request.meta["proxy"] = proxy.url
+        request.meta["proxy_pool_key"] = proxy.key
+        request.meta["download_slot"] = f"{host}@{proxy.key}"
+        return None
+
+    def process_response(self, request, response, spider):
+        proxy = self.get_proxy(request)
+        if proxy is None:
+            return response
+        host = self.end_request(request, proxy)
+        stats = self.crawler.stats
+
+        if is_ban_response(response, request):
+            proxy.bans += 1
+            self.record(proxy, True)
+            # This IP is banned by the host, the retry goes through another proxy
+            self.host_bans[(host, proxy.key)] = time.monotonic() + self.host_ban_seconds
+            stats.inc_value(f"housecrawler/proxy/{proxy.key}/bans")
+            self.evict_if_bad(proxy, spider)
+        elif response.status >= 500 or response.status == 407:
+            proxy.errors += 1
+            self.record(proxy, True)
+            stats.inc_value(f"housecrawler/proxy/{proxy.key}/errors")
+            self.evict_if_bad(proxy, spider)
+        else:
+            self.record(proxy, False, request.meta.get("download_latency"))
+        stats.inc_value(f"housecrawler/proxy/{proxy.key}/responses")
+        return response
+
+    def process_exception(self, request, exception, spider):
+        proxy = self.get_proxy(request)
+        if proxy is None:
+            return None
+        self.end_request(request, proxy)
+        proxy.errors += 1
+        self.record(proxy, True)
+        self.crawler.stats.inc_value(f"housecrawler/proxy/{proxy.key}/errors")
+        self.evict_if_bad(proxy, spider)
+        # RetryMiddleware retries the request, through another proxy if this one is evicted
+        return None
+
+    def spider_opened(self, spider):
+        spider.logger.info(f"Rotate the requests over {len(self.proxies)} proxies")
+        if self.scale_concurrency:
+            # Each proxy is another IP, so the requests in flight can grow with the pool
+            downloader = self.crawler.engine.downloader
+            downloader.total_concurrency = self.crawler.settings.getint("CONCURRENT_REQUESTS") * len(self.proxies)
+
+    def spider_closed(self, spider):
+        default_latency = self.get_default_latency()
+        for proxy in sorted(self.proxies, key=lambda p: -p.get_score(default_latency)):
+            latency = f"{proxy.latency * 1000.0:.0f}ms" if proxy.latency is not None else "-"
+            spider.logger.info(f"Proxy {proxy.key}: latency {latency}, {proxy.bans} bans, {proxy.errors} errors, "
+                               f"evicted {proxy.evictions} times")
+
+
+class PageArchiveMiddleware:
+    """
+    Keep the body of every page fetched by the spider in the content-addressed
+    archive (see archive.PageArchive), under the timestamp of the run, so the
+    numbers of a run can be recomputed from its pages later (see "scrapy reparse").
+    The archive is in ARCHIVE_DIR, default is the "archive" directory in the
+    data directory of the spider. Ban pages and errors are not archived.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.archive_dir = settings.get("ARCHIVE_DIR")
+        self.segment_max_bytes = settings.getint("ARCHIVE_SEGMENT_MAX_BYTES", 64 * 1024 * 1024)
+        self.archive = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ARCHIVE_ENABLED"):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        return None
+
+    def process_response(self, request, response, spider):
+        if self.archive is None or response.status != 200 or is_ban_response(response, request):
+            return response
+        if not isinstance(response, TextResponse):
+            return response
+
+        city = request.meta.get("city") or spider.get_url_city(response.url)
+        level = request.meta.get("level", "city")
+        partial = "download_stopped" in response.flags
+        digest = self.archive.put(spider.get_run_ts(), city, response.url, response.body, level,
+                                  response.status, partial)
+        self.crawler.stats.inc_value("housecrawler/archive/pages")
+        request.meta["archive_hash"] = digest
+        return response
+
+    def spider_opened(self, spider):
+        archive_dir = self.archive_dir
+        if not archive_dir:
+            archive_dir = os.path.join(spider.ssdk.data_dir, "archive")
+        self.archive = PageArchive(archive_dir, self.segment_max_bytes)
+        spider.logger.info(f"Archive the fetched pages in {archive_dir}")
+
+    def spider_closed(self, spider):
+        if self.archive is None:
+            return
+        npage, nblob, raw_bytes, stored_bytes = self.archive.get_stats()
+        spider.logger.info(f"Archive: {npage} pages, {nblob} unique bodies, "
+                           f"{raw_bytes} bytes stored in {stored_bytes} bytes")
+        self.archive.close()
+        self.archive = None
+
+
+class PageCacheMiddleware:
+    """
+    Revalidate the pages instead of downloading them again (PAGE_CACHE_MODE
+    "revalidate"), or serve them from the cache without any request
+    (PAGE_CACHE_MODE "replay", for development and the benchmarks).
+      - revalidate: the last response of each page is kept (see
+        page_cache.PageCache) and sent again with If-None-Match and
+        If-Modified-Since from its ETag and Last-Modified. On 304 Not
+        Modified the cached response is passed on, with the total number
+        extracted from it last time in response.meta["cached_total_num"].
+      - replay: every page is served from the cache, a page not in it is
+        ignored.
+    The cache is in PAGE_CACHE_DIR, default is the "page_cache" directory in
+    the data directory of the spider. It is before HttpCompressionMiddleware
+    (590), so the bodies are cached as received, and the pages served from
+    the cache are still archived by PageArchiveMiddleware.
+    """
+    MODES = ["revalidate", "replay"]
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.cache_dir = settings.get("PAGE_CACHE_DIR")
+        self.mode = settings.get("PAGE_CACHE_MODE", "revalidate")
+        if self.mode not in self.MODES:
+            raise ValueError(f"Unknown PAGE_CACHE_MODE {self.mode}, should be one of {self.MODES}")
+        self.cache = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PAGE_CACHE_ENABLED") and crawler.settings.get("PAGE_CACHE_MODE") != "replay":
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        return s
+
+    def make_cached_response(self, request, page, flag):
+        """
+        :return: The response of a cached page, of the type given by its headers
+        """
+        body = self.cache.get_body(page)
+        if body is None:
+            return None
+        headers = Headers(page["headers"])
+        respcls = responsetypes.from_args(headers=headers, url=page["url"], body=body)
+        flags = ["cached", flag] + (["download_stopped"] if page["partial"] else [])
+        return respcls(url=request.url, status=page["status"], headers=headers, body=body, flags=flags,
+                       request=request)
+
+    def process_request(self, request, spider):
+        page = self.cache.get(request.url)
+        if self.mode == "replay":
+            response = self.make_cached_response(request, page, "replayed") if page is not None else None
+            if response is None:
+                self.crawler.stats.inc_value("housecrawler/page_cache/miss")
+                raise IgnoreRequest(f"Not in the page cache: {request.url}")
+            self.crawler.stats.inc_value("housecrawler/page_cache/replayed")
+            return response
+
+        if page is not None:
+            if page["etag"]:
+                request.headers[b"If-None-Match"] = page["etag"]
+            if page["last_modified"]:
+                request.headers[b"If-Modified-Since"] = page["last_modified"]
+        return None
+
+    def process_response(self, request, response, spider):
+        if "cached" in response.flags:
+            return response
+        stats = self.crawler.stats
+
+        if response.status == 304:
+            page = self.cache.get(request.url)
+            cached = self.make_cached_response(request, page, "revalidated") if page is not None else None
+            if cached is None:
+                # The page left the cache, fetch it again
+                stats.inc_value("housecrawler/page_cache/lost")
+                retry_req = request.copy()
+                retry_req.headers.pop(b"If-None-Match", None)
+                retry_req.headers.pop(b"If-Modified-Since", None)
+                retry_req.dont_filter = True
+                return retry_req
+            if page["total_num"] is not None:
+                request.meta["cached_total_num"] = page["total_num"]
+            stats.inc_value("housecrawler/page_cache/not_modified")
+            return cached
+
+        if response.status == 200 and not is_ban_response(response, request):
+            headers = dict()
+            for name in CACHED_HEADERS:
+                value = response.headers.get(name)
+                if value is not None:
+                    headers[name] = value.decode("latin-1")
+            self.cache.put(request.url, response.status, headers, response.body,
+                           "download_stopped" in response.flags)
+            stats.inc_value("housecrawler/page_cache/stored")
+        return response
+
+    def item_scraped(self, item, response, spider):
+        # The total number of a page, reused when the page is not modified
+        if self.cache is not None and isinstance(item, ListingCountItem) and self.mode == "revalidate":
+            self.cache.set_total_num(item["url"], item["total_num"])
+
+    def spider_opened(self, spider):
+        cache_dir = self.cache_dir
+        if not cache_dir:
+            cache_dir = os.path.join(spider.ssdk.data_dir, "page_cache")
+        self.cache = PageCache(cache_dir)
+        spider.logger.info(f"Page cache in {cache_dir}, mode {self.mode}")
+
+    def spider_closed(self, spider):
+        if self.cache is None:
+            return
+        npage, nvalidated = self.cache.get_stats()
+        spider.logger.info(f"Page cache: {npage} pages, {nvalidated} with an ETag or Last-Modified")
+        self.cache.close()
+        self.cache = None
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# The locks held by each thread, lock file name -> [file object, depth]
+_held = threading.local()
+
+
+def lock_file(fp, blocking):
+    """
+    Lock an open lock file exclusively
+    :raise OSError: If not blocking and the file is locked by someone else
+    """
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        # msvcrt locks a byte range, the first byte stands for the whole file.
+        # Its blocking mode gives up after 10 seconds, so always poll
+        fp.seek(0)
+        msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def unlock_file(fp):
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+    else:
+        fp.seek(0)
+        msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FileLock:
+    """
+    An exclusive lock of an output file across processes and threads, e.g.
+
+        with FileLock(fname):
+            ... read, modify and write fname ...
+
+    The lock is held on a sidecar file "<fname>.lock" (flock on POSIX,
+    msvcrt.locking on Windows), which is never removed, so the output file
+    itself can be replaced while the lock is held. The lock is reentrant in
+    a thread, a step holding it can call another step which takes it again.
+    """
+    def __init__(self, fname, timeout=None, poll_interval=0.05):
+        self.lock_fname = os.path.abspath(fname) + ".lock"
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def get_held():
+        if not hasattr(_held, "locks"):
+            _held.locks = dict()
+        return _held.locks
+
+    def acquire(self):
+        held = self.get_held()
+        if self.lock_fname in held:
+            held[self.lock_fname][1] += 1
+            return
+
+        os.makedirs(os.path.dirname(self.lock_fname), exist_ok=True)
+        fp = open(self.lock_fname, "a+b")
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                lock_file(fp, blocking=(fcntl is not None and deadline is None))
+                break
+            except OSError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    fp.close()
+                    raise TimeoutError(f"Timed out waiting for the lock {self.lock_fname}")
+                time.sleep(self.poll_interval)
+        held[self.lock_fname] = [fp, 1]
+
+    def release(self):
+        held = self.get_held()
+        entry = held[self.lock_fname]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del held[self.lock_fname]
+            try:
+                unlock_file(entry[0])
+            finally:
+                entry[0].close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def get_umask():
+    """
+    :return: The umask of the process, os.umask() can only be read by setting it
+    """
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# Read once, setting the umask is not thread safe and the output steps may run in a thread
+UMASK = get_umask()
+
+
+def fsync_dir(dirname):
+    """
+    Make a rename in a directory durable, where the OS allows opening a directory
+    """
+    if os.name != "posix":
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_output(fname, mode="wb", encoding=None):
+    """
+    Write a file as a whole or not at all, e.g.
+
+        with atomic_output(fname) as fp:
+            fp.write(data)
+
+    The data is written to a unique temp file in the same directory, synced
+    to the disk and renamed over the file. If the block raises, the temp file
+    is removed and the file is left as it was. Readers see either the old or
+    the new file, writers should also hold a FileLock of the file.
+    """
+    fdir = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(fdir, exist_ok=True)
+    fd, tmpfname = tempfile.mkstemp(prefix=f".{os.path.basename(fname)}.", suffix=".tmp", dir=fdir)
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+        if os.path.exists(fname):
+            shutil.copymode(fname, tmpfname)
+        else:
+            # mkstemp() makes the temp file 0600, a new file gets the mode open() would give it
+            os.chmod(tmpfname, 0o666 & ~UMASK)
+        os.replace(tmpfname, fname)
+    except BaseException:
+        if os.path.exists(tmpfname):
+            os.remove(tmpfname)
+        raise
+    fsync_dir(fdir)
+
+
+def write_atomically(fname, data, lock=True):
+    """
+    Replace a file with bytes, see atomic_output()
+    :param lock: Hold the FileLock of the file while writing
+    """
+    if lock:
+        with FileLock(fname):
+            write_atomically(fname, data, lock=False)
+        return
+    with atomic_output(fname) as fp:
+        fp.write(data)
@@ -0,0 +1,109 @@
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+from .archive import PageArchive
+
+# The response headers kept with a cached page, enough to rebuild the response
+CACHED_HEADERS = ("Content-Type", "Content-Encoding", "ETag", "Last-Modified")
+
+
+class PageCache:
+    """
+    The last response of each page, for conditional requests and offline replay.
+    The index (cache.sqlite3) maps each page (its URL without the scheme, so
+    the pages fetched through the mirror proxy by http:// are the same) to
+    its validators (ETag, Last-Modified), the headers and the hash of its
+    body, and the total number extracted from it. The bodies are kept as
+    received (still compressed by the server) in a PageArchive in the same
+    directory, so an unchanged page is stored once.
+    """
+    INDEX_FNAME = "cache.sqlite3"
+    # Seconds to wait for another process writing to the index
+    BUSY_TIMEOUT = 60.0
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.bodies = PageArchive(cache_dir)
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(self.cache_dir, self.INDEX_FNAME), timeout=self.BUSY_TIMEOUT)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS pages ("
+                    " key TEXT PRIMARY KEY,"
+                    " url TEXT NOT NULL,"
+                    " status INTEGER NOT NULL,"
+                    " headers TEXT NOT NULL,"
+                    " etag TEXT,"
+                    " last_modified TEXT,"
+                    " hash TEXT NOT NULL,"
+                    " partial INTEGER NOT NULL DEFAULT 0,"
+                    " total_num INTEGER,"
+                    " fetched TEXT NOT NULL)")
+        return self.conn
+
+    @staticmethod
+    def get_key(url):
+        return url.split("://", 1)[-1]
+
+    def get(self, url):
+        """
+        :return: A dict of the cached page of a URL (without the body), or None
+        """
+        cursor = self.connect().execute(
+            "SELECT url, status, headers, etag, last_modified, hash, partial, total_num, fetched"
+            " FROM pages WHERE key = ?", (self.get_key(url),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        page = dict(zip(("url", "status", "headers", "etag", "last_modified", "hash", "partial", "total_num",
+                         "fetched"), row))
+        page["headers"] = json.loads(page["headers"])
+        return page
+
+    def get_body(self, page):
+        return self.bodies.get(page["hash"])
+
+    def put(self, url, status, headers, body, partial=False):
+        """
+        Cache a response, replacing the last one of the URL
+        :param headers: A dict of the headers in CACHED_HEADERS
+        """
+        digest = self.bodies.put_body(body)
+        conn = self.connect()
+        with conn:
+            # The total number is of the last body, it is set again by set_total_num()
+            conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+                         " (SELECT total_num FROM pages WHERE key = ? AND hash = ?), ?)",
+                         (self.get_key(url), url, status, json.dumps(headers), headers.get("ETag"),
+                          headers.get("Last-Modified"), digest, int(partial), self.get_key(url), digest,
+                          datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        return digest
+
+    def set_total_num(self, url, total_num):
+        """
+        Keep the total number extracted from the cached page of a URL
+        """
+        conn = self.connect()
+        with conn:
+            conn.execute("UPDATE pages SET total_num = ? WHERE key = ?", (total_num, self.get_key(url)))
+
+    def get_stats(self):
+        """
+        :return: (number of pages, number with validators)
+        """
+        return self.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(etag IS NOT NULL OR last_modified IS NOT NULL), 0) FROM pages").fetchone()
+
+    def close(self):
+        self.bodies.close()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -7,7 +7,152 @@
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+import time
+from array import array
+
+from twisted.internet import task
+
+from .items import HousecrawlerItem, ListingCountItem
+from .history_store import SQLiteHistoryStore
+from .listing_index import ListingIdIndex
+from .metrics import run_saved
+
 
 class HousecrawlerPipeline:
+    """
+    Stream the items to the SQLite history stores in batches.
+    Items are buffered and written in one transaction every PIPELINE_FLUSH_ITEMS
+    items, or every PIPELINE_FLUSH_SECONDS seconds, whichever comes first, so
+    the memory used doesn't grow with the number of listings crawled.
+      - ListingCountItem: table area_counts, of the history of its market
+      - HousecrawlerItem: table listings, of the resale history
+    The listing IDs of each city are collected as compact arrays, and at the
+    end of each run (run_saved, also in the daemon mode) they are diffed
+    against the listing ID index to find the new and the delisted homes
+    (table listing_changes). The delisted homes are only found for the cities
+    crawled completely, see commit_listing_ids().
+    """
+    def __init__(self, flush_items=500, flush_seconds=5.0):
+        self.flush_items = flush_items
+        self.flush_seconds = flush_seconds
+        self.store = None
+        # The stores of the other markets, and the area counts of each market
+        self.market_stores = dict()
+        self.area_counts = dict()
+        self.listings = []
+        self.last_flush = time.monotonic()
+        self.flush_loop = None
+        # The listing IDs of each city, keyed by the run, so that the runs of
+        # the daemon mode are committed one by one
+        self.listing_ids = dict()
+        # The total number of listings of each city of each run, of the market with listings
+        self.city_totals = dict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings.getint("PIPELINE_FLUSH_ITEMS", 500),
+                       crawler.settings.getfloat("PIPELINE_FLUSH_SECONDS", 5.0))
+        crawler.signals.connect(pipeline.run_saved, signal=run_saved)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.store = SQLiteHistoryStore(spider.get_market_run("resale").ssdk.history_fname, spider.city_name_list)
+        self.spider = spider
+        # Flush when items arrive slowly, too
+        self.flush_loop = task.LoopingCall(self.flush_if_due)
+        self.flush_loop.start(self.flush_seconds, now=False)
+
     def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        if isinstance(item, HousecrawlerItem):
+            self.listings.append(tuple(adapter.get(k) for k in (
+                "ts", "city", "listing_id", "district", "bizcircle",
+                "title", "total_price", "unit_price", "area", "url")))
+            int_id = ListingIdIndex.to_int_id(adapter["listing_id"])
+            if int_id is not None:
+                run_ids = self.listing_ids.setdefault(adapter["ts"], dict())
+                run_ids.setdefault(adapter["city"], array(ListingIdIndex.ITEM_TYPE)).append(int_id)
+        elif isinstance(item, ListingCountItem):
+            if adapter["level"] == "city" and (adapter.get("market") or "resale") == "resale":
+                self.city_totals.setdefault(adapter["ts"], dict())[adapter["city"]] = adapter["total_num"]
+            self.area_counts.setdefault(adapter.get("market") or "resale", []).append((
+                adapter["ts"], adapter["city"], adapter["level"], adapter.get("district", ""),
+                adapter.get("bizcircle", ""), adapter["total_num"], adapter.get("url")))
+        else:
+            return item
+
+        if len(self.listings) + sum(len(counts) for counts in self.area_counts.values()) >= self.flush_items:
+            self.flush()
         return item
+
+    def flush_if_due(self):
+        if time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def get_market_store(self, market):
+        if market == "resale":
+            return self.store
+        if market not in self.market_stores:
+            self.market_stores[market] = SQLiteHistoryStore(
+                self.spider.get_market_run(market).ssdk.history_fname, self.spider.city_name_list)
+        return self.market_stores[market]
+
+    def flush(self):
+        for market, counts in self.area_counts.items():
+            if counts:
+                self.get_market_store(market).append_area_counts(counts)
+        self.area_counts = dict()
+        if self.listings:
+            self.store.append_listings(self.listings)
+            self.listings = []
+        self.last_flush = time.monotonic()
+
+    def commit_listing_ids(self, spider, run_ts=None):
+        """
+        Diff the listing IDs of a run against the listing ID index, and drop them.
+        The crawl of a city is complete if none of its pages is missed and its
+        IDs are as many as its total number (Beike lists 100 pages at most),
+        otherwise the IDs are a partial snapshot, which finds no delisted homes
+        :param run_ts: The run, by default every run not committed yet
+        """
+        runs = [run_ts] if run_ts is not None else sorted(set(self.listing_ids) | set(self.city_totals))
+        index = ListingIdIndex(spider.ssdk.data_dir + "/listing_ids")
+        for ts in runs:
+            totals = self.city_totals.pop(ts, dict())
+            incomplete = spider.take_incomplete_listing_cities(ts)
+            for city, ids in self.listing_ids.pop(ts, dict()).items():
+                nids = len(set(ids))
+                partial = city in incomplete or nids != totals.get(city)
+                if partial:
+                    print(f"[PYRAD] {city}: Partial listing crawl, {nids} of {totals.get(city)} listings"
+                          f"{' with pages missed' if city in incomplete else ''}")
+                added, removed = index.commit_snapshot(city, ids, partial=partial)
+                changes = [(ts, city, str(i), "new") for i in added]
+                changes.extend((ts, city, str(i), "delisted") for i in removed)
+                self.store.append_listing_changes(changes)
+                print(f"[PYRAD] {city}: {len(added)} new and {len(removed)} delisted listings")
+
+    def run_saved(self, run_time):
+        """
+        Commit the listing IDs of a run when its output steps are done, so the
+        daemon mode keeps the IDs of one run only. In a single run the spider
+        is closed first, and close_spider() commits them
+        """
+        if self.store is None or getattr(self.spider, "frontier", None) is not None:
+            return
+        self.flush()
+        self.commit_listing_ids(self.spider, run_time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def close_spider(self, spider):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        if getattr(spider, "frontier", None) is None:
+            self.commit_listing_ids(spider)
+        elif self.listing_ids:
+            # A worker of a sharded crawl sees a part of the listings of a city only
+            print(f"[PYRAD] The listing ID index is not updated by a sharded crawl")
+        for store in self.market_stores.values():
+            store.close()
+        self.store.close()
+        self.store = None
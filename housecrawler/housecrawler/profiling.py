@@ -0,0 +1,184 @@
+import functools
+import marshal
+import os
+import random
+import sys
+import threading
+from collections import Counter
+
+from .output_commit import FileLock, atomic_output
+
+# The profiler of the process, set by ProfilingExtension when PROFILE_ENABLED is on
+_profiler = None
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def profiled(stage):
+    """
+    Profile the calls of a function as a stage, e.g.
+
+        @profiled("parse")
+        def parse(self, response):
+            ...
+
+    Nothing is done but one check when no profiler is set
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            return profiler.run(stage, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """
+    Profile the stages of production runs (see profiled()), in one of 2 modes,
+      - "cprofile": a deterministic profile of a random sample of the calls of
+        each stage, sample_rate is the fraction of calls profiled. The
+        profiles are written as <stage>.pstats
+      - "sample": a thread takes the stack of each thread running a stage
+        sample_hz times per second. The stacks are written in the collapsed
+        format (<stage>.folded), for flamegraph.pl or speedscope
+    A stage called inside another stage (e.g. the output steps inside
+    "closed") has a profile of its own, which is also a part of the profiles
+    of the stages around it. In the "cprofile" mode the outer profile is
+    paused while the inner one runs, so its functions get the time of the
+    inner stage, but the calls from the outer stage into it are not linked.
+    """
+    MODES = ["cprofile", "sample"]
+
+    def __init__(self, mode="cprofile", sample_rate=1.0, sample_hz=100.0):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profile mode {mode}, should be one of {self.MODES}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.sample_hz = sample_hz
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # The profiles of each stage since the last dump
+        self.stats = dict()
+        self.stacks = dict()
+        # Thread ID -> the stages it is running, the outermost first, for the "sample" mode
+        self.active = dict()
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.mode == "sample" and self.sampler is None:
+            self.stopped.clear()
+            self.sampler = threading.Thread(target=self.sample_loop, name="housecrawler-profiler", daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def run(self, stage, func, args, kwargs):
+        if self.mode == "cprofile":
+            if random.random() >= self.sample_rate:
+                return func(*args, **kwargs)
+            import cProfile
+
+            # The (stage, profile) of the stages this call is nested in, one
+            # profiler can run at a time, the innermost
+            outer = getattr(self.local, "profiles", None) or []
+            if outer:
+                outer[-1][1].disable()
+            prof = cProfile.Profile()
+            self.local.profiles = outer + [(stage, prof)]
+            try:
+                return prof.runcall(func, *args, **kwargs)
+            finally:
+                self.local.profiles = outer
+                self.add_profile([stage] + [outer_stage for outer_stage, _ in outer], prof)
+                if outer:
+                    outer[-1][1].enable()
+
+        tid = threading.get_ident()
+        outer = self.active.get(tid, ())
+        self.active[tid] = outer + (stage,)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if outer:
+                self.active[tid] = outer
+            else:
+                self.active.pop(tid, None)
+
+    def add_profile(self, stages, prof):
+        """
+        Add a profile to the profiles of the stages, of a stage and the ones it is nested in
+        """
+        import pstats
+
+        # The stats are taken out of the profile once
+        st = pstats.Stats(prof)
+        with self.lock:
+            for stage in stages:
+                if stage not in self.stats:
+                    self.stats[stage] = pstats.Stats()
+                self.stats[stage].add(st)
+
+    def sample_loop(self):
+        interval = 1.0 / self.sample_hz
+        while not self.stopped.wait(interval):
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            for tid, stages in list(self.active.items()):
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    stack.reverse()
+                    with self.lock:
+                        for stage in stages:
+                            self.stacks.setdefault(stage, Counter())[";".join(stack)] += 1
+
+    def dump(self, out_dir):
+        """
+        Write the profiles since the last dump to a directory, merged with
+        the profiles already in it, also by the other processes of a run
+        :return: The files written
+        """
+        with self.lock:
+            stats, self.stats = self.stats, dict()
+            stacks, self.stacks = self.stacks, dict()
+        if not stats and not stacks:
+            return []
+
+        os.makedirs(out_dir, exist_ok=True)
+        fnames = []
+        for stage, st in stats.items():
+            fname = os.path.join(out_dir, f"{stage}.pstats")
+            with FileLock(fname):
+                if os.path.isfile(fname):
+                    st.add(fname)
+                # The same as st.dump_stats(fname), through a temp file
+                with atomic_output(fname) as fp:
+                    marshal.dump(st.stats, fp)
+            fnames.append(fname)
+        for stage, counter in stacks.items():
+            fname = os.path.join(out_dir, f"{stage}.folded")
+            with FileLock(fname), open(fname, "a", encoding="utf-8") as fp:
+                for stack, count in counter.most_common():
+                    fp.write(f"{stack} {count}\n")
+            fnames.append(fname)
+        return fnames
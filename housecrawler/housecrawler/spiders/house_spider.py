@@ -1,15 +1,26 @@
 from pathlib import Path
 
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, StopDownload
 from datetime import datetime
-import platform
 import os
-import subprocess
+import math
 import re
-import pandas as pd
-import openpyxl
+import socket
+import time
 
 from .table_refresh import ResaleTableRefresh
+from ..city_registry import CityRegistry
+from ..analytics import get_history_analytics
+from ..data_dir import get_cpu_name, resolve_data_dir
+from ..history_store import load_history_backend, SQLiteHistoryStore
+from ..frontier import make_task, open_frontier
+from ..extract import extract_total_num, TotalNumScanner, extract_listings, extract_total_page
+from ..items import HousecrawlerItem, ListingCountItem
+from ..markets import get_market
+from ..metrics import Metrics, run_saved
+from ..profiling import profiled
 
 class CityInfoItem:
     """
@@ -33,8 +44,10 @@ class CityInfoList:
     """
     A contain to hold all the information of all cities
     """
-    def __init__(self):
+    def __init__(self, market=None):
         self.clist = []
+        # The file names are of the market, see markets.py
+        self.market = get_market(market)
 
     def add(self, city_name, url):
         cii = CityInfoItem(city_name, url)
@@ -52,32 +65,41 @@ class CityInfoList:
     def get_url_dict(self):
         return dict(zip(self.get_city_name_list(), self.get_city_url_list()))
 
-    def provideSpreadSheetFileName(self):
+    def provideSpreadSheetFileName(self, year=None):
         """
         Provide a xlsx file name to append data.
         The file name has the following format,
         cityDataYear{YearNumber}ReleaseNum{CityNum}.xlsx
+        (NewHomeNum or RentalNum for the other markets)
         """
         # Get this year number string
         dtime = datetime.now()
-        year_str = dtime.strftime("%Y")
+        year_str = dtime.strftime("%Y") if year is None else str(year)
         # Xlsx File name
-        fname = f"cityDataYear{year_str}ResaleNum{len(self.clist)}.xlsx"
+        fname = f"cityDataYear{year_str}{self.market.file_tag}Num{len(self.clist)}.xlsx"
         return fname
 
-    def provideMarkdownFileName(self):
+    def provideMarkdownFileName(self, year=None):
         """
         Provide a markdown file name to append data.
         The file name has the following format,
         releaseNum{YearNumber}.md
+        (newhomenumbers or rentalnumbers for the other markets)
         """
         # Get this year number string
         dtime = datetime.now()
-        year_str = dtime.strftime("%Y")
+        year_str = dtime.strftime("%Y") if year is None else str(year)
         # Markdown file name
-        fname = f"resalenumbers{year_str}.md"
+        fname = f"{self.market.file_tag.lower()}numbers{year_str}.md"
         return fname
 
+    def provideHistoryFileName(self):
+        """
+        Provide the file name of the SQLite history store.
+        All years are kept in the same file, spreadsheets of each year are
+        exported from it on request.
+        """
+        return f"city{self.market.file_tag}History.sqlite3"
 
 
 class SpreadsheetDataKeeper:
@@ -89,100 +111,59 @@ class SpreadsheetDataKeeper:
         :return: A string representing current machine's CPU name.
                  If not found, return an empty string
         """
-        if platform.system() == "Windows":
-            return platform.processor()
-        elif platform.system() == "Darwin":
-            os.environ['PATH'] = os.environ['PATH'] + os.pathsep + '/usr/sbin'
-            command = "sysctl -n machdep.cpu.brand_string"
-            return subprocess.check_output(command).strip()
-        elif platform.system() == "Linux":
-            command = "cat /proc/cpuinfo"
-            all_info = subprocess.check_output(command, shell=True).decode().strip()
-            for line in all_info.split("\n"):
-                if "model name" in line:
-                    return re.sub(".*model name.*:", "", line, 1)
-        return ""
+        return get_cpu_name()
 
     @staticmethod
     def get_data_dir_on_this_computer_by_cpu_name():
-        cur_is_win = platform.system() == "Windows"
-        cpu_name = "n/a"
-        if cur_is_win is True:
-            # Assume current it is running on Windows
-            # For win32com, refer to the link below
-            # https://learn.microsoft.com/zh-cn/windows/win32/cimwin32prov/win32-processor
-            from win32com.client import GetObject
-            root_winmgmts = GetObject("winmgmts:root\cimv2")
-            cpus = root_winmgmts.ExecQuery("Select * from Win32_Processor")
-            cpu_name = cpus[0].Name
-            cpu_name = cpu_name.strip()
-        else:
-            # Assume current it is running on Linux or other platforms
-            cpu_name = SpreadsheetDataKeeper.get_cpu_name()
-
-        # Different CPU names corresponds to different machines
-        MyAsusPCCpuName = 'Intel(R) Core(TM) i5-4570 CPU @ 3.20GHz'
-        MyLenovoCpuName = 'AMD Ryzen 5 3550H with Radeon Vega Mobile Gfx'
-        MySnpsCpuName = '11th Gen Intel(R) Core(TM) i7-1185G7 @ 3.00GHz'
-
-        # Relative directory for RealEstate Under Pyrad Notes directory
-        rdir = "source/RealEstate"
-
-        pyradnotes_dir = None
-        if cpu_name == MyAsusPCCpuName:
-            # If current PC is my ASUS computer
-            pyradnotes_dir = f"D:/Gitee/pyradnotes/{rdir}"
-        elif cpu_name == MyLenovoCpuName:
-            pyradnotes_dir = f"D:/Pyrad/Gitee/pyradnotes/{rdir}"
-        elif cpu_name == MySnpsCpuName:
-            # If current PC is my work computer from SNSP, don't do anything
-            pyradnotes_dir = ""
-        else:
-            print(f"Can't identify the CPU name ({cpu_name}) for this PC, please verify.")
+        # Cached, the CPU is probed only once per process, see data_dir.py
+        return resolve_data_dir()
 
-        return pyradnotes_dir, cpu_name
-
-    def __init__(self, city_list, fname):
+    def __init__(self, city_list, fname, history_fname=None, backend="sqlite", data_dir=None):
         self.city_list = city_list
-        spf_dir, _ = self.get_data_dir_on_this_computer_by_cpu_name()
-        self.spfname = spf_dir + "/" + fname
-
-    def xlsx_name(self):
-        return self.spfname
+        self.fname = fname
+        self.hfname = history_fname
+        # Resolved on first use, so a data directory given by the setting
+        # DATA_DIR saves probing the machine
+        self.data_dir_str = data_dir
+        # The backend to keep the history, see HISTORY_BACKENDS
+        self.backend = backend
+        self.store = None
 
-    def create_city_resale_spreadsheet_with_header(self, spfname, sheet_name="CityResaleNum"):
+    @property
+    def data_dir(self):
+        if self.data_dir_str is None:
+            self.data_dir_str, _ = self.get_data_dir_on_this_computer_by_cpu_name()
+        return self.data_dir_str
 
-        if not isinstance(spfname, str):
-            return False
+    @data_dir.setter
+    def data_dir(self, data_dir):
+        self.data_dir_str = data_dir
 
-        # If file exists, assume this function should not be called
-        if os.path.isfile(spfname) is True:
-            return False
+    @property
+    def spfname(self):
+        return self.data_dir + "/" + self.fname
 
-        dt_cols = ["Date", "Time", "Weekday", "Week"]
-        city_cols = self.city_list
+    @property
+    def history_fname(self):
+        return self.data_dir + "/" + self.hfname if self.hfname is not None else None
 
-        # Header columns, first 4 are date, time, weekday, week, the rest are city names
-        # Current there are 16 cities
-        header_columns = dt_cols.copy()
-        header_columns.extend(city_cols)
+    def xlsx_name(self):
+        return self.spfname
 
-        df = pd.DataFrame(columns=header_columns)
-        try:
-            df.to_excel(spfname, sheet_name=sheet_name, index=False)
-        except PermissionError as perr:
-            print(f"PermissionError: errono = {perr.errno}")
-            print(f"PermissionError: strerror = {perr.strerror}")
-            print(f"PermissionError: filename = \'{perr.filename}\'")
-        except Exception as e:
-            print(e.what())
+    def history_name(self):
+        return self.spfname if self.backend == "xlsx" else self.history_fname
 
-        return os.path.isfile(spfname)
+    def get_history_store(self):
+        if self.store is None:
+            store_cls = load_history_backend(self.backend)
+            self.store = store_cls(self.history_name(), self.city_list)
+        return self.store
 
     @staticmethod
-    def get_date_time_value_list():
+    def get_date_time_value_list(dtime=None):
         #dtime = datetime.date.fromtimestamp(datetime.datetime.now())
-        dtime = datetime.now()
+        if dtime is None:
+            dtime = datetime.now()
         # Date string
         date_str = dtime.strftime("%Y-%m-%d")
         # Time string
@@ -194,29 +175,55 @@ class SpreadsheetDataKeeper:
 
         return [date_str, time_str, day_str, week_str]
 
-    def append_data_row_to_spreadsheet(self, data_row, sheet_name="CityResaleNum"):
-
-        spfname = self.spfname
+    @profiled("history_append")
+    def append_data_row_to_spreadsheet(self, data_row, dtime=None):
+        """
+        Append the numbers of this run to the history store.
+        With the default "sqlite" backend nothing is written to the xlsx file,
+        use export_history_to_spreadsheet() to generate it.
+        The row of a run is replaced if it exists, e.g. when a run is resumed.
+        """
         assert isinstance(data_row, list) or isinstance(data_row, tuple)
 
-        if not isinstance(spfname, str):
-            return False
-
-        if os.path.isfile(spfname) is False:
-            if self.create_city_resale_spreadsheet_with_header(spfname, sheet_name) is False:
-                return False
+        row_dt = SpreadsheetDataKeeper.get_date_time_value_list(dtime)
+        return self.get_history_store().append_row(row_dt, data_row)
 
-        row_val = SpreadsheetDataKeeper.get_date_time_value_list()
-        row_val.extend(data_row)
-        #print(row_val)
+    @profiled("history_export")
+    def export_history_to_spreadsheet(self, year=None, spfname=None):
+        """
+        Generate the xlsx file from the SQLite history store
+        :param year: The year to export, all years are exported if it is None
+        :param spfname: The xlsx file to write, default is the yearly spreadsheet
+        :return: The number of rows exported
+        """
+        if spfname is None:
+            spfname = self.spfname
+        store = SQLiteHistoryStore(self.history_fname, self.city_list)
+        try:
+            return store.export_to_spreadsheet(spfname, year)
+        finally:
+            store.close()
 
-        # Use openpyxl directly to append rows to an existing spreadsheet
-        wb = openpyxl.load_workbook(spfname)
-        ws = wb.worksheets[0]
-        ws.append(row_val)
-        wb.save(spfname)
 
-        return True
+class MarketRun:
+    """
+    A market crawled by a spider (see markets.py): its city pages, its output
+    files and history store, and the city totals of the current run
+    """
+    def __init__(self, market, registry):
+        self.market = market
+        cil = CityInfoList(market.name)
+        for city in registry.cities:
+            url = city.get_url(market.name)
+            if url:
+                cil.add(city.en, url)
+        self.city_info_list = cil
+        self.url_dict = cil.get_url_dict()
+        # The history has a column for every city, as for the resale market
+        self.ssdk = SpreadsheetDataKeeper(registry.get_en_names(), cil.provideSpreadSheetFileName(),
+                                          cil.provideHistoryFileName())
+        self.scraped_data = dict()
+        self.checkpoint_store = None
 
 
 class HouseSpider(scrapy.Spider):
@@ -226,37 +233,421 @@ class HouseSpider(scrapy.Spider):
     # thus you don't have to define method 'start_requestes'
     # start_urls = [...]
 
-    def __init__(self, category=None, *args, **kwargs):
-        super(HouseSpider, self).__init__(*args, **kwargs)
+    # Levels of the fan-out crawl, and their request priorities, so that
+    # the city totals always finish first
+    LEVELS = ["city", "district", "bizcircle"]
+    LEVEL_PRIORITY = {"city": 300, "district": 200, "bizcircle": 100, "listing": 0}
+    # The markets crawled (see markets.py), the spiders of the other markets
+    # only change this, see market_spiders.py
+    MARKETS = ["resale"]
 
-        cil = CityInfoList()
-        cil.add('Beijing',      'https://bj.ke.com/ershoufang/')
-        cil.add('Guangzhou',    'https://gz.ke.com/ershoufang/')
-        cil.add('Suzhou',       'https://su.ke.com/ershoufang/')
-        cil.add('Hangzhou',     'https://hz.ke.com/ershoufang/')
-        cil.add('Nanjing',      'https://nj.ke.com/ershoufang/')
-        cil.add('Xi_an',        'https://xa.ke.com/ershoufang/')
-        cil.add('Chengdu',      'https://cd.ke.com/ershoufang/')
-        cil.add('Chongqing',    'https://cq.ke.com/ershoufang/')
-        cil.add('Tianjin',      'https://tj.ke.com/ershoufang/')
-        cil.add('Hefei',        'https://hf.ke.com/ershoufang/')
-        cil.add('Fuzhou',       'https://fz.ke.com/ershoufang/')
-        cil.add('Xiamen',       'https://xm.ke.com/ershoufang/')
-        cil.add('Changsha',     'https://cs.ke.com/ershoufang/')
-        cil.add('Shanghai',     'https://sh.ke.com/ershoufang/')
-        cil.add('Shenzhen',     'https://sz.ke.com/ershoufang/')
-        cil.add('Wuhan',        'https://wh.ke.com/ershoufang/')
+    def __init__(self, category=None, granularity="city", listings="0", resume=None, interval=None,
+                 cities=None, run=None, worker=None, markets=None, *args, **kwargs):
+        super(HouseSpider, self).__init__(*args, **kwargs)
 
+        # The deepest level to crawl, e.g. "scrapy crawl house_resale -a granularity=district"
+        if granularity not in self.LEVELS:
+            raise ValueError(f"Unknown granularity {granularity}, should be one of {self.LEVELS}")
+        self.granularity = granularity
+        # Crawl the listing pages of the deepest level, e.g. "-a listings=1"
+        self.crawl_listings = str(listings).lower() in ("1", "true", "yes")
+        self.run_time = datetime.now()
+        # When this batch started in this process, for the wall time of the run,
+        # run_time is the time of the resumed or the seeded run
+        self.batch_start = time.monotonic()
+        # Resume a run, "last" or the time of the run ("%Y-%m-%d %H:%M:%S"),
+        # e.g. "scrapy crawl house_resale -a resume=last"
+        self.resume = resume
+        # The daemon mode, crawl again every "interval" seconds in the same
+        # process, e.g. "scrapy crawl house_resale -a interval=1800"
+        self.interval = float(interval) if interval else None
+        self.next_batch_call = None
+        self.save_deferred = None
+        # The sharded crawl (setting FRONTIER), the run to work on, "last" by
+        # default, and the name of this worker, e.g. "-a run=last -a worker=pc2"
+        self.frontier = None
+        self.frontier_run = run or "last"
+        self.worker_id = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.frontier_batch_size = 16
+        self.frontier_max_attempts = 3
+        # The tasks leased by this worker and not done yet, and the loop
+        # leasing more tasks as they are done
+        self.frontier_leased = set()
+        self.frontier_poll_seconds = 0.5
+        self.frontier_loop = None
+
+        # The cities to crawl are read from a config file, the one of this package
+        # by default, e.g. "scrapy crawl house_resale -a cities=/path/to/cities.json"
+        self.registry = CityRegistry.load(cities)
+        # The markets to crawl in this process, sharing the connection pool and
+        # the throttle budget, e.g. "-a markets=resale,rental". The first one is
+        # the main market, whose files the commands and the pipeline default to
+        self.market_names = markets.split(",") if markets else list(self.MARKETS)
+        self.market_runs = {name: MarketRun(get_market(name), self.registry) for name in self.market_names}
+        main_run = self.market_runs[self.market_names[0]]
+
+        cil = main_run.city_info_list
         self.city_info_list = cil
-        self.url_dict = cil.get_url_dict()
-        self.all_scraped_data = dict()
-        self.city_name_list = cil.get_city_name_list()
+        self.url_dict = main_run.url_dict
+        self.city_name_list = self.registry.get_en_names()
         self.city_url_list = cil.get_city_url_list()
+        self.mirror_proxy = None
+        # Scanners of the requests being downloaded in the early abort mode
+        self.early_abort = False
+        self.early_abort_scanners = dict()
+        # The cities of each run with pages missed by the listing crawl (failed
+        # or banned), their listing IDs are not a complete snapshot
+        self.incomplete_listing_cities = dict()
+        # Parse time and output step durations, served by MetricsExtension
+        self.metrics = Metrics()
+
+        # The spreadsheet file name (.xlsx) and the history of the main market
+        self.ssdk = main_run.ssdk
+
+    def get_market_run(self, market=None):
+        """
+        :param market: The name of a market, None for the main market
+        :return: The MarketRun of the market, it is added if the market is not
+                 crawled by this spider (e.g. a page of it leased from the frontier)
+        """
+        if market is None:
+            return self.market_runs[self.market_names[0]]
+        if market not in self.market_runs:
+            market_run = MarketRun(get_market(market), self.registry)
+            market_run.ssdk.backend = self.ssdk.backend
+            market_run.ssdk.data_dir = self.ssdk.data_dir
+            self.market_runs[market] = market_run
+        return self.market_runs[market]
+
+    def get_run_ts(self):
+        return self.run_time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def mark_listing_crawl_incomplete(self, request):
+        """
+        A page of a city is missed by the listing crawl, see HousecrawlerPipeline.commit_listing_ids()
+        """
+        if self.crawls_listings(get_market(request.meta.get("market"))):
+            self.incomplete_listing_cities.setdefault(self.get_run_ts(), set()).add(request.meta.get("city"))
+
+    def take_incomplete_listing_cities(self, run_ts):
+        """
+        :return: The cities of a run whose listing crawl missed some pages
+        """
+        return self.incomplete_listing_cities.pop(run_ts, set())
+
+    def get_checkpoint_store(self, market=None):
+        market_run = self.get_market_run(market)
+        if market_run.checkpoint_store is None:
+            market_run.checkpoint_store = SQLiteHistoryStore(market_run.ssdk.history_fname, self.city_name_list)
+        return market_run.checkpoint_store
+
+    def load_checkpoint(self, run_ts):
+        """
+        Continue a run: take over its time and the city totals it got, so only
+        the missing or failed cities are fetched again, and the results are
+        merged into the same history row and the same column of the weekly table
+        """
+        if run_ts == "last":
+            run_ts = self.get_checkpoint_store().get_last_checkpoint_run()
+            if run_ts is None:
+                print(f"[PYRAD] WARNING: No run to resume, start a new run")
+                return
+        self.run_time = datetime.strptime(run_ts, "%Y-%m-%d %H:%M:%S")
+        for name in self.market_names:
+            market_run = self.market_runs[name]
+            market_run.scraped_data.update(self.get_checkpoint_store(name).load_checkpoint(run_ts))
+            missing = [city for city in market_run.url_dict if city not in market_run.scraped_data]
+            print(f"[PYRAD] Resume the run of {run_ts}, {len(missing)} cities to fetch"
+                  f"{'' if len(self.market_names) == 1 else ' (' + name + ')'}: {missing}")
+
+    def save_checkpoint(self, city, total_num, market=None):
+        self.get_checkpoint_store(market).save_checkpoint(self.get_run_ts(), city, total_num)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(HouseSpider, cls).from_crawler(crawler, *args, **kwargs)
+        for market_run in spider.market_runs.values():
+            market_run.ssdk.backend = crawler.settings.get("HISTORY_BACKEND", "sqlite")
+            if crawler.settings.get("DATA_DIR"):
+                market_run.ssdk.data_dir = crawler.settings.get("DATA_DIR")
+        # After the data directory is known, the checkpoints are in the history store
+        if spider.resume:
+            spider.load_checkpoint(spider.resume)
+        mirror_proxy = crawler.settings.get("BEIKE_MIRROR_PROXY")
+        if mirror_proxy:
+            spider.use_mirror_proxy(mirror_proxy)
+        if crawler.settings.get("FRONTIER"):
+            spider.use_frontier(crawler.settings.get("FRONTIER"), crawler.settings)
+            crawler.signals.connect(spider.start_frontier_loop, signal=signals.spider_opened)
+            crawler.signals.connect(spider.on_frontier_idle, signal=signals.spider_idle)
+        if crawler.settings.getbool("EARLY_ABORT_ENABLED"):
+            spider.early_abort = True
+            crawler.signals.connect(spider.on_headers_received, signal=signals.headers_received)
+            crawler.signals.connect(spider.on_bytes_received, signal=signals.bytes_received)
+            # The scanners of the requests which fail or are dropped are not
+            # removed by parse(), which would grow for the life of a daemon
+            crawler.signals.connect(spider.drop_early_abort_scanner, signal=signals.request_left_downloader)
+            crawler.signals.connect(spider.drop_early_abort_scanner, signal=signals.request_dropped)
+        if spider.interval is not None:
+            crawler.signals.connect(spider.on_spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def get_next_batch_delay(self):
+        """
+        Runs are aligned to multiples of the interval since midnight, like a
+        cron job, e.g. at :00 and :30 for an interval of 1800 seconds
+        """
+        now = datetime.now()
+        since_midnight = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+        return self.interval - since_midnight % self.interval
 
-        # The spreadsheet file name (.xlsx)
-        fname = cil.provideSpreadSheetFileName()
-        self.ssdk = SpreadsheetDataKeeper(self.city_name_list, fname)
+    def on_spider_idle(self, spider):
+        """
+        In the daemon mode the spider is kept open when a run is done: the
+        output steps of the run go to a background thread, and the next run is
+        scheduled on the same crawler, so the connections, the DNS cache and
+        everything imported are reused
+        """
+        from twisted.internet import reactor
+
+        if self.next_batch_call is None or not self.next_batch_call.active():
+            if self.has_scraped_data():
+                self.save_results_in_background()
+            delay = self.get_next_batch_delay()
+            print(f"[PYRAD] Next run in {delay:.0f} seconds")
+            self.next_batch_call = reactor.callLater(delay, self.start_next_batch)
+        raise DontCloseSpider
+
+    def start_next_batch(self):
+        self.run_time = datetime.now()
+        self.batch_start = time.monotonic()
+        for name in self.market_names:
+            for city, url in self.market_runs[name].url_dict.items():
+                self.crawler.engine.crawl(self.make_request(url, city, market=name))
+
+    def has_scraped_data(self):
+        return any(len(market_run.scraped_data) > 0 for market_run in self.market_runs.values())
+
+    def take_scraped_data(self):
+        """
+        :return: The city totals of this run of each market which has any, the
+                 totals of the spider are cleared for the next run
+        """
+        results = dict()
+        for name, market_run in self.market_runs.items():
+            if len(market_run.scraped_data) > 0:
+                results[name] = market_run.scraped_data
+                market_run.scraped_data = dict()
+        return results
+
+    def save_results_in_background(self):
+        from twisted.internet import defer, threads
+
+        results, run_time, batch_start = self.take_scraped_data(), self.run_time, self.batch_start
+
+        def save_in_thread(_):
+            # The output steps run in the thread, the run ends in the reactor
+            # thread (the handlers of run_saved are not thread safe)
+            d = threads.deferToThread(self.save_output_steps, results, run_time)
+            d.addCallback(lambda _: self.end_run(run_time, batch_start))
+            return d
+
+        if self.save_deferred is None:
+            self.save_deferred = defer.succeed(None)
+        # One run after the other, the output files are not written concurrently
+        self.save_deferred.addBoth(save_in_thread)
+        self.save_deferred.addErrback(lambda f: self.logger.error(f"Failed to save the results: {f.value}"))
+
+    def use_frontier(self, spec, settings):
+        """
+        Work as one of the workers of a sharded crawl, see frontier.py: the
+        pages are leased from the shared frontier instead of being taken from
+        the city list, and the run is the one seeded in the frontier
+        """
+        if self.interval is not None or self.resume:
+            raise ValueError("The sharded crawl (setting FRONTIER) can't be combined with interval or resume")
+        self.frontier = open_frontier(spec, self.ssdk.data_dir, self.frontier_run,
+                                      settings.getfloat("FRONTIER_LEASE_SECONDS", 300.0))
+        if self.frontier.run_ts is None:
+            raise ValueError(f"No run in the frontier {spec}, seed one by \"scrapy frontier seed\"")
+        self.frontier_batch_size = settings.getint("FRONTIER_BATCH_SIZE", 16)
+        self.frontier_max_attempts = settings.getint("FRONTIER_MAX_ATTEMPTS", 3)
+        self.frontier_poll_seconds = settings.getfloat("FRONTIER_POLL_SECONDS", 0.5)
+        self.run_time = datetime.strptime(self.frontier.run_ts, "%Y-%m-%d %H:%M:%S")
+        print(f"[PYRAD] Worker {self.worker_id} of the run {self.frontier.run_ts}")
+
+    def make_city_tasks(self):
+        """
+        :return: The frontier tasks of the city pages of the markets, which start a sharded run
+        """
+        return [make_task(url, city, priority=self.LEVEL_PRIORITY["city"], market=name)
+                for name in self.market_names for city, url in self.market_runs[name].url_dict.items()]
 
+    def lease_requests(self):
+        """
+        :return: The requests of the tasks leased from the frontier, up to
+                 FRONTIER_BATCH_SIZE tasks of this worker are in flight
+        """
+        requests = []
+        n = self.frontier_batch_size - len(self.frontier_leased)
+        if n <= 0:
+            return requests
+        for task in self.frontier.lease(self.worker_id, n):
+            url = re.sub("^https://", "http://", task["url"]) if self.mirror_proxy else task["url"]
+            callback = self.parse_listing_page if task["level"] == "listing" else self.parse
+            request = self.make_request(url, task["city"], task["level"], task["district"], task["bizcircle"],
+                                        callback=callback, errback=self.on_task_error, market=task.get("market"))
+            request.meta["frontier_key"] = task["key"]
+            # The frontier has each page once, a page given back may come to this worker again
+            request.dont_filter = True
+            self.frontier_leased.add(task["key"])
+            requests.append(request)
+        return requests
+
+    def top_up_leases(self):
+        """
+        Lease more tasks as soon as the ones in flight are done, instead of
+        waiting for the whole batch and the next spider_idle
+        """
+        requests = self.lease_requests()
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        # Close as soon as the run is finished, spider_idle comes every few seconds only
+        if len(requests) == 0 and len(self.frontier_leased) == 0 and self.frontier.is_finished():
+            self.crawler.engine.close_spider(self, "finished")
+
+    def start_frontier_loop(self, spider):
+        from twisted.internet import task
+
+        # The tasks added by the other workers are leased while this one is busy, too
+        self.frontier_loop = task.LoopingCall(self.top_up_leases)
+        self.frontier_loop.start(self.frontier_poll_seconds, now=False)
+
+    def on_frontier_idle(self, spider):
+        """
+        The worker is kept open while the other workers have tasks, which may
+        come back (their leases expire, or their pages are banned) or link to
+        more pages
+        """
+        # Nothing is in flight, the tasks of the requests lost on the way are given up
+        self.frontier_leased.clear()
+        requests = self.lease_requests()
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        if len(requests) > 0 or not self.frontier.is_finished():
+            raise DontCloseSpider
+
+    def complete_task(self, response, results, total_num=None, banned=False):
+        """
+        Report a page of the frontier done. The requests found on the page go
+        to the frontier, for any worker to lease, and only the items are returned.
+        A banned page is given back, another worker (another IP) tries it
+        """
+        key = response.meta.get("frontier_key")
+        if key is None:
+            return results
+        self.frontier_leased.discard(key)
+        if banned:
+            if self.frontier.fail(key, self.worker_id, self.frontier_max_attempts):
+                print(f"[PYARD] Give {response.url} back to the frontier for another worker")
+            return results
+
+        children = [make_task(r.url, r.meta["city"], r.meta["level"], r.meta["district"], r.meta["bizcircle"],
+                              r.priority, r.meta["market"])
+                    for r in results if isinstance(r, scrapy.Request)]
+        if not self.frontier.complete(key, self.worker_id, total_num, children):
+            # The lease expired and another worker has the page, its results are kept
+            self.logger.warning(f"Lease of {response.url} lost, the page is done by another worker")
+            return []
+        self.top_up_leases()
+        return [r for r in results if not isinstance(r, scrapy.Request)]
+
+    def on_task_error(self, failure):
+        request = failure.request
+        key = request.meta.get("frontier_key")
+        self.frontier_leased.discard(key)
+        if key is not None and self.frontier.fail(key, self.worker_id, self.frontier_max_attempts):
+            self.logger.warning(f"Failed {request.url} ({failure.value}), given back to the frontier")
+        else:
+            self.logger.error(f"Failed {request.url}: {failure.value}")
+
+    def on_request_error(self, failure):
+        self.logger.error(f"Failed {failure.request.url}: {failure.value}")
+        self.mark_listing_crawl_incomplete(failure.request)
+
+    def finish_shard(self, force=False):
+        """
+        The output steps of a sharded run are done once, with the city totals
+        of all the workers, by the first worker which finds the run finished
+        (or by "scrapy frontier reduce")
+        :param force: Do the output steps even if the run is not finished or already done
+        :return: True if the output steps are done
+        """
+        run_ts = self.frontier.run_ts
+        if not force and not self.frontier.is_finished():
+            print(f"[PYRAD] The run {run_ts} is not finished, the output steps are left to the last worker")
+            return False
+        if not self.frontier.claim_reduce(self.worker_id) and not force:
+            return False
+        results = self.frontier.get_results()
+        ntotal = sum(len(scraped_data) for scraped_data in results.values())
+        print(f"[PYRAD] Merged {ntotal} city totals of the run {run_ts}: {self.frontier.get_progress()}")
+        self.save_all_results(results, self.run_time)
+        return True
+
+    def use_mirror_proxy(self, proxy_url):
+        """
+        Send all requests to a local stand-in server (e.g. benchmarks/mock_server.py)
+        which works as an HTTP proxy. The stand-in can't do TLS, so the pages are
+        requested by http:// instead of https://
+        """
+        self.mirror_proxy = proxy_url
+        for market_run in self.market_runs.values():
+            market_run.url_dict = {city: re.sub("^https://", "http://", url)
+                                   for city, url in market_run.url_dict.items()}
+        self.url_dict = self.get_market_run().url_dict
+        self.city_url_list = list(self.url_dict.values())
+
+    def on_headers_received(self, headers, body_length, request, spider):
+        if spider is not self or not request.meta.get("early_abort"):
+            return
+        content_encoding = headers.get(b"Content-Encoding") or b""
+        # HttpCompressionMiddleware fails on a truncated br body, even though the number was found
+        if content_encoding.strip().lower() == b"br":
+            return
+        pattern = get_market(request.meta.get("market")).total_num_pattern
+        # body_length is not an int if the length is not known, e.g. a chunked body
+        body_length = body_length if isinstance(body_length, int) and body_length >= 0 else None
+        self.early_abort_scanners[request] = TotalNumScanner(content_encoding, pattern, body_length)
+
+    def drop_early_abort_scanner(self, request, spider):
+        self.early_abort_scanners.pop(request, None)
+
+    def on_bytes_received(self, data, request, spider):
+        """
+        Stop the download once the total-count block is received, the only
+        number read from the page is near its top. The partial body is still
+        passed to parse(), with the number found here in response.meta
+        """
+        scanner = self.early_abort_scanners.get(request)
+        if scanner is None:
+            return
+        found = scanner.feed(data)
+        if found is None:
+            if not scanner.enabled:
+                del self.early_abort_scanners[request]
+            return
+
+        del self.early_abort_scanners[request]
+        request.meta["early_total_num"] = found
+        if scanner.is_complete():
+            # The block came with the end of the body. A download stopped now
+            # saves nothing, and Twisted would put the connection being closed
+            # back in its pool, the next request sent on it is lost and sent
+            # again (a second GET of that page)
+            return
+        self.crawler.stats.inc_value("housecrawler/early_abort")
+        raise StopDownload(fail=False)
 
     def get_url_city(self, url_str=None):
         if url_str is None:
@@ -265,58 +656,88 @@ class HouseSpider(scrapy.Spider):
         if not isinstance(url_str, str):
             return "N/A"
 
-        for city, url in self.url_dict.items():
-            if url == url_str:
-                return city
+        city = self.registry.get_by_url(url_str)
+        return city.en if city is not None else "N/A"
 
-        return "N/A"
+    def get_markdown_fname(self, market=None):
+        return self.get_market_run(market).city_info_list.provideMarkdownFileName()
 
-    def get_markdown_fname(self):
-        return self.city_info_list.provideMarkdownFileName()
-
-    def get_xlsx_fname(self):
-        return self.city_info_list.provideSpreadSheetFileName()
+    def get_xlsx_fname(self, market=None):
+        return self.get_market_run(market).city_info_list.provideSpreadSheetFileName()
 
+    @profiled("closed")
     def closed(self, reason):
-        cnum = len(self.all_scraped_data)
-        if cnum == 0:
-            return
+        if self.frontier is not None:
+            if self.frontier_loop is not None and self.frontier_loop.running:
+                self.frontier_loop.stop()
+            try:
+                self.finish_shard()
+            finally:
+                self.frontier.close()
+        elif self.has_scraped_data():
+            if self.interval is None:
+                self.save_all_results(self.take_scraped_data(), self.run_time)
+            else:
+                self.save_results_in_background()
+        for market_run in self.market_runs.values():
+            if market_run.checkpoint_store is not None:
+                market_run.checkpoint_store.close()
+        if self.next_batch_call is not None and self.next_batch_call.active():
+            self.next_batch_call.cancel()
+        # In the daemon mode, wait for the output steps running in the background
+        return self.save_deferred
+
+    def save_all_results(self, results, run_time):
+        """
+        The output steps of a run of several markets, then the end of the run
+        :param results: The city totals of each market, keyed by the market name
+        """
+        self.save_output_steps(results, run_time)
+        self.end_run(run_time)
+
+    @profiled("save_results")
+    def save_output_steps(self, results, run_time):
+        for market, scraped_data in results.items():
+            self.save_market_results(scraped_data, run_time, market)
+
+    def save_market_results(self, scraped_data, run_time, market=None):
+        """
+        The output steps of one market of a run, see save_all_results(): save
+        the numbers to the history store, update the markdown table of this
+        week and print a summary
+        """
+        market_run = self.get_market_run(market)
+        ssdk = market_run.ssdk
+        if len(self.market_runs) > 1:
+            print(f"==== {market_run.market.title_en} ====")
+        cnum = len(scraped_data)
         print(f"[PYRAD] Total city number = {cnum}")
-        for city_name, total_num in self.all_scraped_data.items():
+        for city_name, total_num in scraped_data.items():
             print(f"[PYARD] {city_name} = {total_num}")
 
-        bj_n = self.all_scraped_data['Beijing'] if 'Beijing' in self.all_scraped_data else "-"
-        sh_n = "-"
-        shzh_n = self.all_scraped_data['Shenzhen'] if 'Shenzhen' in self.all_scraped_data else "-"
-        gz_n = self.all_scraped_data['Guangzhou'] if 'Guangzhou' in self.all_scraped_data else "-"
-        sz_n = self.all_scraped_data['Suzhou'] if 'Suzhou' in self.all_scraped_data else "-"
-        hz_n = self.all_scraped_data['Hangzhou'] if 'Hangzhou' in self.all_scraped_data else "-"
-        nj_n = self.all_scraped_data['Nanjing'] if 'Nanjing' in self.all_scraped_data else "-"
-        xa_n = self.all_scraped_data['Xi_an'] if 'Xi_an' in self.all_scraped_data else "-"
-        cd_n = self.all_scraped_data['Chengdu'] if 'Chengdu' in self.all_scraped_data else "-"
-        cq_n = self.all_scraped_data['Chongqing'] if 'Chongqing' in self.all_scraped_data else "-"
-        tj_n = self.all_scraped_data['Tianjin'] if 'Tianjin' in self.all_scraped_data else "-"
-        hf_n = self.all_scraped_data['Hefei'] if 'Hefei' in self.all_scraped_data else "-"
-        fz_n = self.all_scraped_data['Fuzhou'] if 'Fuzhou' in self.all_scraped_data else "-"
-        xm_n = self.all_scraped_data['Xiamen'] if 'Xiamen' in self.all_scraped_data else "-"
-        wh_n = "-"
-        cs_n = self.all_scraped_data['Changsha'] if 'Changsha' in self.all_scraped_data else "-"
-
-        # Save the numbers to a xlsx file
+        # Save the numbers to the history store
         city_resale_nlist = \
-            [self.all_scraped_data[city] if not self.all_scraped_data.get(city) is None else -1 \
+            [scraped_data[city] if not scraped_data.get(city) is None else -1 \
              for city in self.city_name_list]
 
-        if self.ssdk.append_data_row_to_spreadsheet(city_resale_nlist) is True:
-            print(f"[PYRAD] Successfully saved data to spreadsheet {self.ssdk.xlsx_name()}")
+        with self.metrics.timer("output_step_seconds", step="history_append"):
+            saved = ssdk.append_data_row_to_spreadsheet(city_resale_nlist, run_time)
+        if saved is True:
+            print(f"[PYRAD] Successfully saved data to {ssdk.history_name()}")
         else:
-            print(f"[PYRAD] Failed to save data to spreadsheet {self.ssdk.xlsx_name()}")
+            print(f"[PYRAD] Failed to save data to {ssdk.history_name()}")
+        ssdk.get_history_store().close()
+
+        missing = [city for city in market_run.url_dict if city not in scraped_data]
+        if len(missing) > 0:
+            print(f"[PYRAD] WARNING: No numbers for {missing}, fetch only them by "
+                  f"\"scrapy crawl {self.name} -a resume='{run_time:%Y-%m-%d %H:%M:%S}'\"")
 
         # Update the markdown file for resale tables
-        ddir, _ = self.ssdk.get_data_dir_on_this_computer_by_cpu_name()
-        resale_md_filename = ddir + "/" + self.get_markdown_fname()
-        rtr = ResaleTableRefresh(resale_md_filename, self.all_scraped_data)
-        rtr.refresh()
+        resale_md_filename = ssdk.data_dir + "/" + self.get_markdown_fname(market)
+        rtr = ResaleTableRefresh(resale_md_filename, scraped_data, run_time, self.registry, market_run.market.name)
+        with self.metrics.timer("output_step_seconds", step="table_refresh"):
+            rtr.refresh()
 
         # Print current date & time
         dt = datetime.now()
@@ -327,48 +748,63 @@ class HouseSpider(scrapy.Spider):
         print(f"{dt_string1}")
         # print(f"{dt_string2}")
 
-        bj_n_fmtstr = format(bj_n, ",") if isinstance(bj_n, int) else "-"
-        gz_n_fmtstr = format(gz_n, ",") if isinstance(gz_n, int) else "-"
-        sz_n_fmtstr = format(sz_n, ",") if isinstance(sz_n, int) else "-"
-        hz_n_fmtstr = format(hz_n, ",") if isinstance(hz_n, int) else "-"
-        nj_n_fmtstr = format(nj_n, ",") if isinstance(nj_n, int) else "-"
-        xa_n_fmtstr = format(xa_n, ",") if isinstance(xa_n, int) else "-"
-        cd_n_fmtstr = format(cd_n, ",") if isinstance(cd_n, int) else "-"
-        cq_n_fmtstr = format(cq_n, ",") if isinstance(cq_n, int) else "-"
-        tj_n_fmtstr = format(tj_n, ",") if isinstance(tj_n, int) else "-"
-        hf_n_fmtstr = format(hf_n, ",") if isinstance(hf_n, int) else "-"
-        fz_n_fmtstr = format(fz_n, ",") if isinstance(fz_n, int) else "-"
-        xm_n_fmtstr = format(xm_n, ",") if isinstance(xm_n, int) else "-"
-        cs_n_fmtstr = format(cs_n, ",") if isinstance(cs_n, int) else "-"
-        sh_n_fmtstr = format(sh_n, ",") if isinstance(sh_n, int) else "-"
-        shzh_n_fmtstr = format(shzh_n, ",")  if isinstance(shzh_n, int) else "-"
-        wh_n_fmtstr = format(wh_n, ",")  if isinstance(wh_n, int) else "-"
-
-        longstr2 = (f"北京 {bj_n_fmtstr}\n"
-                    f"广州 {gz_n_fmtstr}\n"
-                    f"苏州 {sz_n_fmtstr}\n"
-                    f"杭州 {hz_n_fmtstr}\n"
-                    f"南京 {nj_n_fmtstr}\n"
-                    f"西安 {xa_n_fmtstr}\n"
-                    f"成都 {cd_n_fmtstr}\n"
-                    f"重庆 {cq_n_fmtstr}\n"
-                    f"天津 {tj_n_fmtstr}\n"
-                    f"合肥 {hf_n_fmtstr}\n"
-                    f"福州  {fz_n_fmtstr}\n"
-                    f"厦门  {xm_n_fmtstr}\n"
-                    f"长沙  {cs_n_fmtstr}\n"
-                    f"深圳  {shzh_n_fmtstr}\n"
-                    f"上海  {sh_n_fmtstr}\n"
-                    f"武汉  {wh_n_fmtstr}\n")
+        # The summary in the order of the weekly tables, the numbers of the cities
+        # in the unknown group are not reliable, so they are not given
+        longstr2 = ""
+        for city in self.registry.get_report_cities():
+            num = scraped_data.get(city.en) if not city.unknown else None
+            num_fmtstr = format(num, ",") if isinstance(num, int) else "-"
+            longstr2 += f"{city.cn} {num_fmtstr}\n"
         print(longstr2)
+        with self.metrics.timer("output_step_seconds", step="trend_summary"):
+            self.print_trend_summary(market)
 
         # For git commit message
         dt_string = dt.strftime("%Y-%m-%d %H:%M")
         print("==== Git commit message ====")
-        print(f"g commit -am \"Realestate Update resale numbers {dt_string}\"")
+        print(f"g commit -am \"Realestate Update {market_run.market.title_en.lower()} numbers {dt_string}\"")
         print("============================")
 
-    def get_headers(self):
+    def end_run(self, run_time, batch_start=None):
+        """
+        Send run_saved, in the reactor thread
+        :param batch_start: The time.monotonic() when the batch of the run started
+        """
+        # The metrics of this run are done, see MetricsExtension
+        run_metrics = self.metrics.end_run()
+        batch_start = self.batch_start if batch_start is None else batch_start
+        if getattr(self, "crawler", None) is not None:
+            self.crawler.signals.send_catch_log(run_saved, run_time=run_time, metrics=run_metrics,
+                                                wall_seconds=time.monotonic() - batch_start)
+
+    def print_trend_summary(self, market=None):
+        """
+        Print the change of each city since last week, from the history
+        analytics (see analytics.py), which are cached between the runs of the
+        daemon mode
+        """
+        ssdk = self.get_market_run(market).ssdk
+        if ssdk.backend != "sqlite":
+            return
+        try:
+            summary = get_history_analytics(ssdk.history_fname, self.city_name_list).latest_summary()
+        except ImportError:
+            print("[PYRAD] Install pandas to get the week-over-week summary")
+            return
+
+        print("==== Week over week ====")
+        for city in self.registry.get_report_cities(unknown=False):
+            if city.en not in summary.index:
+                continue
+            row = summary.loc[city.en]
+            if math.isnan(row["total"]) or math.isnan(row["week_delta"]):
+                continue
+            pct_str = f" ({row['week_pct']:+.2f}%)" if not math.isnan(row["week_pct"]) else ""
+            print(f"{city.cn} {int(row['total']):,} {int(row['week_delta']):+,}{pct_str}, rank {int(row['rank'])}")
+        print("========================")
+
+    @staticmethod
+    def get_headers():
         """
         Get a dict for headers, to avoid robot.txt limit
         2024-05-31 23:25
@@ -379,12 +815,103 @@ class HouseSpider(scrapy.Spider):
         }
         return headers
 
+    def make_request(self, url, city, level="city", district="", bizcircle="", callback=None, errback=None,
+                     market=None):
+        market = get_market(market or self.market_names[0])
+        meta = {"city": city, "level": level, "district": district, "bizcircle": bizcircle, "market": market.name}
+        # Pages of the upper levels are read to the end for the links of the next level
+        meta["early_abort"] = self.early_abort and level == self.get_deepest_level(market) and \
+            not self.crawls_listings(market)
+        if self.mirror_proxy:
+            meta["proxy"] = self.mirror_proxy
+        # The daemon mode requests the same pages in every run
+        return scrapy.Request(url=url, callback=callback or self.parse, errback=errback or self.on_request_error,
+                              headers=self.get_headers(),
+                              meta=meta, priority=self.LEVEL_PRIORITY[level], dont_filter=self.interval is not None)
+
     def start_requests(self):
-        # Set urls list for scraping
-        urls = [cur_url for _, cur_url in self.url_dict.items()]
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse, headers=self.get_headers())
+        # The workers of a sharded crawl take their pages from the frontier
+        if self.frontier is not None:
+            yield from self.lease_requests()
+            return
+        # Set urls list for scraping, the cities already got by a resumed run are skipped
+        for name in self.market_names:
+            market_run = self.market_runs[name]
+            for city, url in market_run.url_dict.items():
+                if city in market_run.scraped_data:
+                    continue
+                yield self.make_request(url, city, market=name)
+
+    def get_deepest_level(self, market):
+        """
+        :return: The deepest level crawled in a market, the city level if the
+                 market has no links to its districts
+        """
+        if market.district_links_xpath is None:
+            return "city"
+        if self.granularity == "bizcircle" and market.bizcircle_links_xpath is None:
+            return "district"
+        return self.granularity
+
+    def crawls_listings(self, market):
+        return self.crawl_listings and market.listings
 
+    def follow_area_links(self, response):
+        """
+        Make the requests for the districts of a city page, or the bizcircles
+        of a district page, down to the level given by granularity
+        """
+        level = response.meta.get("level", "city")
+        market = get_market(response.meta.get("market"))
+        level_index = self.LEVELS.index(level)
+        if level_index >= self.LEVELS.index(self.get_deepest_level(market)):
+            return []
+
+        next_level = self.LEVELS[level_index + 1]
+        links_xpath = market.get_area_links_xpath(next_level)
+        city = response.meta.get("city") or self.get_url_city(response.url)
+        requests = []
+        for link in response.xpath(links_xpath):
+            href = link.attrib.get("href")
+            name = link.xpath("normalize-space(text())").get()
+            if not href or not name:
+                continue
+            district = name if next_level == "district" else response.meta.get("district", "")
+            bizcircle = name if next_level == "bizcircle" else ""
+            requests.append(self.make_request(response.urljoin(href), city, next_level, district, bizcircle,
+                                              market=market.name))
+        return requests
+
+    def make_listing_items(self, response):
+        city = response.meta.get("city") or self.get_url_city(response.url)
+        ts = self.get_run_ts()
+        items = []
+        for listing in extract_listings(response):
+            items.append(HousecrawlerItem(ts=ts, city=city, district=response.meta.get("district", ""),
+                                          bizcircle=response.meta.get("bizcircle", ""), **listing))
+        self.crawler.stats.inc_value("housecrawler/listings", len(items))
+        return items
+
+    def follow_listing_pages(self, response):
+        """
+        Make the requests for the pages 2, 3, ... of the listings of an area page
+        """
+        requests = []
+        base_url = response.url if response.url.endswith("/") else response.url + "/"
+        for page in range(2, extract_total_page(response) + 1):
+            requests.append(self.make_request(f"{base_url}pg{page}/", response.meta.get("city"), "listing",
+                                              response.meta.get("district", ""), response.meta.get("bizcircle", ""),
+                                              callback=self.parse_listing_page, market=response.meta.get("market")))
+        return requests
+
+    def parse_listing_page(self, response):
+        if response.status == 418:
+            print(f"[PYARD] Banned (HTTP 418) for URL: {response.url}")
+            self.mark_listing_crawl_incomplete(response.request)
+        # The items are yielded page by page and streamed to disk by the pipeline
+        return self.complete_task(response, self.make_listing_items(response))
+
+    @profiled("parse")
     def parse(self, response):
 
         """
@@ -403,30 +930,61 @@ class HouseSpider(scrapy.Spider):
         [PYARD] Title = ['北京二手房_北京二手房出售买卖信息网【北京贝壳找房】']
         """
 
-        # Currently it seems the xpath for the total house numbers of each city is the same,
-        # so use it as a single variable
-        total_num_xpath = '//*[@id="beike"]/div[1]/div[4]/div[1]/div[2]/div[1]/h2/span' + '/text()'
-        city_xpath = '//*[@id="beike"]/div[1]/div[4]/div[1]/div[2]/div[1]/h2/a' + '/text()'
-
-        # print(f"[PYRAD] Current scaping URL: {response.url}")
-        # print(f"[PYARD] City = {response.xpath(city_xpath).getall()}")
-        # print(f"[PYARD] Total house number = {response.xpath(total_num_xpath).getall()}")
-
-        data_got = response.xpath(city_xpath).getall()
-        print(f"[PYARD] type(data_got) = {type(data_got)}")
-        print(f"[PYARD] len(data_got) = {len(data_got)}")
-
-        #return
-
-        if len(data_got) > 0:
-            city_name = response.xpath(city_xpath).getall()[0]
-            total_num = int(response.xpath(total_num_xpath).getall()[0])
-            print(f"[PYARD] {city_name} = {total_num}")
-
-            city_name = self.get_url_city(response.url)
-            self.all_scraped_data[city_name] = total_num
+        t_start = time.perf_counter()
+        results = []
+        level = response.meta.get("level", "city")
+        city_name = response.meta.get("city") or self.get_url_city(response.url)
+        market_run = self.get_market_run(response.meta.get("market"))
+        market = market_run.market
+
+        # The total-count block is found in the raw bytes of the body,
+        # the XPath expressions are only used if that misses, see extract.py.
+        # In the early abort mode it is already found while downloading, and
+        # a page not modified since the last run has the number found then
+        # (see PageCacheMiddleware)
+        self.early_abort_scanners.pop(response.request, None)
+        early_found = response.meta.get("early_total_num")
+        if early_found is not None:
+            found = (early_found[0], early_found[1], "early")
+        elif response.meta.get("cached_total_num") is not None:
+            found = (response.meta["cached_total_num"], None, "cached")
+        else:
+            found = extract_total_num(response, market.total_num_pattern)
+
+        if found is not None:
+            total_num, _, method = found
+            if method == "xpath":
+                self.crawler.stats.inc_value(f"housecrawler/extract_{method}")
+
+            district = response.meta.get("district", "")
+            bizcircle = response.meta.get("bizcircle", "")
+            if level == "city":
+                print(f"[PYARD] {city_name} = {total_num}")
+                market_run.scraped_data[city_name] = total_num
+                self.save_checkpoint(city_name, total_num, market.name)
+            results.append(ListingCountItem(
+                ts=self.get_run_ts(), city=city_name, level=level, district=district, bizcircle=bizcircle,
+                url=response.url, total_num=total_num, market=market.name))
+            results.extend(self.follow_area_links(response))
+            if self.crawls_listings(market) and level == self.get_deepest_level(market):
+                results.extend(self.make_listing_items(response))
+                results.extend(self.follow_listing_pages(response))
+        elif response.status == 418:
+            # Still banned after the retries of BanAwareThrottleMiddleware
+            print(f"[PYARD] Banned (HTTP 418) for URL: {response.url}")
         else:
-            print(f"[PYARD] City name not found for URL: {response.url}")
+            print(f"[PYARD] {level.capitalize()} name not found for URL: {response.url}")
+        if found is None:
+            self.mark_listing_crawl_incomplete(response.request)
+
+        # Time spent on parsing, the benchmarks report it per response
+        parse_time = time.perf_counter() - t_start
+        self.crawler.stats.inc_value("housecrawler/parse_count")
+        self.crawler.stats.inc_value("housecrawler/parse_time", parse_time, start=0.0)
+        self.metrics.observe("parse_seconds", parse_time, city=city_name, level=level)
+
+        total_num = found[0] if found is not None and level == "city" else None
+        return self.complete_task(response, results, total_num, banned=found is None and response.status == 418)
 
         # filename = f'test.html'
         # Path(filename).write_bytes(response.body)
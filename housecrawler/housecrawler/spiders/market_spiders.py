@@ -0,0 +1,29 @@
+from .house_spider import HouseSpider
+
+
+class NewHomeSpider(HouseSpider):
+    """
+    Count the new home projects (loupan) of each city,
+    e.g. "scrapy crawl house_newhome"
+    """
+    name = "house_newhome"
+    MARKETS = ["newhome"]
+
+
+class RentalSpider(HouseSpider):
+    """
+    Count the rental listings (zufang) of each city,
+    e.g. "scrapy crawl house_rental"
+    """
+    name = "house_rental"
+    MARKETS = ["rental"]
+
+
+class AllMarketsSpider(HouseSpider):
+    """
+    Count the listings of every market in one process, the pages of all the
+    markets share the connection pool and the throttle of each host,
+    e.g. "scrapy crawl house_all"
+    """
+    name = "house_all"
+    MARKETS = ["resale", "newhome", "rental"]
@@ -1,8 +1,13 @@
-import shutil
+import functools
 import os
+import json
 from datetime import datetime, timedelta
 from enum import Enum
-# import tempfile
+
+from ..city_registry import CityRegistry
+from ..markets import get_market
+from ..output_commit import FileLock, atomic_output, write_atomically
+from ..profiling import profiled
 
 
 class TableState(Enum):
@@ -27,101 +32,304 @@ class TableErrorCode(Enum):
     CREATE_DATA_TABLE_FILE_FAIL = 8
 
 
+N_WEEKDAY = 7
+
+
+def get_week_table_name(dtime):
+    weeknum = int(dtime.strftime("%U"))
+    yearnum = dtime.year
+    return "$\\text{{Year {} Week {}}}$".format(yearnum, weeknum)
+
+
+def get_week_date_row(dtime):
+    """
+    :return: The date row of the table of the week of dtime, Sunday first, without the line end
+    """
+    tstart_this_week = dtime - timedelta(dtime.isoweekday() % N_WEEKDAY)
+    dates_this_week = [(tstart_this_week + timedelta(days=i)).strftime("%m-%d") for i in range(N_WEEKDAY)]
+    return "\\mathrm{Date} & " + " & ".join(["\\mathrm{" + dstr + "}" for dstr in dates_this_week])
+
+
+def render_filled_week_table(week_time, cities, unknown_cities, columns):
+    """
+    Render the table of a week with the numbers of its runs, the same lines as
+    an empty table (see ResaleTableRefresh.render_this_week_table) updated by
+    each run of the week in turn. It doesn't depend on the other weeks, so the
+    weeks can be rendered in parallel
+    :param week_time: A time in the week
+    :param cities: The (Chinese name, English name) of the city rows
+    :param unknown_cities: The (Chinese name, English name) of the unknown rows
+    :param columns: {day of the week (0 is Sunday): (run time, {English name: number})},
+                    the last run of each day
+    :return: The lines of the table, from the week title to the end of the table
+    """
+    def row(label, cells):
+        return label + " & " + " & ".join(cells) + " \\\\"
+
+    days = range(N_WEEKDAY)
+    lines = [f"### Week {int(week_time.strftime('%U'))}", "", get_week_table_name(week_time)]
+    lines.append("$$")
+    lines.append("\\begin{array}{l|r|r|r|r|r|r|r}")
+    lines.append("\\hline")
+    lines.append(get_week_date_row(week_time) + " \\\\")
+    lines.append(row("\\mathrm{城市}", [columns[d][0].strftime("\\mathrm{%H:%M}") if d in columns else "\\mathrm{-}"
+                                        for d in days]))
+    lines.append("\\hline")
+    for cn_name, en_name in cities:
+        # A city without a number in a run is 0, the same as an update by that run
+        lines.append(row(cn_name, [format(max(columns[d][1].get(en_name, 0), 0), ",") if d in columns else "-"
+                                   for d in days]))
+    lines.append("\\hline")
+    for cn_name, en_name in unknown_cities:
+        cells = []
+        for d in days:
+            num = columns[d][1].get(en_name, 0) if d in columns else 0
+            cells.append(format(num, ",") if num > 0 else "-")
+        lines.append(row(cn_name, cells))
+    lines.append("\\hline")
+    lines.append("\\end{array}")
+    lines.append("$$")
+    lines.append("")
+    return lines
+
+
+def with_table_lock(method):
+    """
+    Hold the lock of the table file while a step reads and writes it, so
+    overlapping runs (e.g. the shards of a crawl) update the file one at a time
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not isinstance(self.fname, str):
+            return method(self, *args, **kwargs)
+        with FileLock(self.fname):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class ResaleTableRefresh:
     """
     Update a specific table for the resale numbers in file
+
+    The table of this week is always the last one in the file, so only the
+    part of the file from the table of this week to the end is read and
+    rewritten. The byte offset of each table is kept in a sidecar index file
+    (see index_fname), if the index is missing or out of date the offset is
+    found by one streaming scan of the file.
     """
-    def __init__(self, fname=None, scraped_data=dict()):
+    def __init__(self, fname=None, scraped_data=dict(), curtime=None, registry=None, market=None):
         self.fname = fname
-        self.curtime = datetime.now()
-        self.city_names = ['北京','广州','苏州','杭州','南京','西安','成都','重庆','天津','合肥','福州','厦门','长沙','深圳','上海','武汉']
-        self.en_city_names = ['Beijing','Guangzhou','Suzhou','Hangzhou','Nanjing','Xi_an','Chengdu','Chongqing','Tianjin','Hefei','Fuzhou','Xiamen','Changsha','Shenzhen','Shanghai','Wuhan']
+        # The tables of the other markets (new homes, rentals) have the same layout
+        self.market = get_market(market)
+        self.index_fname = fname + ".idx" if isinstance(fname, str) else None
+        # The time of the run, a resumed run updates the same column as the run it resumes
+        self.curtime = datetime.now() if curtime is None else curtime
+        # The city rows of the table, in the report order of the city registry
+        self.registry = CityRegistry.load() if registry is None else registry
+        self.city_names = [city.cn for city in self.registry.get_report_cities(unknown=False)]
+        self.unknown_city_names = [city.cn for city in self.registry.get_report_cities(unknown=True)]
         self.cdata = scraped_data.copy()
         self.table_data_date_time = []
         self.city_number = []
         self.city_number_unknown = []
-        self.copy_until_linenum = -1
+        # Byte offset of the title line of this week's table, and the lines
+        # from that offset to the end of the file
+        self.table_offset = -1
+        self.table_lines = None
         self.encoding_style = 'UTF-8'
+        self.newline = os.linesep
 
     def get_en_city_name(self, cn_name):
-        if not cn_name in self.city_names:
-            return ""
-        index = self.city_names.index(cn_name)
-        return self.en_city_names[index]
+        return self.registry.get_en_name(cn_name)
 
     def get_cn_city_name(self, en_name):
-        if not en_name in self.en_city_names:
-            return ""
-        index = self.en_city_names.index(en_name)
-        return self.city_names[index]
+        return self.registry.get_cn_name(en_name)
 
     def get_file_header_str(self):
         year_str = self.curtime.strftime("%Y")
-        hdr_str = (f"# Year {year_str} Resale Numbers from Lianjia/Beike\n\n"
-                   f"## 重点城市二手房数量统计\n\n")
+        hdr_str = (f"# Year {year_str} {self.market.title_en} Numbers from Lianjia/Beike\n\n"
+                   f"## 重点城市{self.market.title_cn}数量统计\n\n")
         return hdr_str
 
+    def get_this_week_table_name(self):
+        return get_week_table_name(self.curtime)
+
     def check_table_file_existence(self):
         return os.path.isfile(self.fname) and os.access(self.fname, os.F_OK)
 
+    @with_table_lock
     def create_file_and_write_header(self):
         if self.check_table_file_existence():
             print(f"File alreayd exist, not need to create: {self.fname}")
             return True
 
-        with open(self.fname, 'a+', encoding=self.encoding_style) as fp:
+        with atomic_output(self.fname, 'w', encoding=self.encoding_style) as fp:
             fp.write(f"{self.get_file_header_str()}")
 
         return self.check_table_file_existence()
 
+    def detect_newline(self):
+        """
+        Use the same line ending as the first line of the file, the file
+        may be written on Windows and updated on Linux or the other way round
+        """
+        with open(self.fname, 'rb') as fp:
+            first_line = fp.readline()
+        if first_line.endswith(b"\r\n"):
+            self.newline = "\r\n"
+        elif first_line.endswith(b"\n"):
+            self.newline = "\n"
+        return self.newline
+
+    def load_table_index(self):
+        try:
+            with open(self.index_fname, 'r', encoding=self.encoding_style) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+
+    def save_table_offset(self, table_name, offset):
+        try:
+            with FileLock(self.index_fname):
+                tindex = self.load_table_index()
+                tindex[table_name] = offset
+                with atomic_output(self.index_fname, 'w', encoding=self.encoding_style) as fp:
+                    json.dump(tindex, fp, ensure_ascii=False, indent=1)
+        except OSError as err:
+            # The index is only a shortcut, the table can always be found by a scan
+            print(f"[PYRAD] WARNING: Failed to save table index {self.index_fname}: {err}")
+
+    def check_table_offset(self, table_name, offset):
+        """
+        Check the title line of the table starts at the given byte offset
+        """
+        if not isinstance(offset, int) or offset < 0:
+            return False
+        with open(self.fname, 'rb') as fp:
+            fp.seek(offset)
+            line = fp.readline()
+        return line.decode(self.encoding_style, errors='replace').strip() == table_name
+
+    def scan_for_table(self, table_name):
+        """
+        Stream the file once to find the byte offset of the title line of a table
+        :return: The byte offset of the first table of the name, or -1 if not found
+        """
+        name_bytes = table_name.encode(self.encoding_style)
+        offset = 0
+        found = -1
+        nfound = 0
+        with open(self.fname, 'rb') as fp:
+            for line in fp:
+                if line.strip() == name_bytes:
+                    nfound += 1
+                    if found < 0:
+                        found = offset
+                offset += len(line)
+        if nfound > 1:
+            # The first table is the one updated, as the tables after it are
+            # rewritten, the later ones with the same title are dropped
+            print(f"[PYRAD] WARNING: {nfound} tables named {table_name} in {self.fname}, the first one is updated")
+        return found
+
+    @profiled("table_find")
     def find_this_week_table(self):
-        weeknum = int(self.curtime.strftime("%U"))
-        yearnum = self.curtime.year
-        table_name = "$\\text{{Year {} Week {}}}$".format(yearnum, weeknum)
-        self.copy_until_linenum = -1
-        with open(self.fname, 'r', encoding=self.encoding_style) as fp:
-            for i, line in enumerate(fp):
-                curline = line.strip()
-                if curline == table_name:
-                    self.copy_until_linenum = i
-                    break
-        return self.copy_until_linenum
+        table_name = self.get_this_week_table_name()
+        self.table_offset = -1
+        self.table_lines = None
+
+        offset = self.load_table_index().get(table_name, -1)
+        if not self.check_table_offset(table_name, offset):
+            offset = self.scan_for_table(table_name)
+            if offset >= 0:
+                self.save_table_offset(table_name, offset)
 
+        self.table_offset = offset
+        return self.table_offset
+
+    def read_this_week_table(self):
+        """
+        Read the lines from the title line of this week's table to the end of the file
+        """
+        with open(self.fname, 'rb') as fp:
+            fp.seek(self.table_offset)
+            tail = fp.read()
+        self.newline = "\r\n" if b"\r\n" in tail[:256] else "\n"
+        self.table_lines = tail.decode(self.encoding_style).splitlines()
+        return self.table_lines
+
+    def render_this_week_table(self):
+        """
+        Render an empty table for this week
+        :return: The lines of the table, from the week title to the end of the table
+        """
+        lines = []
+        cur_week_num = int(self.curtime.strftime("%U"))
+        lines.append(f"### Week {cur_week_num}")
+        lines.append("")
+        lines.append(self.get_this_week_table_name())
+        lines.append("")
+        lines.append("$$")
+        lines.append("\\begin{array}{l|r|r|r|r|r|r|r}")
+        lines.append("\\hline")
+        # Date row
+        lines.append(get_week_date_row(self.curtime) + " \\\\ ")
+        # Time row
+        time_row = "\\mathrm{城市} & " + " & ".join(["\\mathrm{-}"] * N_WEEKDAY)
+        lines.append(time_row + " \\\\ ")
+        lines.append("\\hline")
+        # City number rows
+        row_last_part = " & " + " & ".join(["-"] * N_WEEKDAY) + " \\\\"
+        for city in self.city_names:
+            lines.append(city + row_last_part)
+        lines.append("\\hline")
+        # City number unkown rows
+        for city in self.unknown_city_names:
+            lines.append(city + row_last_part)
+        lines.append("\\hline")
+        lines.append("\\end{array}")
+        lines.append("$$")
+        lines.append("")
+        return lines
+
+    def write_file_from(self, offset, tail):
+        """
+        Replace the table file by its first bytes up to offset followed by
+        tail, through a temp file, so the table file is never left half written
+        """
+        with atomic_output(self.fname) as fp:
+            with open(self.fname, 'rb') as fpr:
+                # Copy tables before this week as raw bytes
+                remaining = offset
+                while remaining > 0:
+                    chunk = fpr.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    fp.write(chunk)
+                    remaining -= len(chunk)
+            fp.write(tail)
+
+    @profiled("table_add")
+    @with_table_lock
     def add_table_for_this_week(self):
         if not isinstance(self.fname, str):
             return TableErrorCode.ADD_THIS_WEEK_TABLE_FAIL
-        N_WEEKDAY = 7
-        with open(self.fname, 'a+', encoding=self.encoding_style) as fp:
-            # First add 2 empty lines to separate it from the previous table
-            fp.write("\n\n")
-            cur_week_num = int(self.curtime.strftime("%U"))
-            fp.write(f"### Week {cur_week_num}\n")
-            fp.write(f"\n$\\text{{Year {self.curtime.year} Week {cur_week_num}}}$\n\n")
-            fp.write("$$\n")
-            fp.write("\\begin{array}{l|r|r|r|r|r|r|r}\n")
-            fp.write("\\hline\n")
-            # Date row
-            tstart_this_week = self.curtime - timedelta(self.curtime.isoweekday() % N_WEEKDAY)
-            dates_this_week = [(tstart_this_week + timedelta(days=i)).strftime("%m-%d") for i in range(7)]
-            date_row = "\\mathrm{Date} & " + " & ".join(["\\mathrm{" + dstr + "}" for dstr in dates_this_week])
-            fp.write(date_row + " \\\\ \n")
-            # Time row
-            time_row = "\\mathrm{城市} & " + " & ".join(["\\mathrm{-}"] * N_WEEKDAY)
-            fp.write(time_row + " \\\\ \n")
-            fp.write("\\hline\n")
-            # City number rows
-            row_last_part = " & " + " & ".join(["-"] * N_WEEKDAY) + " \\\\"
-            for city in self.city_names[:-2]:
-                crow = city + row_last_part
-                fp.write(crow + "\n")
-            fp.write("\\hline\n")
-            # City number unkown rows
-            for city in self.city_names[-2:]:
-                crow = city + row_last_part
-                fp.write(crow + "\n")
-            fp.write("\\hline\n")
-            fp.write("\\end{array}\n")
-            fp.write("$$\n\n")
+
+        nl = self.detect_newline()
+        # First add 2 empty lines to separate it from the previous table
+        lines = ["", ""] + self.render_this_week_table()
+        start = os.path.getsize(self.fname)
+        try:
+            self.write_file_from(start, (nl.join(lines) + nl).encode(self.encoding_style))
+        except OSError as err:
+            print(f"[PYRAD] ERROR: Failed to write {self.fname}: {err}")
+            return TableErrorCode.ADD_THIS_WEEK_TABLE_FAIL
+
+        # The table is appended to the end of the file, so its offset is known without a scan,
+        # the title line is the 5th line written
+        self.table_offset = start + len((nl.join(lines[:4]) + nl).encode(self.encoding_style))
+        self.table_lines = None
+        self.save_table_offset(self.get_this_week_table_name(), self.table_offset)
 
         return TableErrorCode.ADD_THIS_WEEK_TABLE_SUCCESS
 
@@ -130,8 +338,8 @@ class ResaleTableRefresh:
         Clear the parsed data for the table of this week, currently this
         includes the resale numbers of each city, the unkown resale numbers
         for some cities, and the date, time and city names for this table.
-        Don't clear the 'copy_until_linenum', as it parses the file for
-        searching it for only one time
+        Don't clear the 'table_offset' and 'table_lines', as it reads the file
+        for only one time
         :return:
         """
         self.city_number.clear()
@@ -142,13 +350,17 @@ class ResaleTableRefresh:
                 len(self.table_data_date_time) == 0
 
 
+    @profiled("table_parse")
     def parse_this_week_table(self):
 
         TEC = TableErrorCode
 
-        n = self.find_this_week_table()
-        if n < 0:
-            return TEC.THIS_WEEK_TABLE_NOT_FOUND
+        if self.table_offset < 0:
+            n = self.find_this_week_table()
+            if n < 0:
+                return TEC.THIS_WEEK_TABLE_NOT_FOUND
+        if self.table_lines is None:
+            self.read_this_week_table()
 
         #self.city_number.clear()
         #self.city_number_unknown.clear()
@@ -158,117 +370,110 @@ class ResaleTableRefresh:
         st = TableState.st_none
         hline_cnt = 0
         ncol = -1
-        with open(self.fname, 'r', encoding=self.encoding_style) as fp:
-            for i, line in enumerate(fp):
-                if i <= n:
+        # The first line is the title line of the table
+        for line in self.table_lines[1:]:
+            assert isinstance(line, str)
+            curline = line.strip()
+            hline_cnt += (1 if curline.startswith("\\hline") else 0)
+            clist = curline.split()
+            #print(f"Line {i}: {curline}")
+            if st == TableState.st_none:
+                st = TableState.st_start
+            elif st == TableState.st_start:
+                if not curline.startswith("\\begin"):
+                    continue
+                st = TableState.st_date
+            elif st == TableState.st_date:
+                if not curline.startswith("\\mathrm"):
                     continue
-                assert isinstance(line, str)
-                curline = line.strip()
-                hline_cnt += (1 if curline.startswith("\\hline") else 0)
-                clist = curline.split()
-                #print(f"Line {i}: {curline}")
-                if st == TableState.st_none:
-                    st = TableState.st_start
-                elif st == TableState.st_start:
-                    if not curline.startswith("\\begin"):
-                        continue
-                    st = TableState.st_date
-                elif st == TableState.st_date:
-                    if not curline.startswith("\\mathrm"):
-                        continue
-                    st = TableState.st_time
-                    #print(f"TableState.st_date len(clist) = {len(clist)}")
-                    colstr = self.curtime.strftime("\\mathrm{%m-%d}")
-                    if colstr in clist:
-                        ncol = clist.index(colstr)
-                        #print(f"Found date column is {ncol}")
-                        self.table_data_date_time.append(curline)
-                    else:
-                        return TEC.THIS_WEEK_TABLE_DATE_COLUMN_NOT_FOUND
-                elif st == TableState.st_time:
-                    if not curline.startswith("\\mathrm"):
-                        continue
-                    st = TableState.st_city_num
-                    #print(f"TableState.st_time len(clist) = {len(clist)}")
-                    if ncol >= 0:
-                        curtimestr = self.curtime.strftime("\\mathrm{%H:%M}")
-                        clist[ncol] = curtimestr
-                        self.table_data_date_time.append(' '.join(clist))
-                elif st == TableState.st_city_num:
-                    if hline_cnt < 2:
-                        continue
-                    if hline_cnt == 2 and curline.startswith("\\hline"):
-                        continue
-                    if hline_cnt == 3:
-                        st = TableState.st_city_num_unkown
-                        continue
-                    #print(f"TableState.st_city_num len(clist) = {len(clist)}, clist[0] = {clist[0]}, {clist[0] in self.city_names}")
-                    if ncol >= 0:
-                        curnum = self.cdata.get(self.get_en_city_name(clist[0]), 0)
-                        clist[ncol] = format(curnum, ',')
-                        self.city_number.append(' '.join(clist))
-                elif st == TableState.st_city_num_unkown:
-                    if curline.startswith("\\hline"):
-                        st = TableState.st_end
-                        continue
-                    #print(f"TableState.st_city_num_unkown len(clist) = {len(clist)}, clist[0] = {clist[0]}, {clist[0] in self.city_names}")
-                    if ncol >= 0:
-                        curnum = self.cdata.get(self.get_en_city_name(clist[0]), 0)
-                        clist[ncol] = format(curnum, ',') if curnum > 0 else "-"
-                        self.city_number_unknown.append(' '.join(clist))
+                st = TableState.st_time
+                #print(f"TableState.st_date len(clist) = {len(clist)}")
+                colstr = self.curtime.strftime("\\mathrm{%m-%d}")
+                if colstr in clist:
+                    ncol = clist.index(colstr)
+                    #print(f"Found date column is {ncol}")
+                    self.table_data_date_time.append(curline)
                 else:
-                    pass
+                    return TEC.THIS_WEEK_TABLE_DATE_COLUMN_NOT_FOUND
+            elif st == TableState.st_time:
+                if not curline.startswith("\\mathrm"):
+                    continue
+                st = TableState.st_city_num
+                #print(f"TableState.st_time len(clist) = {len(clist)}")
+                if ncol >= 0:
+                    curtimestr = self.curtime.strftime("\\mathrm{%H:%M}")
+                    clist[ncol] = curtimestr
+                    self.table_data_date_time.append(' '.join(clist))
+            elif st == TableState.st_city_num:
+                if hline_cnt < 2:
+                    continue
+                if hline_cnt == 2 and curline.startswith("\\hline"):
+                    continue
+                if hline_cnt == 3:
+                    st = TableState.st_city_num_unkown
+                    continue
+                #print(f"TableState.st_city_num len(clist) = {len(clist)}, clist[0] = {clist[0]}, {clist[0] in self.city_names}")
+                if ncol >= 0:
+                    curnum = self.cdata.get(self.get_en_city_name(clist[0]), 0)
+                    clist[ncol] = format(curnum, ',')
+                    self.city_number.append(' '.join(clist))
+            elif st == TableState.st_city_num_unkown:
+                if curline.startswith("\\hline"):
+                    st = TableState.st_end
+                    break
+                #print(f"TableState.st_city_num_unkown len(clist) = {len(clist)}, clist[0] = {clist[0]}, {clist[0] in self.city_names}")
+                if ncol >= 0:
+                    curnum = self.cdata.get(self.get_en_city_name(clist[0]), 0)
+                    clist[ncol] = format(curnum, ',') if curnum > 0 else "-"
+                    self.city_number_unknown.append(' '.join(clist))
+            else:
+                pass
 
         return TEC.THIS_WEEK_TABLE_PARSE_SUCCESS if len(self.city_number) != 0 else TEC.THIS_WEEK_TABLE_PARSE_FAIL
 
+    @profiled("table_update")
+    @with_table_lock
     def update_this_week_table(self):
         # Error code class (enum) short hand
         TEC = TableErrorCode
 
         # Before updating the table file, make sure the table for this week
-        # has already been added
-        errcode = self.parse_this_week_table()
-        if errcode == TEC.THIS_WEEK_TABLE_NOT_FOUND or \
-           errcode == TEC.THIS_WEEK_TABLE_DATE_COLUMN_NOT_FOUND:
+        # has already been added and parsed
+        if len(self.city_number) == 0:
+            errcode = self.parse_this_week_table()
+            if errcode == TEC.THIS_WEEK_TABLE_NOT_FOUND or \
+               errcode == TEC.THIS_WEEK_TABLE_DATE_COLUMN_NOT_FOUND:
+                return TEC.UPDATE_THIS_WEEK_TABLE_FAIL
+
+        # Tables before this week are kept as they are, only the part from
+        # the title line of this week's table is rendered again
+        lines = [self.table_lines[0]]
+        lines.append("$$")
+        lines.append("\\begin{array}{l|r|r|r|r|r|r|r}")
+        lines.append("\\hline")
+        lines.extend(self.table_data_date_time)
+        lines.append("\\hline")
+        lines.extend(self.city_number)
+        lines.append("\\hline")
+        lines.extend(self.city_number_unknown)
+        lines.append("\\hline")
+        lines.append("\\end{array}")
+        lines.append("$$")
+        lines.append("")
+        tail = (self.newline.join(lines) + self.newline).encode(self.encoding_style)
+
+        try:
+            self.write_file_from(self.table_offset, tail)
+        except OSError as err:
+            print(f"[PYRAD] ERROR: Failed to write {self.fname}: {err}")
             return TEC.UPDATE_THIS_WEEK_TABLE_FAIL
 
-        #fp = tempfile.TemporaryFile(mode='w', encoding='utf-8', dir='.')
-        tmpfname = "mytemp.md"
-        fp = open(tmpfname, "w", encoding=self.encoding_style)
-
-        # Copy tables before this week
-        if self.copy_until_linenum >= 0:
-            with open(self.fname, 'r', encoding=self.encoding_style) as fpr:
-                for i, line in enumerate(fpr):
-                    if i <= self.copy_until_linenum:
-                        fp.write(line)
-
-        fp.write("$$\n")
-        fp.write("\\begin{array}{l|r|r|r|r|r|r|r}\n")
-        fp.write("\\hline\n")
-        for l in self.table_data_date_time:
-            fp.write(l + '\n')
-        fp.write("\\hline\n")
-        for l in self.city_number:
-            fp.write(l + '\n')
-        fp.write("\\hline\n")
-        for l in self.city_number_unknown:
-            fp.write(l + '\n')
-        fp.write("\\hline\n")
-        fp.write("\\end{array}\n")
-        fp.write("$$\n\n")
-        fp.close()
-
-        # print(f"fp.name = {fp.name}")
-        # print(f"self.fname = {self.fname}")
-        # print(f"os.path.abspath(self.fname) = {os.path.abspath(self.fname)}")
-        #shutil.copy(self.fname, self.fname + ".bak.md")
-        os.remove(self.fname)
-        shutil.copy(tmpfname, self.fname)
-        os.remove(tmpfname)
+        self.table_lines = (self.newline.join(lines)).splitlines()
 
         return TEC.UPDATE_THIS_WEEK_TABLE_SUCCESS
 
+    @profiled("table_refresh")
+    @with_table_lock
     def refresh(self):
         TEC = TableErrorCode
 
@@ -285,8 +490,10 @@ class ResaleTableRefresh:
            errcode == TEC.THIS_WEEK_TABLE_DATE_COLUMN_NOT_FOUND:
             print(f"[PYRAD] WARNING: Table for this week not found, added a table for this week")
             errcode = self.add_table_for_this_week()
-        if errcode == TEC.ADD_THIS_WEEK_TABLE_SUCCESS or \
-           errcode == TEC.THIS_WEEK_TABLE_PARSE_SUCCESS:
+            if errcode == TEC.ADD_THIS_WEEK_TABLE_SUCCESS:
+                # Only the table just added is read
+                errcode = self.parse_this_week_table()
+        if errcode == TEC.THIS_WEEK_TABLE_PARSE_SUCCESS:
             errcode = self.update_this_week_table()
         if errcode == TEC.UPDATE_THIS_WEEK_TABLE_SUCCESS:
             print(f"[PYRAD] INFO: Successfully updated the resale table for this week")
@@ -294,6 +501,78 @@ class ResaleTableRefresh:
             print(f"[PYRAD] ERROR: Failed to update the resale table for this week")
 
 
+class ResaleTableRebuild(ResaleTableRefresh):
+    """
+    Build the whole table file of a year from the history, instead of
+    updating the table of this week run after run. The file is the same as
+    the one the runs of the year would have left, so past weeks can be fixed
+    and cities added by rebuilding the year. Each week is rendered on its
+    own (in parallel with an executor), and the file and its index are
+    written once, by renaming a temp file over them
+    """
+    def __init__(self, fname, year, registry=None, market=None):
+        super().__init__(fname, dict(), datetime(int(year), 1, 1), registry, market)
+        self.year = int(year)
+
+    def group_runs_by_week(self, runs):
+        """
+        :param runs: An iterable of (run time, {English name: number}) in the order of time
+        :return: A list of (week time, columns) of the weeks of the year with runs,
+                 see render_filled_week_table()
+        """
+        weeks = dict()
+        for run_time, data in runs:
+            if run_time.year != self.year:
+                continue
+            week = weeks.setdefault(int(run_time.strftime("%U")), (run_time, dict()))
+            # The last run of a day is the one in the table
+            week[1][run_time.isoweekday() % N_WEEKDAY] = (run_time, data)
+        return [weeks[weeknum] for weeknum in sorted(weeks)]
+
+    def render(self, runs, executor=None):
+        """
+        :param executor: A concurrent.futures executor to render the weeks in
+        :return: A tuple (the content of the file as bytes, {table name: byte offset})
+        """
+        weeks = self.group_runs_by_week(runs)
+        cities = [(c.cn, c.en) for c in self.registry.get_report_cities(unknown=False)]
+        unknown_cities = [(c.cn, c.en) for c in self.registry.get_report_cities(unknown=True)]
+        args = ([w[0] for w in weeks], [cities] * len(weeks), [unknown_cities] * len(weeks), [w[1] for w in weeks])
+        if executor is not None:
+            tables = list(executor.map(render_filled_week_table, *args, chunksize=8))
+        else:
+            tables = list(map(render_filled_week_table, *args))
+
+        nl = self.detect_newline() if self.check_table_file_existence() else os.linesep
+        parts = [self.get_file_header_str().replace("\n", nl).encode(self.encoding_style)]
+        pos = len(parts[0])
+        tindex = dict()
+        for (week_time, _), lines in zip(weeks, tables):
+            # 2 empty lines before each table, as add_table_for_this_week() does
+            head = (nl.join(["", "", lines[0], lines[1]]) + nl).encode(self.encoding_style)
+            body = (nl.join(lines[2:]) + nl).encode(self.encoding_style)
+            tindex[get_week_table_name(week_time)] = pos + len(head)
+            parts.extend([head, body])
+            pos += len(head) + len(body)
+        return b"".join(parts), tindex
+
+    @profiled("table_rebuild")
+    def rebuild(self, runs, executor=None):
+        """
+        Write the table file of the year from the runs
+        :return: The number of weekly tables written
+        """
+        with FileLock(self.fname):
+            data, tindex = self.render(runs, executor)
+            write_atomically(self.fname, data, lock=False)
+            # The index is only a shortcut, it is written after the file
+            write_atomically(self.index_fname,
+                             json.dumps(tindex, ensure_ascii=False, indent=1).encode(self.encoding_style))
+        self.table_offset = -1
+        self.table_lines = None
+        return len(tindex)
+
+
 if __name__ == "__main__":
     print(f"This is the __main__ block for module table_refresh.py")
     #fn = f"D:/Pyrad/Gitee/pyradnotes/source/RealEstate/resalenumbers2023.md"